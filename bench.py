@@ -0,0 +1,533 @@
+#!/usr/bin/env python3
+# bench.py — offline load test for bot.py
+# Runs the real handlers against a local stand-in for the Telegram Bot API:
+#   python bench.py                 # 200 users, json storage
+#   python bench.py 1000 --storage sqlite --limits
+#   python bench.py --memory        # users_db memory: dict vs UserRecord, 100k and 1M users
+#   python bench.py 400 --cluster 4 # ingress + 4 worker processes (sqlite)
+#   python bench.py 500 --webhook   # updates POSTed to WebhookServer instead of getUpdates
+# Nothing leaves the machine; data goes to a temporary BOT_DATA_DIR.
+
+import argparse
+import gc
+import http.client
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import deque
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+FAKE_TOKEN = "123456:BENCH-offline-token"
+USER_BASE = 10_000_000               # simulated users are USER_BASE + n
+
+# ================ fake Bot API ================
+class FakeTelegram:
+    """Minimal Bot API: answers send*/edit*/answer* calls with plausible
+    results, keeps every sent message (and later edits), and serves the
+    injected updates through getUpdates long polling, or after push_to()
+    POSTs them to a webhook the way Telegram does."""
+
+    def __init__(self):
+        self.lock = threading.Condition()
+        self.updates = []            # pending updates, ascending update_id
+        self.next_update_id = 1
+        self.next_message_id = 1
+        self.messages = {}           # (chat_id, message_id) -> message dict
+        self.calls = {}              # method -> count
+        self.sent = []               # (method, chat_id, message) for send* calls
+        self.injected = {}           # update_id -> time.perf_counter() at injection
+        self.push_queues = None      # webhook delivery: pending updates per connection
+        self.pushed = {}             # webhook delivery: HTTP status -> POSTs answered with it
+
+    # ---- update side ----
+    def inject(self, update):
+        with self.lock:
+            uid = self.next_update_id
+            self.next_update_id += 1
+            update["update_id"] = uid
+            if self.push_queues is not None:
+                self.push_queues[update_chat(update) % len(self.push_queues)].append(update)
+            else:
+                self.updates.append(update)
+            self.injected[uid] = time.perf_counter()
+            self.lock.notify_all()
+            return uid
+
+    def get_updates(self, params):
+        offset = int(params.get("offset", 0) or 0)
+        limit = int(params.get("limit", 100) or 100)
+        timeout = float(params.get("timeout", 0) or 0)
+        deadline = time.monotonic() + timeout
+        with self.lock:
+            while True:
+                self.updates = [u for u in self.updates if u["update_id"] >= offset]
+                if self.updates or time.monotonic() >= deadline:
+                    return self.updates[:limit]
+                self.lock.wait(deadline - time.monotonic())
+
+    # ---- webhook delivery ----
+    def push_to(self, address, path, secret, connections):
+        # from now on injected updates are POSTed to address+path. A chat always
+        # uses the same connection, so its updates arrive in order; an update
+        # stays at the head of its connection until the bot answers 200
+        with self.lock:
+            self.push_queues = [deque() for _ in range(connections)]
+        for i in range(connections):
+            threading.Thread(target=self.pusher, args=(self.push_queues[i], address, path, secret),
+                             name=f"webhook-push-{i}", daemon=True).start()
+
+    def pusher(self, pending, address, path, secret):
+        conn = http.client.HTTPConnection(*address, timeout=60)
+        headers = {"Content-Type": "application/json", "X-Telegram-Bot-Api-Secret-Token": secret}
+        while True:
+            with self.lock:
+                while not pending:
+                    self.lock.wait()
+                update = pending[0]
+            try:
+                conn.request("POST", path, body=json.dumps(update, ensure_ascii=False).encode("utf-8"),
+                             headers=headers)
+                resp = conn.getresponse()
+                resp.read()
+                status = resp.status
+            except (OSError, http.client.HTTPException):
+                conn.close()                         # reconnects on the next request
+                status = 0
+            with self.lock:
+                self.pushed[status] = self.pushed.get(status, 0) + 1
+                if status == 200:
+                    pending.popleft()
+            if status != 200:
+                time.sleep(0.1)                      # Telegram backs off before redelivering
+
+    # ---- bot side ----
+    def new_message(self, chat_id, **fields):
+        with self.lock:
+            mid = self.next_message_id
+            self.next_message_id += 1
+            msg = {"message_id": mid, "date": int(time.time()),
+                   "chat": {"id": chat_id, "type": "private"}, **fields}
+            self.messages[(chat_id, mid)] = msg
+            return msg
+
+    def call(self, method, params):
+        with self.lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+        if method == "getUpdates":
+            return self.get_updates(params)
+        if method == "getMe":
+            return {"id": 123456, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+        chat_id = int(params["chat_id"]) if "chat_id" in params else None
+        markup = json.loads(params["reply_markup"]) if params.get("reply_markup") else None
+        if method == "sendMessage":
+            # like Telegram, only inline keyboards are echoed back on the message
+            inline = markup if markup and "inline_keyboard" in markup else None
+            msg = self.new_message(chat_id, text=params.get("text", ""),
+                                   **({"reply_markup": inline} if inline else {}))
+        elif method == "sendPhoto":
+            photo = params.get("photo", "uploaded")
+            msg = self.new_message(chat_id, caption=params.get("caption"),
+                                   photo=[{"file_id": photo, "file_unique_id": photo[:16],
+                                           "width": 1280, "height": 720}])
+        elif method == "sendMediaGroup":
+            msgs = [self.new_message(chat_id, photo=[{"file_id": m.get("media", ""), "file_unique_id": "g",
+                                                      "width": 1280, "height": 720}])
+                    for m in json.loads(params.get("media", "[]"))]
+            with self.lock:
+                self.sent.extend((method, chat_id, m) for m in msgs)
+            return msgs
+        elif method in ("editMessageReplyMarkup", "editMessageText", "editMessageCaption"):
+            with self.lock:
+                msg = self.messages.get((chat_id, int(params.get("message_id", 0))))
+                if msg is None:
+                    return True
+                if "text" in params:
+                    msg["text"] = params["text"]
+                if markup and markup.get("inline_keyboard"):
+                    msg["reply_markup"] = markup
+                else:
+                    msg.pop("reply_markup", None)
+                return dict(msg)
+        else:
+            return True              # answerCallbackQuery, deleteWebhook, ...
+        with self.lock:
+            self.sent.append((method, chat_id, msg))
+        return msg
+
+    def serve(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            wbufsize = 1 << 16               # headers and body leave in one write
+            disable_nagle_algorithm = True
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                body = self.rfile.read(length) if length else b""
+                url = urlparse(self.path)
+                method = url.path.rsplit("/", 1)[-1]
+                params = {k: v[-1] for k, v in parse_qs(url.query).items()}
+                if self.headers.get("Content-Type", "").startswith("application/x-www-form-urlencoded"):
+                    # the asyncio client posts its parameters as a form; multipart
+                    # uploads are not inspected
+                    params.update((k, v[-1]) for k, v in parse_qs(body.decode("utf-8")).items())
+                try:
+                    body = {"ok": True, "result": api.call(method, params)}
+                except Exception as e:
+                    body = {"ok": False, "error_code": 400, "description": f"Bad Request: {e}"}
+                data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            do_GET = do_POST
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, name="fake-telegram", daemon=True).start()
+        return server
+
+# ================ synthetic updates ================
+def update_chat(update):
+    if "callback_query" in update:
+        return update["callback_query"]["from"]["id"]
+    return update["message"]["chat"]["id"]
+
+def user_obj(chat_id):
+    return {"id": chat_id, "is_bot": False, "first_name": f"u{chat_id}", "language_code": "fa"}
+
+def text_update(chat_id, text):
+    return {"message": {"message_id": 1, "date": int(time.time()), "from": user_obj(chat_id),
+                        "chat": {"id": chat_id, "type": "private"}, "text": text}}
+
+def photo_update(chat_id):
+    fid = f"BENCH-receipt-{chat_id}"
+    return {"message": {"message_id": 1, "date": int(time.time()), "from": user_obj(chat_id),
+                        "chat": {"id": chat_id, "type": "private"},
+                        "photo": [{"file_id": fid, "file_unique_id": fid[-12:], "width": 1280, "height": 720}]}}
+
+def callback_update(user_id, data, message):
+    return {"callback_query": {"id": f"cb{time.perf_counter_ns()}", "from": user_obj(user_id),
+                               "chat_instance": "bench", "data": data, "message": message}}
+
+# ================ load generator ================
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+class Recorder:
+    """Counts handled updates and keeps handler / end-to-end latencies per phase."""
+
+    def __init__(self, api):
+        self.api = api
+        self.cond = threading.Condition()
+        self.handled = 0
+        self.phase = None
+        self.samples = {}            # phase -> {"handler": [...], "e2e": [...]}
+
+    def record(self, update_id, started, finished):
+        with self.cond:
+            s = self.samples.setdefault(self.phase, {"handler": [], "e2e": []})
+            s["handler"].append(finished - started)
+            injected = self.api.injected.pop(update_id, None)
+            if injected is not None:
+                s["e2e"].append(finished - injected)
+            self.handled += 1
+            self.cond.notify_all()
+
+    def wait(self, count, timeout):
+        deadline = time.monotonic() + timeout
+        with self.cond:
+            while self.handled < count:
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    raise TimeoutError(f"handled {self.handled}/{count} updates")
+                self.cond.wait(left)
+
+def run_phase(name, api, rec, scripts, results, timeout):
+    # scripts: list of per-chat update lists; injected round-robin so chats interleave
+    rec.phase = name
+    start = time.perf_counter()
+    before = rec.handled                # handling starts while we are still injecting
+    total = 0
+    for step in range(max((len(s) for s in scripts), default=0)):
+        for script in scripts:
+            if step < len(script):
+                api.inject(script[step])
+                total += 1
+    if total:
+        rec.wait(before + total, timeout)
+    elapsed = time.perf_counter() - start
+    s = rec.samples.get(name, {"handler": [], "e2e": []})
+    results.append({
+        "phase": name, "updates": total, "seconds": round(elapsed, 3),
+        "updates_per_s": round(total / elapsed, 1) if elapsed else 0.0,
+        **{f"handler_p{p}_ms": round(percentile(s["handler"], p) * 1000, 2) for p in (50, 95, 99)},
+        **{f"e2e_p{p}_ms": round(percentile(s["e2e"], p) * 1000, 2) for p in (50, 95, 99)},
+    })
+
+def shop_script(bot, chat_id, country):
+    label = f"{country} — {bot.COUNTRIES[country]:,}"
+    return [text_update(chat_id, t) for t in (
+        "📱 خرید شماره مجازی", "📱 شماره مجازی", label, "1",
+        "⭐ استارز", "100", "🧾 مشاهده سبد", "✅ نهایی‌سازی و پرداخت", "💳 پرداخت با کیف‌پول")]
+
+# ================ memory benchmark ================
+def synthetic_profile(n):
+    # fresh string objects per user, as json.loads would hand them over
+    return {
+        "first_name": f"user{n}", "last_name": f"family{n % 997}", "phone": f"+98912{n:07d}",
+        "lang": "".join(("f", "a")) if n % 5 else "".join(("e", "n")),
+        "wallet": (n * 7919) % 2_000_000, "points": n % 150, "vip": n % 50 == 0,
+        "created_at": (datetime(2024, 1, 1) + timedelta(seconds=n * 17)).isoformat(),
+    }
+
+def traced_size(build, count):
+    # bytes still allocated by the finished structure (temporaries are freed)
+    gc.collect()
+    tracemalloc.start()
+    data = build(count)
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del data
+    gc.collect()
+    return size
+
+def memory_bench(bot, counts):
+    layouts = {
+        "dict": lambda n: {str(USER_BASE + i): synthetic_profile(i) for i in range(n)},
+        "compact": lambda n: {str(USER_BASE + i): bot.UserRecord.from_dict(synthetic_profile(i)) for i in range(n)},
+    }
+    print("users_db memory (whole dict: keys, records and field values)")
+    print(f"{'users':>12}  {'dict layout':>24}  {'compact layout':>24}  {'saved':>6}")
+    for count in counts:
+        sizes = {name: traced_size(build, count) for name, build in layouts.items()}
+        cells = [f"{sizes[name] / 2**20:8.1f} MiB {sizes[name] / count:6.0f} B/user" for name in layouts]
+        saved = 100 * (1 - sizes["compact"] / sizes["dict"])
+        print(f"{count:>12,}  {cells[0]:>24}  {cells[1]:>24}  {saved:5.1f}%")
+
+def main():
+    ap = argparse.ArgumentParser(description="Offline load test for bot.py")
+    ap.add_argument("users", nargs="?", type=int, default=200)
+    ap.add_argument("--storage", choices=["json", "sqlite"], default="json")
+    ap.add_argument("--workers", type=int, default=None, help="dispatch workers (default DISPATCH_WORKERS)")
+    ap.add_argument("--cluster", type=int, default=0, metavar="N",
+                    help="run N worker processes behind a ClusterRouter (implies --storage sqlite)")
+    ap.add_argument("--webhook", action="store_true",
+                    help="deliver updates by POSTing them to bot.WebhookServer instead of getUpdates")
+    ap.add_argument("--limits", action="store_true", help="keep the real outbox rate limits")
+    ap.add_argument("--timeout", type=float, default=600, help="seconds allowed per phase")
+    ap.add_argument("--json", metavar="FILE", help="also write the report as JSON")
+    ap.add_argument("--keep", action="store_true", help="keep the temporary data dir")
+    ap.add_argument("--memory", nargs="*", type=int, metavar="USERS",
+                    help="only compare users_db memory, dict vs UserRecord (default 100000 1000000)")
+    args = ap.parse_args()
+    if args.cluster:
+        args.storage = "sqlite"
+
+    data_dir = tempfile.mkdtemp(prefix="bench-bot-")
+    os.environ["BOT_DATA_DIR"] = data_dir
+    os.environ["BOT_TOKEN"] = FAKE_TOKEN
+    os.environ["BOT_STORAGE"] = args.storage
+
+    if args.memory is not None:
+        sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+        import bot
+        memory_bench(bot, args.memory or [100_000, 1_000_000])
+        bot.storage.close()
+        shutil.rmtree(data_dir, ignore_errors=True)
+        return 0
+
+    api = FakeTelegram()
+    server = api.serve()
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    # inherited by cluster workers too
+    os.environ["BOT_API_URL"] = f"http://127.0.0.1:{server.server_address[1]}/bot{{0}}/{{1}}"
+    import bot
+    threading.Thread(target=bot.storage.maintenance, name="maintenance", daemon=True).start()
+
+    if not args.limits:
+        lift_limits()
+
+    rec = Recorder(api)
+    router = None
+    if args.cluster:
+        # handler time is measured in the worker and reported back with the ack
+        router = bot.ClusterRouter(bot.bot, args.cluster, initializer=None if args.limits else lift_limits)
+        router.on_done = lambda worker, update_id, seconds: rec.record(
+            update_id, time.perf_counter() - seconds, time.perf_counter())
+        dispatcher = router.install()
+    else:
+        class TimedDispatcher(bot.ChatDispatcher):
+            def handle(self, update):
+                started = time.perf_counter()
+                try:
+                    super().handle(update)
+                finally:
+                    rec.record(update.update_id, started, time.perf_counter())
+
+        dispatcher = TimedDispatcher(bot.bot, args.workers or bot.DISPATCH_WORKERS).install()
+    webhook = poller = None
+    if args.webhook:
+        secret = "bench-webhook-secret"
+        webhook = bot.WebhookServer(dispatcher, "127.0.0.1", 0, secret=secret).start()
+        api.push_to(webhook.address, bot.WEBHOOK_PATH, secret, bot.WEBHOOK_MAX_CONNECTIONS)
+    else:
+        poller = threading.Thread(target=bot.bot.polling, name="polling", daemon=True,
+                                  kwargs={"non_stop": True, "interval": 0, "timeout": 5, "long_polling_timeout": 1})
+        poller.start()
+
+    admin = bot.ADMIN_IDS[0]
+    users = [USER_BASE + n for n in range(args.users)]
+    countries = list(bot.COUNTRIES)
+    results = []
+    wall = time.perf_counter()
+    try:
+        # 1) /start, shop + cart, failed wallet checkout, wallet top-up, receipt photo
+        run_phase("browse_topup", api, rec, [
+            [text_update(u, "/start")] + shop_script(bot, u, countries[0]) +
+            [text_update(u, t) for t in ("💳 کیف‌پول / شارژ", "⬆️ شارژ کیف‌پول", "500,000")] +
+            [photo_update(u)]
+            for u in users], results, args.timeout)
+        settle(bot, api, router, args.timeout)
+
+        # 2) admin approves every receipt from the digests, one click per digest per round
+        digests = [m for method, cid, m in list(api.sent)
+                   if method == "sendMessage" and cid == admin and "approve_receipt:" in json.dumps(m.get("reply_markup") or {})]
+        rounds = max((len(m["reply_markup"]["inline_keyboard"]) for m in digests), default=0)
+        for r in range(rounds):
+            clicks = []
+            for m in digests:
+                rows = m["reply_markup"]["inline_keyboard"] if m.get("reply_markup") else []
+                if rows:
+                    current = json.loads(json.dumps(m))          # what the client would send now
+                    clicks.append([callback_update(admin, rows[0][0]["callback_data"], current)])
+            run_phase("admin_approve", api, rec, clicks, results, args.timeout)
+            settle(bot, api, router, args.timeout, digests=False)
+        merge_phases(results, "admin_approve")
+
+        # 3) the same users buy again and pay from the credited wallet
+        run_phase("wallet_checkout", api, rec, [shop_script(bot, u, countries[1]) for u in users],
+                  results, args.timeout)
+        settle(bot, api, router, args.timeout)
+    finally:
+        if webhook is not None:
+            webhook.stop()
+        else:
+            bot.bot.stop_polling()
+            poller.join(5)
+        dispatcher.stop()
+    wall = time.perf_counter() - wall
+
+    orders, receipts = bot.orders_db, bot.receipts_db
+    if router is not None:
+        # the workers wrote them; read the shared database
+        _, orders, receipts, _ = bot.SqliteStorage(bot.SQLITE_FILE).load()
+    approved = sum(1 for r in receipts if r.get("status") == "approved" and r.get("user_id") in set(users))
+    paid = sum(1 for o in orders if o.get("status") == "paid")
+    all_handler = [x for s in rec.samples.values() for x in s["handler"]]
+    report = {
+        "users": args.users, "storage": args.storage, "rate_limits": args.limits,
+        "workers": args.workers or bot.DISPATCH_WORKERS, "cluster": args.cluster,
+        "ingress": "webhook" if args.webhook else "polling",
+        "phases": results,
+        "total": {
+            "updates": rec.handled, "seconds": round(wall, 3),
+            "updates_per_s": round(rec.handled / wall, 1) if wall else 0.0,
+            **{f"handler_p{p}_ms": round(percentile(all_handler, p) * 1000, 2) for p in (50, 95, 99)},
+        },
+        "api_calls": dict(sorted(api.calls.items())),
+        "webhook_posts": {str(k): v for k, v in sorted(api.pushed.items())},
+        "outbox": bot.outbox.stats(),
+        "check": {"receipts_approved": approved, "orders_paid": paid,
+                  "ok": approved == args.users and paid == args.users},
+    }
+    print_report(report)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+    bot.storage.close()
+    if args.keep:
+        print(f"data kept in {data_dir}")
+    else:
+        shutil.rmtree(data_dir, ignore_errors=True)
+    server.shutdown()
+    return 0 if report["check"]["ok"] else 1
+
+def lift_limits():
+    # no outbox pacing; runs in this process and, in cluster mode, in every worker
+    bot = sys.modules["bot"]
+    bot.outbox.global_bucket = bot.TokenBucket(1e9)
+    bot.outbox.chat_rate = bot.outbox.chat_burst = 1e9
+
+def settle(bot, api, router, timeout, digests=True):
+    # wait until queued replies (and admin digests, if new ones are expected) are out
+    if router is None:
+        bot.admin_digest.flush()
+        bot.outbox.drain(timeout)
+        return
+    # the workers' digests and outboxes are out of reach: wait out the digest
+    # window, then until the fake API sees no more bot calls
+    if digests:
+        time.sleep(bot.ADMIN_DIGEST_WINDOW)
+    deadline = time.monotonic() + timeout
+    last = None
+    while time.monotonic() < deadline:
+        with api.lock:
+            now = sum(n for m, n in api.calls.items() if m != "getUpdates")
+        if now == last:
+            return
+        last = now
+        time.sleep(0.5)
+
+def merge_phases(results, name):
+    # admin rounds are recorded one by one; fold them into a single row
+    rows = [r for r in results if r["phase"] == name]
+    if len(rows) <= 1:
+        return
+    merged = dict(rows[-1])
+    merged["updates"] = sum(r["updates"] for r in rows)
+    merged["seconds"] = round(sum(r["seconds"] for r in rows), 3)
+    merged["updates_per_s"] = round(merged["updates"] / merged["seconds"], 1) if merged["seconds"] else 0.0
+    results[:] = [r for r in results if r["phase"] != name] + [merged]
+
+def print_report(report):
+    print(f"users={report['users']} storage={report['storage']} workers={report['workers']} "
+          f"cluster={report.get('cluster') or 'off'} ingress={report.get('ingress', 'polling')} "
+          f"rate_limits={'on' if report['rate_limits'] else 'off'}")
+    cols = ["phase", "updates", "seconds", "updates_per_s",
+            "handler_p50_ms", "handler_p95_ms", "handler_p99_ms", "e2e_p50_ms", "e2e_p95_ms", "e2e_p99_ms"]
+    print("  ".join(f"{c:>15}" for c in cols))
+    for r in report["phases"]:
+        print("  ".join(f"{str(r.get(c, '')):>15}" for c in cols))
+    t = report["total"]
+    print(f"total: {t['updates']} updates in {t['seconds']}s = {t['updates_per_s']} updates/s, "
+          f"handler p50/p95/p99 = {t['handler_p50_ms']}/{t['handler_p95_ms']}/{t['handler_p99_ms']} ms")
+    print("api calls:", ", ".join(f"{k}={v}" for k, v in report["api_calls"].items()))
+    if report.get("webhook_posts"):
+        # 0 = connection error; anything but 200 was delivered again
+        print("webhook posts:", ", ".join(f"{k}={v}" for k, v in report["webhook_posts"].items()))
+    o = report["outbox"]
+    print("outbox:", ", ".join(f"{k}={v}" for k, v in o.items()))
+    c = report["check"]
+    print(f"check: receipts approved {c['receipts_approved']}/{report['users']}, "
+          f"orders paid {c['orders_paid']}/{report['users']} -> {'OK' if c['ok'] else 'MISMATCH'}")
+
+if __name__ == "__main__":
+    sys.exit(main())
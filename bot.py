@@ -1,825 +1,4547 @@
-#!/usr/bin/env python3
-# arash_bot_super.py
-# Requires: pip install pyTelegramBotAPI
-# UTF-8 encoded
-
-import telebot
-from telebot import types
-import json
-import os
-import random
-import traceback
-from datetime import datetime, timedelta
-
-# ================= CONFIG =================
-# بالای فایل، دقیقاً این را جایگزین کن:
-TOKEN_BOT = "7431334957:AAFHFjmQPnacsPYxjv08HAazcX49bF_tdsI"
-ADMIN_IDS = [6847589554]             # replace with your admin ids
-SUPPORT_ID = 7108658689              # support forward id
-CREATOR_ID = 6847589554              # visible on 'creator' button
-DATA_DIR = "bot_data"
-USERS_FILE = os.path.join(DATA_DIR, "users.json")
-ORDERS_FILE = os.path.join(DATA_DIR, "orders.json")
-RECEIPTS_FILE = os.path.join(DATA_DIR, "receipts.json")
-BROADCAST_LOG = os.path.join(DATA_DIR, "broadcast.json")
-
-PRICE_PER_STAR = 1500
-CODE_EXPIRY_MINUTES = 3
-
-# ensure support in admins
-if SUPPORT_ID not in ADMIN_IDS:
-    ADMIN_IDS.append(SUPPORT_ID)
-
-# create data dir
-os.makedirs(DATA_DIR, exist_ok=True)
-
-# ================= persistence helpers =================
-def load_json(path):
-    if os.path.exists(path):
-        try:
-            with open(path, "r", encoding="utf-8") as f:
-                return json.load(f)
-        except Exception:
-            return {}
-    return {}
-
-def save_json(path, data):
-    with open(path, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
-
-# load databases
-users_db = load_json(USERS_FILE) or {}
-orders_db = load_json(ORDERS_FILE) or []
-receipts_db = load_json(RECEIPTS_FILE) or []
-broadcast_db = load_json(BROADCAST_LOG) or []
-
-# ================ config data ================
-COUNTRIES = {
-    "🇺🇸 USA": 40000,
-    "🇨🇦 Canada": 40000,
-    "🇮🇷 Iran": 150000,
-    "🇸🇦 Saudi Arabia": 100000,
-}
-
-# multilingual messages
-MESSAGES = {
-    "fa": {
-        "welcome": "👋 سلام! خوش آمدی به ربات.",
-        "menu": "منوی اصلی:",
-        "choose_country": "🌍 کشور شماره مجازی را انتخاب کن:",
-        "price_for": "💵 قیمت برای {country}: {price:,} تومان",
-        "confirm_order": "آیا می‌خواهی سفارش را اضافه کنی به سبد؟",
-        "enter_qty": "🔢 تعداد را وارد کن (عدد صحیح):",
-        "cart_added": "🧾 آیتم به سبد اضافه شد.",
-        "cart_empty": "🛒 سبد شما خالی است.",
-        "view_cart": "🧾 سبد خرید شما:\n{summary}\n\n💰 مجموع: {total:,} تومان",
-        "checkout_confirm": "آیا می‌خواهی سفارش را نهایی کنی؟",
-        "enter_name": "✍️ لطفاً نام و نام خانوادگی را وارد کن:",
-        "send_contact": "📲 شماره خود را با دکمه زیر ارسال کن:",
-        "enter_code": "⏰ کد ارسال شد. لطفاً وارد کن:",
-        "invalid_code": "❌ کد اشتباه یا منقضی شده.",
-        "order_registered": "🎉 سفارش ثبت شد! کد: {order_id}",
-        "profile_created": "✅ پروفایل بروزرسانی شد.",
-        "wallet_balance": "💰 موجودی: {amount:,} تومان",
-        "send_receipt": "📸 لطفاً عکس فیش پرداخت را ارسال کن.",
-        "receipt_sent_admin": "📤 رسید ارسال شد؛ پس از تایید، کیف‌پول شارژ می‌شود.",
-        "receipt_approved": "✅ رسید تایید شد؛ کیف‌پول شما {amount:,} تومان شارژ شد.",
-        "receipt_rejected": "❌ رسید رد شد.",
-        "support_prompt": "🛠 لطفاً پیام پشتیبانی خود را ارسال کن:",
-        "support_sent": "پیام شما برای پشتیبانی ارسال شد."
-    },
-    "en": {
-        "welcome": "👋 Welcome to the bot!",
-        "menu": "Main menu:",
-        "choose_country": "🌍 Choose virtual-number country:",
-        "price_for": "💵 Price for {country}: {price:,} Toman",
-        "confirm_order": "Do you want to add this to your cart?",
-        "enter_qty": "🔢 Enter quantity (integer):",
-        "cart_added": "🧾 Item added to cart.",
-        "cart_empty": "🛒 Your cart is empty.",
-        "view_cart": "🧾 Your cart:\n{summary}\n\n💰 Total: {total:,} Toman",
-        "checkout_confirm": "Do you want to complete the checkout?",
-        "enter_name": "✍️ Please enter your full name:",
-        "send_contact": "📲 Please send your Telegram contact (button):",
-        "enter_code": "⏰ Code sent. Please enter it:",
-        "invalid_code": "❌ Code invalid or expired.",
-        "order_registered": "🎉 Order registered! ID: {order_id}",
-        "profile_created": "✅ Profile updated.",
-        "wallet_balance": "💰 Balance: {amount:,} Toman",
-        "send_receipt": "📸 Please send payment receipt photo.",
-        "receipt_sent_admin": "📤 Receipt sent for review.",
-        "receipt_approved": "✅ Receipt approved; wallet credited {amount:,} Toman.",
-        "receipt_rejected": "❌ Receipt rejected.",
-        "support_prompt": "🛠 Please send your support message:",
-        "support_sent": "Your support message was sent."
-    },
-    "ar": {
-        "welcome": "👋 مرحباً بك في البوت!",
-        "menu": "القائمة الرئيسية:",
-        "choose_country": "🌍 اختر دولة الرقم الافتراضي:",
-        "price_for": "💵 السعر لـ {country}: {price:,} تومان",
-        "confirm_order": "هل تريد إضافة هذا للسلة؟",
-        "enter_qty": "🔢 أدخل الكمية (عدد صحيح):",
-        "cart_added": "🧾 تم إضافة العنصر للسلة.",
-        "cart_empty": "🛒 سلتك فارغة.",
-        "view_cart": "🧾 سلتك:\n{summary}\n\n💰 المجموع: {total:,} تومان",
-        "checkout_confirm": "هل تريد إنهاء الطلب؟",
-        "enter_name": "✍️ الرجاء إدخال اسمك الكامل:",
-        "send_contact": "📲 الرجاء إرسال جهة اتصال تلغرام (زر):",
-        "enter_code": "⏰ تم إرسال الرمز. الرجاء إدخاله:",
-        "invalid_code": "❌ الرمز غير صالح أو منتهي.",
-        "order_registered": "🎉 تم تسجيل الطلب! رقم: {order_id}",
-        "profile_created": "✅ تم تحديث الملف الشخصي.",
-        "wallet_balance": "💰 الرصيد: {amount:,} تومان",
-        "send_receipt": "📸 الرجاء إرسال إيصال الدفع صورة.",
-        "receipt_sent_admin": "📤 تم إرسال الإيصال للمراجعة.",
-        "receipt_approved": "✅ تم الموافقة؛ تم شحن المحفظة بمقدار {amount:,} تومان.",
-        "receipt_rejected": "❌ تم رفض الإيصال.",
-        "support_prompt": "🛠 أرسل رسالة الدعم:",
-        "support_sent": "تم إرسال رسالتك للدعم."
-    }
-}
-
-# ================ Utilities ================
-def user_profile(chat_id):
-    key = str(chat_id)
-    if key not in users_db:
-        users_db[key] = {
-            "first_name": "",
-            "last_name": "",
-            "phone": "",
-            "lang": "fa",
-            "wallet": 0,
-            "points": 0,
-            "vip": False,
-            "created_at": datetime.utcnow().isoformat()
-        }
-        save_json(USERS_FILE, users_db)
-    return users_db[key]
-
-def set_profile(chat_id, profile):
-    users_db[str(chat_id)] = profile
-    save_json(USERS_FILE, users_db)
-
-def get_msg(chat_id, key, **kw):
-    prof = user_profile(chat_id)
-    lang = prof.get("lang", "fa")
-    template = MESSAGES.get(lang, MESSAGES["fa"]).get(key, "")
-    return template.format(**kw) if kw else template
-
-def gen_code():
-    return "{:06d}".format(random.randint(0, 999999))
-
-def gen_order_id(prefix="ARSH"):
-    now = datetime.utcnow().strftime("%y%m%d%H%M%S")
-    return f"{prefix}-{now}-{random.randint(1000,9999)}"
-
-def save_order(order):
-    orders_db.append(order)
-    save_json(ORDERS_FILE, orders_db)
-
-def save_receipt(r):
-    receipts_db.append(r)
-    save_json(RECEIPTS_FILE, receipts_db)
-
-def user_cart_summary(cart):
-    lines = []
-    total = 0
-    for idx, item in enumerate(cart, 1):
-        if item["kind"] == "number":
-            lines.append(f"{idx}. {item['country']} × {item['qty']} — {item['price']:,} each")
-            total += item['price'] * item['qty']
-        elif item["kind"] == "stars":
-            lines.append(f"{idx}. ⭐ {item['qty']} × {item['price']:,}")
-            total += item['price'] * item['qty']
-    return "\n".join(lines), total
-
-# ================ Bot init ================
-bot = telebot.TeleBot(TOKEN_BOT)
-user_states = {}  # chat_id -> state dict (flow, stage, temp data)
-
-# ================ Markups/UI ================
-def main_menu_markup(chat_id):
-    prof = user_profile(chat_id)
-    kb = types.ReplyKeyboardMarkup(resize_keyboard=True, row_width=2)
-    kb.add(types.KeyboardButton("📱 خرید شماره مجازی"), types.KeyboardButton("⭐ خرید استارز"))
-    kb.add(types.KeyboardButton("🧾 سبد خرید"), types.KeyboardButton("💳 کیف‌پول / شارژ"))
-    kb.add(types.KeyboardButton("👤 پروفایل"), types.KeyboardButton("ℹ️ درباره ما"))
-    kb.add(types.KeyboardButton("🛠 پشتیبانی"), types.KeyboardButton("🌐 تغییر زبان"))
-    kb.add(types.KeyboardButton("👨‍💻 سازنده"), types.KeyboardButton("📣 خبر/اعلان"))
-    return kb
-
-def country_choice_markup(chat_id):
-    kb = types.ReplyKeyboardMarkup(resize_keyboard=True, row_width=1)
-    for c, p in COUNTRIES.items():
-        kb.add(types.KeyboardButton(f"{c} — {p:,}"))
-    kb.add(types.KeyboardButton("🔙 بازگشت"))
-    return kb
-
-def qty_kb():
-    kb = types.ReplyKeyboardMarkup(resize_keyboard=True)
-    kb.add(types.KeyboardButton("1"), types.KeyboardButton("2"), types.KeyboardButton("3"))
-    kb.add(types.KeyboardButton("🔙 بازگشت"))
-    return kb
-
-def confirm_yesno_markup(chat_id):
-    prof = user_profile(chat_id)
-    lang = prof.get("lang", "fa")
-    kb = types.ReplyKeyboardMarkup(resize_keyboard=True)
-    # localized labels:
-    yes = {"fa":"✅ تایید سفارش","en":"✅ Confirm Order","ar":"✅ تأكيد"}[lang if lang in ["fa","en","ar"] else "fa"]
-    no = {"fa":"❌ لغو","en":"❌ Cancel","ar":"❌ إلغاء"}[lang if lang in ["fa","en","ar"] else "fa"]
-    kb.add(types.KeyboardButton(yes), types.KeyboardButton(no))
-    return kb
-
-def contact_request_kb(lang="fa"):
-    kb = types.ReplyKeyboardMarkup(one_time_keyboard=True, resize_keyboard=True)
-    labels = {"fa":"📲 ارسال شماره من","en":"📲 Send my contact","ar":"📲 إرسال رقمي"}
-    kb.add(types.KeyboardButton(labels.get(lang,"📲 ارسال شماره من"), request_contact=True))
-    kb.add(types.KeyboardButton({"fa":"❌ انصراف","en":"❌ Cancel","ar":"❌ إلغاء"}.get(lang)))
-    return kb
-
-# ================ Handlers ================
-@bot.message_handler(commands=["start","help"])
-def cmd_start(m):
-    chat_id = m.chat.id
-    prof = user_profile(chat_id)
-    bot.send_message(chat_id, get_msg(chat_id,"welcome"))
-    bot.send_message(chat_id, get_msg(chat_id,"menu"), reply_markup=main_menu_markup(chat_id))
-
-@bot.message_handler(func=lambda m: m.text == '👨‍💻 سازنده' or m.text.lower() in ['creator', 'developer'])
-def creator_handler(m):
-    chat_id = m.chat.id
-
-    # مسیر عکس سازنده (فایل logo.jpg باید کنار فایل اصلی بات باشه)
-    photo_path = "logo.jpg"  # اسم فایل رو هرچی خواستی بذار، مثلاً "creator.jpg"
-
-    caption = (
-        "✨ این ربات با عشق ساخته شده توسط [@Eryone0101](https://t.me/Eryone0101)\n\n"
-        "📞 برای سفارش بات مشابه یا شخصی‌سازی، به من پیام بده 🌟"
-    )
-
-    markup = types.InlineKeyboardMarkup()
-    markup.add(
-        types.InlineKeyboardButton("👨‍💻 مشاهده پروفایل سازنده", url="https://t.me/Eryone0101"),
-        types.InlineKeyboardButton("📩 تماس با سازنده", url="https://t.me/Eryone0101")
-    )
-
-    # اگر عکس وجود داشت، با عکس بفرست
-    if os.path.exists(photo_path):
-        with open(photo_path, "rb") as photo:
-            bot.send_photo(chat_id, photo, caption=caption, parse_mode="Markdown", reply_markup=markup)
-    else:
-        # اگر عکس نبود فقط پیام متنی ارسال کن
-        bot.send_message(chat_id, caption, parse_mode="Markdown", reply_markup=markup)
-
-
-
-@bot.message_handler(func=lambda m: m.text == "🌐 تغییر زبان")
-def choose_lang(m):
-    chat_id = m.chat.id
-    kb = types.ReplyKeyboardMarkup(resize_keyboard=True)
-    kb.add(types.KeyboardButton("🇮🇷 فارسی"), types.KeyboardButton("🇬🇧 English"), types.KeyboardButton("🇸🇦 العربية"))
-    kb.add(types.KeyboardButton("🔙 بازگشت"))
-    user_states[chat_id] = {"flow":"profile_edit","stage":"await_lang"}
-    bot.send_message(chat_id, "زبان را انتخاب کن:", reply_markup=kb)
-
-@bot.message_handler(func=lambda m: m.text == "ℹ️ درباره ما")
-def about(m):
-    chat_id = m.chat.id
-    bot.send_message(chat_id, "🤖 این بات نسخهٔ پیشرفته است. برای پشتیبانی «🛠 پشتیبانی» را انتخاب کن.", reply_markup=main_menu_markup(chat_id))
-
-@bot.message_handler(func=lambda m: m.text == "🛠 پشتیبانی")
-def support_start(m):
-    chat_id = m.chat.id
-    user_states[chat_id] = {"flow":"support","stage":"await_msg"}
-    bot.send_message(chat_id, get_msg(chat_id,"support_prompt"), reply_markup=types.ReplyKeyboardRemove())
-
-@bot.message_handler(func=lambda m: m.text == "📣 خبر/اعلان")
-def broadcast_info(m):
-    chat_id = m.chat.id
-    if chat_id not in ADMIN_IDS:
-        bot.send_message(chat_id, "فقط ادمین می‌تواند پیام بفرستد.", reply_markup=main_menu_markup(chat_id))
-        return
-    user_states[chat_id] = {"flow":"broadcast","stage":"await_broadcast"}
-    bot.send_message(chat_id, "متن پیامی که می‌خواهی برای همه ارسال کنی را ارسال کن:", reply_markup=types.ReplyKeyboardRemove())
-
-@bot.message_handler(func=lambda m: m.text == "📱 خرید شماره مجازی")
-def start_virtual(m):
-    chat_id = m.chat.id
-    user_states[chat_id] = {"flow":"shop","stage":"choose_type","cart": []}
-    kb = types.ReplyKeyboardMarkup(resize_keyboard=True, row_width=2)
-    kb.add(types.KeyboardButton("📱 شماره مجازی"), types.KeyboardButton("⭐ استارز"))
-    kb.add(types.KeyboardButton("🧾 مشاهده سبد"), types.KeyboardButton("🔙 بازگشت"))
-    bot.send_message(chat_id, "خرید: شماره یا استارز را انتخاب کن:", reply_markup=kb)
-
-# handle quick menu choices and stateful flows
-@bot.message_handler(func=lambda m: True, content_types=['text'])
-def router(m):
-    chat_id = m.chat.id
-    text = (m.text or "").strip()
-    state = user_states.get(chat_id)
-
-    # if admin in broadcast mode
-    if state and state.get("flow")=="broadcast" and state.get("stage")=="await_broadcast":
-        if chat_id in ADMIN_IDS:
-            msg = text
-            cnt = 0
-            failed = 0
-            for uid in list(users_db.keys()):
-                try:
-                    bot.send_message(int(uid), f"📣 Broadcast:\n\n{msg}")
-                    cnt += 1
-                except Exception:
-                    failed += 1
-            broadcast_db.append({"admin":chat_id,"text":msg,"time":datetime.utcnow().isoformat(),"sent":cnt,"failed":failed})
-            save_json(BROADCAST_LOG, broadcast_db)
-            bot.send_message(chat_id, f"ارسال شد: {cnt} موفق / {failed} ناموفق", reply_markup=main_menu_markup(chat_id))
-            user_states.pop(chat_id, None)
-        else:
-            bot.send_message(chat_id, "دسترسی ندارید.", reply_markup=main_menu_markup(chat_id))
-        return
-
-    # support flow
-    if state and state.get("flow")=="support" and state.get("stage")=="await_msg":
-        user_states.pop(chat_id, None)
-        text_msg = text
-        # forward to support and admins
-        try:
-            bot.send_message(SUPPORT_ID, f"[Support] From {chat_id}:\n{text_msg}")
-        except Exception:
-            pass
-        for aid in ADMIN_IDS:
-            if aid == SUPPORT_ID: continue
-            try:
-                bot.send_message(aid, f"[Support] From {chat_id}:\n{text_msg}")
-            except Exception:
-                pass
-        bot.send_message(chat_id, get_msg(chat_id,"support_sent"), reply_markup=main_menu_markup(chat_id))
-        return
-
-    # if no active state, handle menu buttons
-    if not state:
-        # main menu interactions
-        if text in ["💳 کیف‌پول / شارژ","کیف‌پول","💳 کیف‌پول"]:
-            user_states[chat_id] = {"flow":"wallet","stage":"menu"}
-            bot.send_message(chat_id, "💼 منوی کیف پول:", reply_markup=types.ReplyKeyboardMarkup(resize_keyboard=True).add(types.KeyboardButton("⬆️ شارژ کیف‌پول"), types.KeyboardButton("💰 مشاهده موجودی"), types.KeyboardButton("🔙 بازگشت")))
-            return
-        if text in ["👤 پروفایل","پروفایل"]:
-            prof = user_profile(chat_id)
-            txt = (
-                f"👤 پروفایل شما:\n"
-                f"نام: {prof.get('first_name','(ثبت نشده)')}\n"
-                f"نام خانوادگی: {prof.get('last_name','(ثبت نشده)')}\n"
-                f"شماره: {prof.get('phone','(ثبت نشده)')}\n"
-                f"زبان: {prof.get('lang')}\n"
-                f"موجودی: {prof.get('wallet',0):,} تومان\n"
-                f"امتیاز: {prof.get('points',0)}\n"
-                f"سطح: {'VIP' if prof.get('vip') else 'Regular'}\n"
-            )
-            kb = types.ReplyKeyboardMarkup(resize_keyboard=True)
-            kb.add(types.KeyboardButton("✏️ ویرایش پروفایل"), types.KeyboardButton("🌐 تغییر زبان"))
-            kb.add(types.KeyboardButton("🔙 بازگشت"))
-            bot.send_message(chat_id, txt, reply_markup=kb)
-            return
-        if text in ["⭐ خرید استارز","خرید استارز","استارز"]:
-            user_states[chat_id] = {"flow":"shop","stage":"choose_stars","cart": []}
-            bot.send_message(chat_id, "چند ستارز می‌خواهی؟ (حداقل {})".format(1), reply_markup=types.ReplyKeyboardRemove())
-            return
-        # fallback for main menu
-        bot.send_message(chat_id, "از منو انتخاب کن:", reply_markup=main_menu_markup(chat_id))
-        return
-
-    # --- wallet flow ---
-    if state and state.get("flow")=="wallet":
-        stage = state.get("stage")
-        if stage=="menu":
-            if text=="⬆️ شارژ کیف‌پول":
-                user_states[chat_id]["stage"]="choose_amount"
-                kb = types.ReplyKeyboardMarkup(resize_keyboard=True)
-                kb.add(types.KeyboardButton("50,000"), types.KeyboardButton("100,000"), types.KeyboardButton("150,000"))
-                kb.add(types.KeyboardButton("🔙 بازگشت"))
-                bot.send_message(chat_id, "مبلغ را انتخاب کن (تومان):", reply_markup=kb)
-                return
-            if text=="💰 مشاهده موجودی":
-                prof = user_profile(chat_id)
-                bot.send_message(chat_id, get_msg(chat_id,"wallet_balance", amount=prof.get("wallet",0)), reply_markup=main_menu_markup(chat_id))
-                user_states.pop(chat_id, None)
-                return
-        if stage=="choose_amount":
-            if text=="🔙 بازگشت":
-                user_states.pop(chat_id, None)
-                bot.send_message(chat_id, "بازگشت.", reply_markup=main_menu_markup(chat_id))
-                return
-            # parse number
-            try:
-                amt = int(text.replace(",","").strip())
-            except Exception:
-                bot.send_message(chat_id, "مقدار نامعتبر. یکی از گزینه‌ها را انتخاب کن.")
-                return
-            user_states[chat_id].update({"stage":"await_receipt","charge_amount":amt})
-            bot.send_message(chat_id, get_msg(chat_id,"send_receipt"), reply_markup=types.ReplyKeyboardRemove())
-            return
-
-    # --- shop flow (numbers & stars & cart) ---
-    if state and state.get("flow")=="shop":
-        stage = state.get("stage")
-        cart = state.get("cart", [])
-        # choosing between number or stars initially
-        if stage=="choose_type":
-            if text in ["📱 شماره مجازی","شماره مجازی","📱"]:
-                user_states[chat_id]["stage"]="choose_country"
-                bot.send_message(chat_id, get_msg(chat_id,"choose_country"), reply_markup=country_choice_markup(chat_id))
-                return
-            if text in ["⭐ استارز","استارز","⭐"]:
-                user_states[chat_id]["stage"]="choose_stars"
-                bot.send_message(chat_id, "چند استارز می‌خواهی؟ (مثال: 100)", reply_markup=types.ReplyKeyboardRemove())
-                return
-            if text in ["🧾 مشاهده سبد","سبد","🧾 سبد خرید"]:
-                if not cart:
-                    bot.send_message(chat_id, get_msg(chat_id, "cart_empty"), reply_markup=main_menu_markup(chat_id))
-                    user_states.pop(chat_id,None)
-                    return
-                summary, total = user_cart_summary(cart)
-                kb = types.ReplyKeyboardMarkup(resize_keyboard=True)
-                kb.add(types.KeyboardButton("✅ نهایی‌سازی و پرداخت"), types.KeyboardButton("❌ خالی‌سازی سبد"))
-                kb.add(types.KeyboardButton("🔙 بازگشت"))
-                bot.send_message(chat_id, get_msg(chat_id,"view_cart", summary=summary, total=total), reply_markup=kb)
-                user_states[chat_id]["stage"]="cart_review"
-                return
-            if text=="🔙 بازگشت":
-                user_states.pop(chat_id,None)
-                bot.send_message(chat_id, "بازگشت به منوی اصلی.", reply_markup=main_menu_markup(chat_id))
-                return
-
-        # choose_country stage: select a country to add number(s)
-        if stage=="choose_country":
-            if text=="🔙 بازگشت":
-                user_states[chat_id]["stage"]="choose_type"
-                bot.send_message(chat_id, "بازگشت.", reply_markup=main_menu_markup(chat_id))
-                return
-            # match a country
-            selected = None
-            for label in COUNTRIES.keys():
-                if text.startswith(label):
-                    selected = label
-                    break
-            if not selected:
-                bot.send_message(chat_id, "لطفاً از دکمه‌ها یک کشور انتخاب کن.", reply_markup=country_choice_markup(chat_id))
-                return
-            # ask quantity
-            user_states[chat_id].update({"stage":"choose_qty","pending_country":selected,"pending_price":COUNTRIES[selected]})
-            bot.send_message(chat_id, f"{selected} انتخاب شد. قیمت هر شماره: {COUNTRIES[selected]:,}\n{get_msg(chat_id,'enter_qty')}", reply_markup=qty_kb())
-            return
-
-        if stage=="choose_qty":
-            if text=="🔙 بازگشت":
-                user_states[chat_id]["stage"]="choose_country"
-                bot.send_message(chat_id, get_msg(chat_id,"choose_country"), reply_markup=country_choice_markup(chat_id))
-                return
-            try:
-                qty = int(text)
-                if qty <= 0:
-                    raise ValueError()
-            except Exception:
-                bot.send_message(chat_id, get_msg(chat_id,"invalid_code"))
-                return
-            country = state.get("pending_country")
-            price = state.get("pending_price")
-            # add to cart: allow multiple items of same country by appending
-            cart.append({"kind":"number","country":country,"price":price,"qty":qty})
-            user_states[chat_id]["cart"] = cart
-            bot.send_message(chat_id, get_msg(chat_id,"cart_added"), reply_markup=types.ReplyKeyboardMarkup(resize_keyboard=True).add(types.KeyboardButton("📱 ادامه خرید"), types.KeyboardButton("🧾 مشاهده سبد"), types.KeyboardButton("🔙 بازگشت")))
-            user_states[chat_id]["stage"]="choose_type"
-            return
-
-        # choose_stars: adding stars into cart
-        if stage=="choose_stars":
-            if text=="🔙 بازگشت":
-                user_states[chat_id]["stage"]="choose_type"
-                bot.send_message(chat_id, "بازگشت.", reply_markup=main_menu_markup(chat_id))
-                return
-            try:
-                qty = int(text.replace(",",""))
-                if qty <= 0:
-                    raise ValueError()
-            except Exception:
-                bot.send_message(chat_id, "عدد نامعتبر. یک عدد صحیح وارد کن.")
-                return
-            # price per star dynamic (could be based on promotions)
-            price_per = PRICE_PER_STAR
-            cart.append({"kind":"stars","qty":qty,"price":price_per})
-            user_states[chat_id]["cart"] = cart
-            bot.send_message(chat_id, get_msg(chat_id,"cart_added"), reply_markup=types.ReplyKeyboardMarkup(resize_keyboard=True).add(types.KeyboardButton("📱 ادامه خرید"), types.KeyboardButton("🧾 مشاهده سبد"), types.KeyboardButton("🔙 بازگشت")))
-            user_states[chat_id]["stage"]="choose_type"
-            return
-
-        # cart review stage
-        if stage=="cart_review":
-            if text in ["❌ خالی‌سازی سبد","❌ Empty cart"]:
-                user_states[chat_id]["cart"] = []
-                bot.send_message(chat_id, "سبد خالی شد.", reply_markup=main_menu_markup(chat_id))
-                user_states.pop(chat_id,None)
-                return
-            if text in ["✅ نهایی‌سازی و پرداخت","✅ Checkout"]:
-                cart = state.get("cart",[])
-                if not cart:
-                    bot.send_message(chat_id, get_msg(chat_id,"cart_empty"), reply_markup=main_menu_markup(chat_id))
-                    user_states.pop(chat_id,None)
-                    return
-                summary, total = user_cart_summary(cart)
-                # require name and contact and optionally use wallet
-                user_states[chat_id]["stage"]="checkout_confirm"
-                user_states[chat_id]["checkout_total"]=total
-                kb = types.ReplyKeyboardMarkup(resize_keyboard=True)
-                kb.add(types.KeyboardButton("💳 پرداخت با کیف‌پول"), types.KeyboardButton("📤 ارسال رسید و پرداخت دستی"))
-                kb.add(types.KeyboardButton("🔙 بازگشت"))
-                bot.send_message(chat_id, get_msg(chat_id,"view_cart", summary=summary, total=total), reply_markup=kb)
-                return
-            if text=="🔙 بازگشت":
-                user_states[chat_id]["stage"]="choose_type"
-                bot.send_message(chat_id, "بازگشت.", reply_markup=main_menu_markup(chat_id))
-                return
-
-        # checkout confirm step
-        if stage=="checkout_confirm":
-            if text=="🔙 بازگشت":
-                user_states[chat_id]["stage"]="choose_type"
-                bot.send_message(chat_id, "بازگشت.", reply_markup=main_menu_markup(chat_id))
-                return
-            if text=="💳 پرداخت با کیف‌پول":
-                total = state.get("checkout_total",0)
-                prof = user_profile(chat_id)
-                if prof.get("wallet",0) >= total:
-                    prof["wallet"] -= total
-                    # finalize order
-                    order_id = gen_order_id("ARSH-C")
-                    order = {
-                        "order_id": order_id,
-                        "type": "checkout",
-                        "cart": state.get("cart",[]),
-                        "total": total,
-                        "user_id": chat_id,
-                        "status": "paid",
-                        "time": datetime.utcnow().isoformat()
-                    }
-                    save_order(order)
-                    # reward points and VIP
-                    prof["points"] = prof.get("points",0) + int(total//10000)  # example: 1 point per 10k
-                    if prof["points"] >= 100 and not prof.get("vip"):
-                        prof["vip"]=True
-                    set_profile(chat_id, prof)
-                    bot.send_message(chat_id, f"پرداخت با کیف‌پول انجام شد. سفارش ثبت شد: {order_id}", reply_markup=main_menu_markup(chat_id))
-                    # notify admins
-                    for aid in ADMIN_IDS:
-                        try:
-                            markup = types.InlineKeyboardMarkup()
-                            markup.add(types.InlineKeyboardButton("📦 مشاهده سفارش", callback_data=f"view_order:{order_id}"))
-                            bot.send_message(aid, f"سفارش جدید پرداخت شده: {order_id}\nکاربر: {chat_id}\nمجموع: {total:,}", reply_markup=markup)
-                        except Exception:
-                            pass
-                    user_states.pop(chat_id,None)
-                    return
-                else:
-                    bot.send_message(chat_id, "موجودی کافی نیست. لطفاً کیف‌پول را شارژ کن.", reply_markup=main_menu_markup(chat_id))
-                    user_states.pop(chat_id,None)
-                    return
-            if text=="📤 ارسال رسید و پرداخت دستی":
-                # ask for receipt photo after sending contact
-                user_states[chat_id]["stage"]="await_contact_for_receipt"
-                bot.send_message(chat_id, get_msg(chat_id,"send_contact"), reply_markup=contact_request_kb(user_profile(chat_id).get("lang","fa")))
-                return
-
-    # profile edit flow
-    if state and state.get("flow")=="profile_edit":
-        stage = state.get("stage")
-        if stage=="await_lang":
-            if text=="🔙 بازگشت":
-                user_states.pop(chat_id,None)
-                bot.send_message(chat_id, "بازگشت.", reply_markup=main_menu_markup(chat_id))
-                return
-            lang_map = {"🇮🇷 فارسی":"fa","🇬🇧 English":"en","🇸🇦 العربية":"ar"}
-            if text not in lang_map:
-                bot.send_message(chat_id, "زبان نامعتبر.", reply_markup=main_menu_markup(chat_id))
-                user_states.pop(chat_id,None)
-                return
-            prof = user_profile(chat_id)
-            prof["lang"] = lang_map[text]
-            set_profile(chat_id, prof)
-            bot.send_message(chat_id, get_msg(chat_id,"profile_created"), reply_markup=main_menu_markup(chat_id))
-            user_states.pop(chat_id,None)
-            return
-
-    # fallback
-    bot.send_message(chat_id, "دستور نامشخص — از منو استفاده کن.", reply_markup=main_menu_markup(chat_id))
-
-# contact handler (used for verification and receipts)
-@bot.message_handler(content_types=['contact'])
-def contact_handler(m):
-    chat_id = m.chat.id
-    state = user_states.get(chat_id)
-    if not state:
-        bot.send_message(chat_id, "ابتدا از منو گزینه‌ای انتخاب کن.", reply_markup=main_menu_markup(chat_id))
-        return
-    contact = m.contact
-    phone = getattr(contact,"phone_number", None)
-    if not phone:
-        bot.send_message(chat_id, "شماره معتبر فرستاده نشده.", reply_markup=main_menu_markup(chat_id))
-        return
-    # profile edit finalization
-    if state.get("flow")=="profile_edit" and state.get("stage")=="await_contact":
-        prof = user_profile(chat_id)
-        prof["phone"] = phone
-        set_profile(chat_id, prof)
-        bot.send_message(chat_id, get_msg(chat_id,"profile_created"), reply_markup=main_menu_markup(chat_id))
-        user_states.pop(chat_id,None)
-        return
-    # if awaiting contact for receipt -> move to await_receipt stage and ask for photo
-    if state.get("stage")=="await_contact_for_receipt":
-        user_states[chat_id]["stage"]="await_receipt"
-        user_states[chat_id]["receipt_phone"]=phone
-        bot.send_message(chat_id, get_msg(chat_id,"send_receipt"), reply_markup=types.ReplyKeyboardRemove())
-        return
-    # if this is used for order verification -> create code and ask
-    user_states[chat_id]["phone"] = phone
-    code = gen_code()
-    user_states[chat_id]["code"] = code
-    user_states[chat_id]["expiry"] = datetime.utcnow() + timedelta(minutes=CODE_EXPIRY_MINUTES)
-    user_states[chat_id]["stage"]="await_code"
-    bot.send_message(chat_id, f"کد سفارش شما: {code}")
-    bot.send_message(chat_id, get_msg(chat_id,"enter_code"))
-
-# photo handler: receipts
-@bot.message_handler(content_types=['photo'])
-def photo_handler(m):
-    chat_id = m.chat.id
-    state = user_states.get(chat_id)
-    if not state:
-        bot.send_message(chat_id, "عکس دریافت شد اما منتظر عکس نبودیم.", reply_markup=main_menu_markup(chat_id))
-        return
-    if state.get("stage")=="await_receipt":
-        file_id = m.photo[-1].file_id
-        amount = state.get("charge_amount", 0)
-        receipt_id = f"R-{datetime.utcnow().strftime('%y%m%d%H%M%S')}-{random.randint(1000,9999)}"
-        rec = {"receipt_id": receipt_id, "user_id": chat_id, "file_id": file_id, "amount": amount, "time": datetime.utcnow().isoformat(), "status":"pending"}
-        save_receipt(rec)
-        # send to admins
-        markup = types.InlineKeyboardMarkup()
-        markup.add(types.InlineKeyboardButton("✅ تایید", callback_data=f"approve_receipt:{receipt_id}"))
-        markup.add(types.InlineKeyboardButton("❌ رد", callback_data=f"reject_receipt:{receipt_id}"))
-        for aid in ADMIN_IDS:
-            try:
-                bot.send_message(aid, f"🧾 رسید جدید از کاربر {chat_id}\nمقدار: {amount:,} تومان\nایدی: {receipt_id}")
-                bot.send_photo(aid, file_id, reply_markup=markup)
-            except Exception:
-                pass
-        bot.send_message(chat_id, get_msg(chat_id,"receipt_sent_admin"), reply_markup=main_menu_markup(chat_id))
-        user_states.pop(chat_id,None)
-        return
-    bot.send_message(chat_id, "در حال حاضر تماشاگر عکس نیستیم.", reply_markup=main_menu_markup(chat_id))
-
-# text handler for code verification (separate to avoid conflicts)
-@bot.message_handler(func=lambda m: True, content_types=['text'])
-def code_verification_router(m):
-    # This handler only checks code if user in await_code stage
-    chat_id = m.chat.id
-    state = user_states.get(chat_id)
-    if not state:
-        return
-    if state.get("stage")!="await_code":
-        return
-    text = (m.text or "").strip()
-    expiry = state.get("expiry")
-    if expiry and datetime.utcnow() > expiry:
-        new_code = gen_code()
-        state["code"] = new_code
-        state["expiry"] = datetime.utcnow() + timedelta(minutes=CODE_EXPIRY_MINUTES)
-        bot.send_message(chat_id, "کد قبلی منقضی شد. کد جدید ارسال شد.")
-        bot.send_message(chat_id, f"کد جدید: {new_code}")
-        return
-    if text != state.get("code"):
-        bot.send_message(chat_id, get_msg(chat_id,"invalid_code"))
-        return
-    # code valid -> finalize any pending order flow (if any)
-    # Example: if in checkout via contact/verification, create order record
-    if state.get("flow")=="shop":
-        # create single-order for demonstration (earlier flows usually store cart)
-        cart = state.get("cart",[])
-        if not cart:
-            bot.send_message(chat_id, "سبد خالی است.", reply_markup=main_menu_markup(chat_id))
-            user_states.pop(chat_id,None)
-            return
-        order_id = gen_order_id("ARSH-V")
-        order = {
-            "order_id": order_id,
-            "user_id": chat_id,
-            "cart": cart,
-            "total": state.get("checkout_total", sum(i.get("price",0)*i.get("qty",1) for i in cart)),
-            "status": "pending_admin",
-            "time": datetime.utcnow().isoformat()
-        }
-        save_order(order)
-        bot.send_message(chat_id, get_msg(chat_id,"order_registered", order_id=order_id), reply_markup=main_menu_markup(chat_id))
-        # notify admins
-        for aid in ADMIN_IDS:
-            try:
-                markup = types.InlineKeyboardMarkup()
-                markup.add(types.InlineKeyboardButton("📦 View Order", callback_data=f"view_order:{order_id}"))
-                markup.add(types.InlineKeyboardButton("✅ Approve & Assign", callback_data=f"approve_order:{order_id}"))
-                bot.send_message(aid, f"📦 New order {order_id}\nUser: {chat_id}\nTotal: {order['total']:,}", reply_markup=markup)
-            except Exception:
-                pass
-    user_states.pop(chat_id,None)
-
-# callback router for admin actions
-@bot.callback_query_handler(func=lambda call: True)
-def callback_router(call):
-    try:
-        data = call.data or ""
-        user_id = call.from_user.id
-        # receipts
-        if data.startswith("approve_receipt:") or data.startswith("reject_receipt:"):
-            if user_id not in ADMIN_IDS:
-                bot.answer_callback_query(call.id, "فقط ادمین می‌تواند این کار را انجام دهد.")
-                return
-            action, rid = data.split(":")
-            target = None
-            for r in receipts_db:
-                if r.get("receipt_id")==rid:
-                    target = r
-                    break
-            if not target:
-                bot.answer_callback_query(call.id, "رسید پیدا نشد.")
-                return
-            if action=="approve_receipt":
-                uid = target["user_id"]
-                prof = user_profile(uid)
-                prof["wallet"] = prof.get("wallet",0) + int(target.get("amount",0))
-                set_profile(uid, prof)
-                target["status"]="approved"
-                save_json(RECEIPTS_FILE, receipts_db)
-                bot.send_message(uid, get_msg(uid,"receipt_approved", amount=target.get("amount",0)))
-                bot.answer_callback_query(call.id, "رسید تایید شد.")
-                try:
-                    bot.edit_message_caption("✅ تایید شد", chat_id=call.message.chat.id, message_id=call.message.message_id)
-                except Exception:
-                    pass
-                return
-            else:
-                target["status"]="rejected"
-                save_json(RECEIPTS_FILE, receipts_db)
-                bot.send_message(target["user_id"], get_msg(target["user_id"], "receipt_rejected"))
-                bot.answer_callback_query(call.id, "رسید رد شد.")
-                try:
-                    bot.edit_message_caption("❌ رد شد", chat_id=call.message.chat.id, message_id=call.message.message_id)
-                except Exception:
-                    pass
-                return
-
-        # admin order actions
-        if data.startswith("view_order:"):
-            if user_id not in ADMIN_IDS:
-                bot.answer_callback_query(call.id, "فقط ادمین.")
-                return
-            _, oid = data.split(":",1)
-            target = next((o for o in orders_db if o.get("order_id")==oid), None)
-            if not target:
-                bot.answer_callback_query(call.id, "سفارش پیدا نشد.")
-                return
-            bot.send_message(user_id, f"Order {oid} details:\n{json.dumps(target, ensure_ascii=False, indent=2)}")
-            bot.answer_callback_query(call.id, "ارسال شد.")
-            return
-
-        if data.startswith("approve_order:"):
-            if user_id not in ADMIN_IDS:
-                bot.answer_callback_query(call.id, "فقط ادمین.")
-                return
-            _, oid = data.split(":",1)
-            target = next((o for o in orders_db if o.get("order_id")==oid), None)
-            if not target:
-                bot.answer_callback_query(call.id, "سفارش پیدا نشد.")
-                return
-            # set status to approved and optionally assign a value
-            target["status"]="approved"
-            save_json(ORDERS_FILE, orders_db)
-            bot.send_message(user_id, f"سفارش {oid} تایید شد. می‌توانید اختصاص دهید یا اطلاعات را به کاربر ارسال کنید.")
-            try:
-                bot.send_message(target["user_id"], f"سفارش شما {oid} تایید شد. پس از ارسال اطلاعات، پیام می‌آید.")
-            except Exception:
-                pass
-            bot.answer_callback_query(call.id, "تأیید شد.")
-            return
-
-    except Exception as e:
-        traceback.print_exc()
-        try:
-            bot.answer_callback_query(call.id, "خطا در پردازش.")
-        except Exception:
-            pass
-
-# run
-if __name__ == "__main__":
-    print("Super professional bot started...")
-    bot.infinity_polling()
-
-
+#!/usr/bin/env python3
+# arash_bot_super.py
+# Requires: pip install pyTelegramBotAPI
+# Optional: pip install aiohttp   (asyncio mode: python bot.py async)
+# UTF-8 encoded
+
+import telebot
+from telebot import types
+from telebot.apihelper import ApiTelegramException
+import bisect
+import copy
+import functools
+import gzip
+import hashlib
+import hmac
+import json
+import marshal
+import mmap
+import multiprocessing
+import os
+import secrets
+import string
+import struct
+import queue
+import random
+import re
+import sqlite3
+import sys
+import threading
+import time
+import traceback
+import tracemalloc
+import zlib
+import heapq
+import itertools
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# ================= CONFIG =================
+# بالای فایل، دقیقاً این را جایگزین کن:
+TOKEN_BOT = os.environ.get("BOT_TOKEN", "7431334957:AAFHFjmQPnacsPYxjv08HAazcX49bF_tdsI")
+ADMIN_IDS = [6847589554]             # replace with your admin ids
+SUPPORT_ID = 7108658689              # support forward id
+CREATOR_ID = 6847589554              # visible on 'creator' button
+DATA_DIR = os.environ.get("BOT_DATA_DIR", "bot_data")
+USERS_FILE = os.path.join(DATA_DIR, "users.json")
+ORDERS_FILE = os.path.join(DATA_DIR, "orders.json")
+RECEIPTS_FILE = os.path.join(DATA_DIR, "receipts.json")
+BROADCAST_LOG = os.path.join(DATA_DIR, "broadcast.json")
+USERS_JOURNAL = os.path.join(DATA_DIR, "users.journal.jsonl")
+SQLITE_FILE = os.path.join(DATA_DIR, "bot.sqlite3")
+USERS_SHARD_DIR = os.path.join(DATA_DIR, "users")
+USERS_SHARD_MANIFEST = os.path.join(DATA_DIR, "users_shards.json")
+HISTORY_JOURNAL = os.path.join(DATA_DIR, "history.journal.jsonl")
+HISTORY_FOLDING = HISTORY_JOURNAL + ".folding"   # the journal being folded in
+SNAPSHOT_FILE = os.path.join(DATA_DIR, "snapshot.bin")
+ARCHIVE_DIR = os.path.join(DATA_DIR, "archive")
+ANALYTICS_FILE = os.path.join(DATA_DIR, "analytics.json")
+MEDIA_CACHE_FILE = os.path.join(DATA_DIR, "media_cache.json")   # local media -> Telegram file_id
+DIGEST_JOURNAL = os.path.join(DATA_DIR, "admin_digest.jsonl")   # json backend: admin digest items not sent yet
+
+STORAGE_BACKEND = os.environ.get("BOT_STORAGE", "json")   # "json" (bot_data/*.json) or "sqlite" (SQLITE_FILE)
+API_URL = os.environ.get("BOT_API_URL", "")   # e.g. a local Bot API server: "http://host:8081/bot{0}/{1}"
+
+# cluster mode (python bot.py cluster N [webhook]): one ingress process gets
+# the updates and hands each chat to one of N worker processes (admins to
+# worker 0); the workers share SQLITE_FILE. Set by the ingress for its
+# workers, "index/size":
+CLUSTER_WORKER = os.environ.get("BOT_CLUSTER_WORKER", "")
+CLUSTER_INDEX, CLUSTER_SIZE = map(int, CLUSTER_WORKER.split("/")) if CLUSTER_WORKER else (0, 1)
+CLUSTER_INGRESS = __name__ == "__main__" and sys.argv[1:2] == ["cluster"]   # only routes updates
+
+# "journal": user changes are appended to the users journal of their shard and
+# periodically folded into its snapshot, order/receipt/broadcast changes go to
+# HISTORY_JOURNAL, and a clean shutdown writes SNAPSHOT_FILE for a fast start;
+# "json": the changed file is rewritten on every change (old behaviour)
+PERSIST_MODE = "journal"
+JOURNAL_COMPACT_EVERY = 5000         # compact after this many journal appends
+JOURNAL_COMPACT_INTERVAL = 600       # seconds between periodic compactions
+FLUSH_INTERVAL = 2.0                 # seconds; each dirty JSON file is written at most this often
+# json backend: users are split over this many snapshot+journal pairs in
+# USERS_SHARD_DIR (by crc32 of the user id) when a data dir is created;
+# existing data keeps its layout until: python bot.py reshard N  (bot stopped)
+USER_SHARDS = 8
+SNAPSHOT_USER_CHUNK = 20000          # users per record in SNAPSHOT_FILE
+
+# settled orders/receipts older than ARCHIVE_AFTER_DAYS leave memory for gzip
+# segments in ARCHIVE_DIR (one set per month); lookups by id still find them
+ARCHIVE_AFTER_DAYS = 30              # 0 = no automatic archiving (python bot.py archive [days] still works)
+ARCHIVE_STATUSES = ("paid", "approved", "rejected")
+ARCHIVE_INTERVAL = 3600              # seconds between archive passes
+ARCHIVE_BLOCK = 256                  # records per gzip member; a lookup inflates one member
+ARCHIVE_INDEX_CACHE = 16             # segment id indexes kept in memory
+
+BROADCAST_JOBS_FILE = os.path.join(DATA_DIR, "broadcast_jobs.json")
+BROADCAST_RATE = 25                  # broadcast messages per second, all jobs together
+BROADCAST_WORKERS = 8                # concurrent senders per job
+BROADCAST_BATCH = 200                # recipients per persisted cursor step
+BROADCAST_PROGRESS_EVERY = 5         # seconds between admin progress edits
+
+OUTBOX_SENDERS = 4                   # threads delivering queued messages
+OUTBOX_GLOBAL_RATE = 30              # msgs/s for the whole bot (Telegram limit)
+OUTBOX_CHAT_RATE = 1                 # msgs/s per chat
+OUTBOX_CHAT_BURST = 3                # short bursts allowed per chat (e.g. /start sends two)
+OUTBOX_MAX_RETRIES = 3
+
+ADMIN_DIGEST_WINDOW = 5.0            # seconds new orders/receipts are collected per admin digest (0 = send at once)
+ADMIN_DIGEST_MAX_ITEMS = 20          # items per digest message (inline keyboard and text stay small)
+
+STATES_FILE = os.path.join(DATA_DIR, "states.json")
+STATE_MAX_SESSIONS = 50000           # open conversations kept; least recently used dropped first
+STATE_TTL = 6 * 3600                 # seconds a conversation may sit idle before it is dropped
+STATE_SWEEP_INTERVAL = 60            # seconds between expiry sweeps (and state spills)
+STATE_PERSIST = True                 # spill open conversations to STATES_FILE, restore on start
+
+DISPATCH_WORKERS = 8                 # sync mode: parallel update workers (one chat -> one worker)
+DISPATCH_QUEUE_SIZE = 1000           # pending updates per worker before intake is pushed back
+
+UPDATES_FILE = os.path.join(DATA_DIR, "updates.json")   # json backend: handled-update checkpoint
+UPDATE_CHECKPOINT_INTERVAL = 1.0     # seconds between saves of the handled-update offset
+UPDATE_DEDUP_SIZE = 10000            # recent update_ids remembered, so redeliveries are dropped
+CATCH_UP_BATCH = 100                 # getUpdates page size while draining a backlog (Telegram's max)
+POLL_STALL_WAIT = 1.0                # seconds a page of only in-flight updates waits before polling again
+
+# webhook mode (python bot.py webhook); TLS is expected to be terminated by a
+# reverse proxy in front of WEBHOOK_LISTEN:WEBHOOK_PORT
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL", "")   # public https URL registered with Telegram
+WEBHOOK_LISTEN = "127.0.0.1"
+WEBHOOK_PORT = 8080
+WEBHOOK_PATH = "/telegram"
+WEBHOOK_SECRET = ""                  # X-Telegram-Bot-Api-Secret-Token; random if empty
+WEBHOOK_MAX_CONNECTIONS = 40
+WEBHOOK_ENQUEUE_TIMEOUT = 2.0        # seconds to wait for queue room before answering 503
+WEBHOOK_APPLY_TIMEOUT = 10.0         # seconds to wait for the update to be handled before answering 503
+WEBHOOK_MAX_BODY = 1 << 20           # bytes; larger POSTs get 413 without being read
+ASYNC_HANDLER_THREADS = 16           # asyncio mode: fixed pool running the handler bodies
+ASYNC_CHAT_LOCKS = 256               # asyncio mode: chat_id shards that keep per-chat order
+
+METRICS_LISTEN = "127.0.0.1"         # Prometheus text on http://METRICS_LISTEN:METRICS_PORT/metrics
+METRICS_PORT = 9464                  # 0 = no endpoint (/stats still works)
+
+PROFILE_SAMPLE_INTERVAL = 0.01      # seconds between stack samples during /profile
+PROFILE_MAX_SECONDS = 300
+PROFILE_TOP = 40                     # functions listed per table in the report
+
+REPORT_DAYS = 7                      # /report default window
+REVENUE_STATUSES = ("paid", "approved")   # orders counted as sales
+REBUILD_BATCH = 1000                 # records counted per db_lock hold during an analytics rebuild
+
+PRICE_PER_STAR = 1500
+CODE_EXPIRY_MINUTES = 3
+
+# ensure support in admins
+if SUPPORT_ID not in ADMIN_IDS:
+    ADMIN_IDS.append(SUPPORT_ID)
+
+# create data dir
+os.makedirs(DATA_DIR, exist_ok=True)
+
+# ================= metrics =================
+METRIC_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+class Metrics:
+    """Counters, latency histograms and gauges in plain dicts keyed by
+    (name, labels). One short lock per update; rendered as Prometheus text
+    on METRICS_PORT and summarised by the admin /stats command."""
+
+    def __init__(self, buckets=METRIC_BUCKETS):
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.counters = {}      # (name, labels) -> value
+        self.histograms = {}    # (name, labels) -> [count per bucket..., +Inf count, sum]
+        self.gauges = {}        # name -> callable returning the current value
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        i = bisect.bisect_left(self.buckets, seconds)
+        with self.lock:
+            h = self.histograms.get(key)
+            if h is None:
+                h = self.histograms[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            h[i] += 1
+            h[-1] += seconds
+
+    def gauge(self, name, fn):
+        self.gauges[name] = fn
+
+    @contextmanager
+    def timer(self, name, **labels):
+        # records <name>_seconds, and <name>_errors_total when the body raises
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self.inc(f"{name}_errors_total", **labels)
+            raise
+        finally:
+            self.observe(f"{name}_seconds", time.perf_counter() - start, **labels)
+
+    def timed(self, name, **labels):
+        def deco(fn):
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                with self.timer(name, **labels):
+                    return fn(*args, **kwargs)
+            return wrapper
+        return deco
+
+    def quantile(self, h, q):
+        # upper bound of the bucket holding the q-th observation
+        total = sum(h[:-1])
+        if not total:
+            return 0.0
+        seen = 0
+        for bound, n in zip(self.buckets, h):
+            seen += n
+            if seen >= q * total:
+                return bound
+        return float("inf")
+
+    def summary(self, name):
+        # [(labels dict, count, sum, p50, p95)] for one histogram, busiest first
+        with self.lock:
+            items = [(dict(labels), list(h)) for (n, labels), h in self.histograms.items() if n == name]
+        rows = [(labels, sum(h[:-1]), h[-1], self.quantile(h, 0.5), self.quantile(h, 0.95)) for labels, h in items]
+        return sorted(rows, key=lambda r: -r[1])
+
+    def counter_total(self, name, **match):
+        with self.lock:
+            return sum(v for (n, labels), v in self.counters.items()
+                       if n == name and all(dict(labels).get(k) == val for k, val in match.items()))
+
+    def render(self):
+        def fmt(labels, extra=()):
+            pairs = list(labels) + list(extra)
+            if not pairs:
+                return ""
+            return "{" + ",".join(f'{k}="{str(v).replace(chr(34), chr(39))}"' for k, v in pairs) + "}"
+
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((k, list(h)) for k, h in self.histograms.items())
+        out, typed = [], set()
+        for (name, labels), value in counters:
+            if name not in typed:
+                typed.add(name)
+                out.append(f"# TYPE {name} counter")
+            out.append(f"{name}{fmt(labels)} {value}")
+        for (name, labels), h in histograms:
+            if name not in typed:
+                typed.add(name)
+                out.append(f"# TYPE {name} histogram")
+            cumulative = 0
+            for bound, n in zip(self.buckets, h):
+                cumulative += n
+                out.append(f"{name}_bucket{fmt(labels, [('le', bound)])} {cumulative}")
+            cumulative += h[-2]
+            out.append(f"{name}_bucket{fmt(labels, [('le', '+Inf')])} {cumulative}")
+            out.append(f"{name}_count{fmt(labels)} {cumulative}")
+            out.append(f"{name}_sum{fmt(labels)} {h[-1]:.6f}")
+        for name, fn in sorted(self.gauges.items()):
+            try:
+                value = fn()
+            except Exception:
+                continue
+            out.append(f"# TYPE {name} gauge")
+            out.append(f"{name} {value}")
+        return "\n".join(out) + "\n"
+
+metrics = Metrics()
+
+# ================= persistence helpers =================
+def load_json(path):
+    if os.path.exists(path):
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except Exception:
+            return {}
+    return {}
+
+def json_default(obj):
+    # records kept as objects in memory (UserRecord) are stored as plain dicts
+    if hasattr(obj, "to_dict"):
+        return obj.to_dict()
+    raise TypeError(f"{type(obj).__name__} is not JSON serializable")
+
+def save_json(path, data):
+    # write to a temp file and rename, so a crash never leaves a half-written file
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"   # unique across cluster processes too
+    with metrics.timer("bot_save", file=os.path.basename(path)):
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, indent=2, default=json_default)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+
+def save_json_records(path, records):
+    # save_json() for a list given as an iterable: written as it comes, one
+    # record per line, never built in memory
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with metrics.timer("bot_save", file=os.path.basename(path)):
+        with open(tmp, "w", encoding="utf-8") as f:
+            sep = "[\n"
+            for rec in records:
+                f.write(sep)
+                f.write(json.dumps(rec, ensure_ascii=False, default=json_default))
+                sep = ",\n"
+            f.write("[]" if sep == "[\n" else "\n]")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+
+class JsonFlusher:
+    """Coalesces save_json calls: handlers mark a file dirty and return, a
+    background thread writes each dirty file at most once per interval."""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.lock = threading.Lock()        # guards self.dirty
+        self.write_lock = threading.Lock()  # one writer at a time, keeps renames ordered
+        self.dirty = {}                     # path -> live dict/list to serialize
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def mark_dirty(self, path, data):
+        # re-marked files move to the end: flush() writes in marking order
+        with self.lock:
+            self.dirty.pop(path, None)
+            self.dirty[path] = data
+
+    def flush(self):
+        with self.write_lock:
+            with self.lock:
+                pending, self.dirty = self.dirty, {}
+            for path, data in pending.items():
+                # shallow copy: handlers may add entries while we serialize
+                snapshot = dict(data) if isinstance(data, dict) else list(data)
+                try:
+                    save_json(path, snapshot)
+                except Exception:
+                    traceback.print_exc()
+                    self.mark_dirty(path, data)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.flush()
+
+    def stop(self):
+        self.stopped.set()
+        self.flush()
+
+# ================= user records =================
+class UserRecord:
+    """One users_db entry. __slots__ instead of a per-user dict, the language
+    code interned (a handful of distinct values shared by every user) and
+    created_at kept as integer epoch seconds.
+
+    Reads and writes like the old profile dict -- prof["wallet"],
+    prof.get("phone", "-"), "lang" in prof -- and a field that was never
+    set is simply missing, as a missing key was. Keys outside FIELDS go to
+    a small side dict. to_dict() gives back the stored JSON shape.
+    """
+
+    FIELDS = ("first_name", "last_name", "phone", "lang", "wallet", "points", "vip", "created_at")
+    __slots__ = FIELDS + ("extra",)
+
+    def __init__(self, **fields):
+        for key, value in fields.items():
+            self[key] = value
+
+    @classmethod
+    def from_dict(cls, data):
+        if isinstance(data, cls):
+            return data
+        return cls(**data)
+
+    def __setitem__(self, key, value):
+        if key == "lang" and isinstance(value, str):
+            value = sys.intern(value)
+        elif key == "created_at" and isinstance(value, str):
+            try:
+                when = datetime.fromisoformat(value)
+                value = int((when if when.tzinfo else when.replace(tzinfo=timezone.utc)).timestamp())
+            except ValueError:
+                pass
+        if key in UserRecord.FIELDS:
+            setattr(self, key, value)
+            return
+        try:
+            self.extra[key] = value
+        except AttributeError:
+            self.extra = {key: value}
+
+    def __getitem__(self, key):
+        try:
+            if key in UserRecord.FIELDS:
+                value = getattr(self, key)
+                if key == "created_at" and isinstance(value, int):
+                    # naive UTC ISO string, as the dict layout stored it
+                    return datetime.utcfromtimestamp(value).isoformat()
+                return value
+            return self.extra[key]
+        except (AttributeError, KeyError):
+            raise KeyError(key) from None
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        return self.get(key, self) is not self
+
+    def keys(self):
+        return [k for k in UserRecord.FIELDS if hasattr(self, k)] + list(getattr(self, "extra", ()))
+
+    def to_dict(self):
+        return {k: self[k] for k in self.keys()}
+
+    def to_row(self):
+        # positional form for the binary snapshot; ... marks an unset field
+        return tuple(getattr(self, k, ...) for k in UserRecord.__slots__)
+
+    @classmethod
+    def from_row(cls, row):
+        # lang needs no sys.intern here: marshal keeps interned strings interned
+        rec = cls.__new__(cls)
+        for setter, value in zip(_ROW_SETTERS, row):
+            if value is not ...:
+                setter(rec, value)
+        return rec
+
+    def __repr__(self):
+        return f"UserRecord({self.to_dict()!r})"
+
+_ROW_SETTERS = tuple(UserRecord.__dict__[k].__set__ for k in UserRecord.__slots__)
+
+# ================= storage backends =================
+# Both backends keep the same in-memory shape (users dict, orders/receipts/
+# broadcast history) that the handlers read; they only differ in how a single
+# change reaches the disk.
+
+def user_shard_of(key, n):
+    # stable across processes and restarts (unlike hash())
+    return zlib.crc32(str(key).encode("utf-8")) % n if n > 1 else 0
+
+def user_shard_paths(n):
+    # one shard is the classic USERS_FILE + USERS_JOURNAL pair
+    if n == 1:
+        return [(USERS_FILE, USERS_JOURNAL)]
+    return [(os.path.join(USERS_SHARD_DIR, f"users-{i:03d}-of-{n:03d}.json"),
+             os.path.join(USERS_SHARD_DIR, f"users-{i:03d}-of-{n:03d}.journal.jsonl")) for i in range(n)]
+
+def current_user_shards():
+    manifest = load_json(USERS_SHARD_MANIFEST)
+    if isinstance(manifest, dict) and manifest.get("shards"):
+        return int(manifest["shards"])
+    if os.path.exists(USERS_FILE) or os.path.exists(USERS_JOURNAL):
+        return 1
+    return USER_SHARDS
+
+class UserShard:
+    """The users hashing to one shard: a snapshot file plus an append-only
+    journal of the changes made since. Each shard has its own lock, so
+    profile updates in different shards never wait for each other.
+
+    compact() holds that lock only to copy the dict and set the journal
+    aside as `<journal>.compacting`; the snapshot is rewritten outside it,
+    and load() replays a set-aside journal a crash left behind."""
+
+    def __init__(self, path, journal):
+        self.path = path
+        self.journal = journal
+        self.pending = journal + ".compacting"
+        self.lock = threading.Lock()
+        self.compact_lock = threading.Lock()    # one compaction of this shard at a time
+        self.users = {}
+        self.appends = 0
+        self.unsynced = False
+
+    @staticmethod
+    def replay(path, users):
+        replayed = 0
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        rec = json.loads(line)
+                    except ValueError:
+                        # torn tail from a crash mid-append; everything before it is good
+                        break
+                    users[rec["k"]] = UserRecord.from_dict(rec["v"])
+                    replayed += 1
+        return replayed
+
+    def load(self):
+        users = {k: UserRecord.from_dict(v) for k, v in (load_json(self.path) or {}).items()}
+        # a journal set aside by an unfinished compact() is older than the current one
+        replayed = self.replay(self.pending, users) + self.replay(self.journal, users)
+        self.users = users
+        if replayed or os.path.exists(self.pending):
+            # fold the replayed journal into a fresh snapshot (also drops any torn tail)
+            self.compact()
+        return users
+
+    def compact(self):
+        with self.compact_lock:
+            with self.lock:
+                users = dict(self.users)
+                if os.path.exists(self.journal):
+                    if self.unsynced:
+                        with open(self.journal, "a", encoding="utf-8") as f:
+                            os.fsync(f.fileno())
+                    # appends from here on start a new journal
+                    os.replace(self.journal, self.pending)
+                self.appends = 0
+                self.unsynced = False
+            save_json(self.path, users)
+            if os.path.exists(self.pending):
+                os.remove(self.pending)
+
+    def append(self, key, prof):
+        line = json.dumps({"k": key, "v": prof}, ensure_ascii=False, default=json_default)
+        with self.lock:
+            self.users[key] = prof
+            with open(self.journal, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+            self.appends += 1
+            self.unsynced = True
+            return self.appends
+
+    def sync(self):
+        with self.lock:
+            if self.unsynced and os.path.exists(self.journal):
+                with open(self.journal, "a", encoding="utf-8") as f:
+                    os.fsync(f.fileno())
+            self.unsynced = False
+
+HISTORY_IDS = {"orders": "order_id", "receipts": "receipt_id", "broadcasts": None}
+HISTORY_FILES = {"orders": ORDERS_FILE, "receipts": RECEIPTS_FILE, "broadcasts": BROADCAST_LOG}
+
+class LazyHistory:
+    """orders_db / receipts_db / broadcast_db.
+
+    Records added this run live in memory; what was stored before stays on
+    disk (binary snapshot or SQLite) until it is needed. get(id) fetches a
+    single record, iterating loads everything once. len() never loads.
+    by_id holds every record in memory that has an id -- the same dict
+    objects as in the list, so in-place status changes need no re-indexing.
+    iter_settled() and remove() (archiving) do not load either when the
+    backend can stream matching records (fetch_where), nor does iter_all()
+    when it can stream all of them (fetch_iter).
+    """
+
+    def __init__(self, id_key, items=None, stored=0, fetch_one=None, fetch_all=None, fetch_where=None,
+                 fetch_iter=None):
+        self.id_key = id_key
+        self.lock = threading.RLock()
+        self.items = items          # the full list, once loaded
+        self.recent = []            # appended before the full load
+        self.stored = stored        # records still only on disk
+        self.fetch_one = fetch_one
+        self.fetch_all = fetch_all
+        self.fetch_where = fetch_where
+        self.fetch_iter = fetch_iter
+        self.removed = set()        # ids dropped while still only on disk
+        self.by_id = {}
+        if items is not None and id_key:
+            self.by_id.update((r.get(id_key), r) for r in items)
+
+    @property
+    def loaded(self):
+        return self.items is not None
+
+    def load(self):
+        with self.lock:
+            if self.items is not None:
+                return self.items
+            # a backend that writes through (SQLite) returns this run's records
+            # too; keep them once, and the copy handlers already hold
+            items = self.fetch_all()
+            if not self.id_key:
+                items = items[:self.stored]
+            elif self.removed:
+                items = [r for r in items if r.get(self.id_key) not in self.removed]
+            seen = set()
+            for i, rec in enumerate(items if self.id_key else ()):
+                rid = rec.get(self.id_key)
+                seen.add(rid)
+                if rid in self.by_id:
+                    items[i] = self.by_id[rid]
+                else:
+                    self.by_id[rid] = rec
+            self.items = items + [r for r in self.recent if not self.id_key or r.get(self.id_key) not in seen]
+            self.recent = []
+            self.stored = 0
+            return self.items
+
+    def in_memory(self):
+        return self.items if self.items is not None else self.recent
+
+    def append(self, rec):
+        with self.lock:
+            (self.items if self.items is not None else self.recent).append(rec)
+            if self.id_key:
+                self.by_id[rec.get(self.id_key)] = rec
+                self.removed.discard(rec.get(self.id_key))
+
+    def remove(self, ids):
+        with self.lock:
+            ids = set(ids)
+            if self.items is not None:
+                self.items = [r for r in self.items if r.get(self.id_key) not in ids]
+            else:
+                kept = [r for r in self.recent if r.get(self.id_key) not in ids]
+                # the others were stored before this run; load() leaves them out
+                self.stored -= len(ids) - (len(self.recent) - len(kept))
+                self.recent = kept
+                self.removed |= ids
+            for rid in ids:
+                self.by_id.pop(rid, None)
+
+    @staticmethod
+    def settled(rec, statuses, before):
+        return rec.get("status") in statuses and (record_time(rec) or before) < before
+
+    def iter_settled(self, statuses, before):
+        # records in one of `statuses` dated before `before` (a datetime);
+        # streams from the backend unless everything is in memory anyway
+        if self.items is not None or self.fetch_where is None:
+            yield from [r for r in self.load() if self.settled(r, statuses, before)]
+            return
+        seen = set()
+        for rec in self.fetch_where(statuses, before):
+            rid = rec.get(self.id_key)
+            if rid in self.removed:
+                continue
+            seen.add(rid)
+            rec = self.by_id.get(rid, rec)      # this run's copy is the current one
+            if self.settled(rec, statuses, before):
+                yield rec
+        with self.lock:
+            rest = [r for rid, r in self.by_id.items() if rid not in seen]
+        yield from (r for r in rest if self.settled(r, statuses, before))
+
+    def iter_all(self):
+        # what iterating yields, in the same order, streamed from the backend
+        # unless everything is in memory anyway
+        if self.items is not None or self.fetch_iter is None:
+            yield from list(self.load())
+            return
+        if not self.id_key:
+            with self.lock:
+                stored, rest = self.stored, list(self.recent)
+            yield from itertools.islice(self.fetch_iter(), stored)
+            yield from rest
+            return
+        seen = set()
+        for rec in self.fetch_iter():
+            rid = rec.get(self.id_key)
+            if rid in self.removed or rid in seen:
+                continue
+            seen.add(rid)
+            yield self.by_id.get(rid, rec)
+        with self.lock:
+            rest = [r for rid, r in self.by_id.items() if rid not in seen]
+        yield from rest
+
+    def refresh(self, rid):
+        # re-read one record from the backend (a cluster worker may have
+        # changed it); an object handlers already hold is updated in place
+        fresh = self.fetch_one(rid) if self.fetch_one else None
+        with self.lock:
+            rec = self.by_id.get(rid)
+            if fresh is None:
+                return rec
+            if rec is None:
+                self.by_id[rid] = rec = fresh
+            else:
+                rec.clear()
+                rec.update(fresh)
+            return rec
+
+    def get(self, rid):
+        rec = self.by_id.get(rid)
+        if rec is not None or self.items is not None or rid in self.removed:
+            return rec
+        if self.fetch_one is None:
+            self.load()
+            return self.by_id.get(rid)
+        with self.lock:
+            rec = self.by_id.get(rid)
+            if rec is None and self.fetch_one is not None:
+                rec = self.fetch_one(rid)
+                if rec is not None:
+                    self.by_id[rid] = rec
+            return rec
+
+    def __len__(self):
+        return len(self.items) if self.items is not None else self.stored + len(self.recent)
+
+    def __iter__(self):
+        return iter(self.load())
+
+    def __getitem__(self, i):
+        return self.load()[i]
+
+SNAPSHOT_MAGIC = b"NBSNAP01"
+
+class BinarySnapshot:
+    """Fast-start copy of the json backend's data, written on clean shutdown.
+
+    Layout: MAGIC, length-prefixed records (u32 big-endian length + marshal
+    payload), a JSON footer, the footer's u64 offset and MAGIC again. Users
+    are stored as chunks of UserRecord rows; every order/receipt/broadcast
+    is its own record, with one id -> offset index record per kind, so a
+    single old order is read through the mmap without touching the rest.
+    The footer keeps the stat() of every source file at write time; if any
+    changed since (a crash, a manual edit, a reshard), the snapshot is
+    ignored and the JSON files are read as before.
+    """
+
+    def __init__(self, mm, footer):
+        self.mm = mm
+        self.footer = footer
+        self.indexes = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def sources(paths):
+        out = {}
+        for path in paths:
+            try:
+                st = os.stat(path)
+                out[path] = [st.st_mtime_ns, st.st_size]
+            except OSError:
+                out[path] = None
+        return out
+
+    @staticmethod
+    def format_tag():
+        return {"marshal": marshal.version, "python": list(sys.version_info[:2]), "user_fields": list(UserRecord.__slots__)}
+
+    @classmethod
+    def open(cls, path, sources, shards):
+        try:
+            with open(path, "rb") as f:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return None
+        try:
+            if mm[:8] != SNAPSHOT_MAGIC or mm[-8:] != SNAPSHOT_MAGIC:
+                raise ValueError("bad magic")
+            (foot,) = struct.unpack(">Q", mm[-16:-8])
+            footer = json.loads(mm[foot:-16])
+            if (footer.get("format") != cls.format_tag() or footer.get("shards") != shards
+                    or footer.get("sources") != sources):
+                raise ValueError("stale")
+        except (ValueError, struct.error):
+            mm.close()
+            return None
+        return cls(mm, footer)
+
+    def _record(self, pos):
+        (n,) = struct.unpack_from(">I", self.mm, pos)
+        return marshal.loads(self.mm[pos + 4:pos + 4 + n]), pos + 4 + n
+
+    def iter_records(self, kind):
+        pos, count = self.footer["sections"][kind]
+        for _ in range(count):
+            rec, pos = self._record(pos)
+            yield rec
+
+    def records(self, kind):
+        return list(self.iter_records(kind))
+
+    def count(self, kind):
+        return self.footer["counts"][kind]
+
+    def users(self):
+        # one dict per user shard, in shard order
+        out = [{} for _ in range(self.footer["shards"])]
+        from_row = UserRecord.from_row
+        for i, chunk in self.records("users"):
+            out[i].update((key, from_row(row)) for key, row in chunk)
+        return out
+
+    def get(self, kind, rid):
+        with self.lock:
+            index = self.indexes.get(kind)
+            if index is None:
+                index = self.indexes[kind] = self._record(self.footer["index"][kind])[0]
+        pos = index.get(rid)
+        return None if pos is None else self._record(pos)[0]
+
+    def close(self):
+        self.mm.close()
+
+    @classmethod
+    def write(cls, path, sources, shards, history):
+        # shards: the user dict of each shard; history: {kind: (id_key, records)},
+        # records any iterable (streamed, not held in memory)
+        footer = {"format": cls.format_tag(), "shards": len(shards), "sources": sources,
+                  "sections": {}, "counts": {}, "index": {}}
+        tmp = f"{path}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(SNAPSHOT_MAGIC)
+
+            def put(obj):
+                pos = f.tell()
+                data = marshal.dumps(obj)
+                f.write(struct.pack(">I", len(data)))
+                f.write(data)
+                return pos
+
+            start = f.tell()
+            chunks = total = 0
+            for n, users in enumerate(shards):
+                items = list(users.items())
+                for i in range(0, len(items), SNAPSHOT_USER_CHUNK):
+                    put((n, [(k, v.to_row()) for k, v in items[i:i + SNAPSHOT_USER_CHUNK]]))
+                    chunks += 1
+                total += len(items)
+            footer["sections"]["users"] = [start, chunks]
+            footer["counts"]["users"] = total
+            for kind, (id_key, records) in history.items():
+                start = f.tell()
+                index = {}
+                count = 0
+                for rec in records:
+                    pos = put(rec)
+                    count += 1
+                    if id_key:
+                        index[rec.get(id_key)] = pos
+                footer["sections"][kind] = [start, count]
+                footer["counts"][kind] = count
+                if id_key:
+                    footer["index"][kind] = put(index)
+            foot = f.tell()
+            f.write(json.dumps(footer).encode("utf-8"))
+            f.write(struct.pack(">Q", foot))
+            f.write(SNAPSHOT_MAGIC)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+
+class JsonStorage:
+    """bot_data/*.json files. Users live in UserShard snapshot+journal pairs
+    (USERS_FILE/USERS_JOURNAL when there is one shard). Orders, receipts and
+    broadcasts are single JSON files; in journal mode their changes are
+    appended to HISTORY_JOURNAL and folded in by maintenance() and at
+    shutdown, and when SNAPSHOT_FILE is current they are not even read
+    until needed (a fold then streams them from it).
+    Applied update ids ride along in HISTORY_JOURNAL too; UPDATES_FILE is
+    rewritten by save_checkpoint() and before the journal is truncated.
+    AdminDigest items wait in DIGEST_JOURNAL until they are sent."""
+
+    shared = False                      # one process only (no cluster mode)
+
+    def __init__(self, shards=None):
+        self.shard_count = shards or current_user_shards()
+        self.shards = [UserShard(path, journal) for path, journal in user_shard_paths(self.shard_count)]
+        self.flusher = JsonFlusher(FLUSH_INTERVAL)
+        self.history_lock = threading.Lock()
+        self.fold_lock = threading.Lock()   # one fold_history() at a time
+        self.history_appends = 0
+        self.applied_appends = 0            # "applied" lines in HISTORY_JOURNAL (no record to fold)
+        self.history_unsynced = False
+        self.compact_wanted = threading.Event()     # a shard journal is due; see maintenance()
+        self.snapshot = None
+        self.update_offset = 0
+        self.applied = set()
+        self.digest = []                    # [(seq, item)] not sent yet; see digest_add()
+        self.digest_seq = 0
+        self.digest_lock = threading.Lock()
+        self.digest_unsynced = False
+        self.users = {}
+        self.orders = self.receipts = self.broadcasts = None
+
+    def source_files(self):
+        # everything SNAPSHOT_FILE is derived from
+        return ([p for shard in self.shards for p in (shard.path, shard.journal, shard.pending)]
+                + list(HISTORY_FILES.values()) + [HISTORY_JOURNAL, HISTORY_FOLDING])
+
+    def load(self):
+        self.load_checkpoint()              # the journal may add applied ids to it
+        self.load_digest()
+        if self.shard_count > 1:
+            os.makedirs(USERS_SHARD_DIR, exist_ok=True)
+            if not os.path.exists(USERS_SHARD_MANIFEST):
+                save_json(USERS_SHARD_MANIFEST, {"shards": self.shard_count})
+        if PERSIST_MODE == "journal":
+            self.snapshot = BinarySnapshot.open(SNAPSHOT_FILE, BinarySnapshot.sources(self.source_files()),
+                                                self.shard_count)
+        if self.snapshot:
+            snap = self.snapshot
+            self.users = {}
+            for shard, users in zip(self.shards, snap.users()):
+                shard.users = users
+                self.users.update(users)
+            for kind, id_key in HISTORY_IDS.items():
+                setattr(self, kind, LazyHistory(
+                    id_key, stored=snap.count(kind),
+                    fetch_one=(lambda rid, kind=kind: snap.get(kind, rid)) if id_key else None,
+                    fetch_all=lambda kind=kind: snap.records(kind),
+                    fetch_iter=lambda kind=kind: snap.iter_records(kind),
+                    fetch_where=(lambda statuses, before, kind=kind: (
+                        r for r in snap.iter_records(kind) if LazyHistory.settled(r, statuses, before)))
+                    if id_key else None))
+            return self.users, self.orders, self.receipts, self.broadcasts
+        # shards are independent files; read and replay them side by side
+        with ThreadPoolExecutor(max_workers=min(len(self.shards), 8)) as pool:
+            parts = list(pool.map(UserShard.load, self.shards))
+        self.users = {}
+        for part in parts:
+            self.users.update(part)
+        history = {kind: load_json(path) or [] for kind, path in HISTORY_FILES.items()}
+        self.replay_history(history)
+        for kind, id_key in HISTORY_IDS.items():
+            setattr(self, kind, LazyHistory(id_key, items=history[kind]))
+        if self.history_appends or self.applied_appends or os.path.exists(HISTORY_FOLDING):
+            self.fold_history()             # also drops a torn tail
+        return self.users, self.orders, self.receipts, self.broadcasts
+
+    def replay_history(self, history):
+        # apply HISTORY_JOURNAL (left over from a crash) to the lists just read,
+        # after a HISTORY_FOLDING that an unfinished fold_history() left behind;
+        # {"t": kind, "v": record} adds or replaces, {"t": kind, "d": id} removes,
+        # {"t": "applied", "u": update_id} marks an update handled
+        journals = [p for p in (HISTORY_FOLDING, HISTORY_JOURNAL) if os.path.exists(p)]
+        if not journals:
+            return
+        keyed = {kind: {r.get(id_key): r for r in history[kind]}
+                 for kind, id_key in HISTORY_IDS.items() if id_key}
+        replayed = applied = 0
+        for path in journals:
+            replayed, applied = self._replay_journal(path, history, keyed, replayed, applied)
+        for kind, records in keyed.items():
+            history[kind] = list(records.values())
+        self.history_appends = replayed
+        self.applied_appends = applied
+
+    def _replay_journal(self, path, history, keyed, replayed, applied):
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    break                   # torn tail
+                kind = entry["t"]
+                if kind == "applied":
+                    if entry["u"] > self.update_offset:
+                        self.applied.add(entry["u"])
+                    applied += 1
+                    continue
+                id_key = HISTORY_IDS[kind]
+                if "d" in entry:
+                    keyed[kind].pop(entry["d"], None)
+                elif id_key:
+                    keyed[kind][entry["v"].get(id_key)] = entry["v"]
+                else:
+                    history[kind].append(entry["v"])
+                replayed += 1
+        return replayed, applied
+
+    def shard(self, key):
+        return self.shards[user_shard_of(key, len(self.shards))]
+
+    def transaction(self):
+        # single process: db_lock already makes read-modify-write atomic
+        return nullcontext()
+
+    def compact(self):
+        for shard in self.shards:
+            shard.compact()
+
+    @metrics.timed("bot_storage_write", backend="json")
+    def put_user(self, key, prof):
+        shard = self.shard(key)
+        if PERSIST_MODE != "journal":
+            shard.users[key] = prof
+            self.flusher.mark_dirty(shard.path, shard.users)
+            return
+        # the rewrite is left to the maintenance thread: this runs under db_lock
+        if shard.append(key, prof) >= self.compact_threshold():
+            self.compact_wanted.set()
+
+    def compact_threshold(self):
+        return max(1, JOURNAL_COMPACT_EVERY // len(self.shards))
+
+    def put_history(self, kind, rec=None, drop=()):
+        if PERSIST_MODE != "journal":
+            self.flusher.mark_dirty(HISTORY_FILES[kind], getattr(self, kind))
+            return
+        entries = [{"t": kind, "v": rec}] if rec is not None else [{"t": kind, "d": rid} for rid in drop]
+        lines = "".join(json.dumps(e, ensure_ascii=False, default=json_default) + "\n" for e in entries)
+        with self.history_lock:
+            with open(HISTORY_JOURNAL, "a", encoding="utf-8") as f:
+                f.write(lines)
+            self.history_appends += len(entries)
+            self.history_unsynced = True
+
+    def fold_history(self):
+        # HISTORY_JOURNAL -> the JSON files. history_lock is held only to set
+        # the journal aside as HISTORY_FOLDING; the files are then rewritten
+        # from the in-memory view (LazyHistory.iter_all), which streams what
+        # is still only in SNAPSHOT_FILE instead of loading it. A crash
+        # before HISTORY_FOLDING is removed replays it on the next start
+        with self.fold_lock:
+            with self.history_lock:
+                leftover = os.path.exists(HISTORY_FOLDING)
+                if not self.history_appends and not self.applied_appends and not leftover:
+                    return
+                self._write_checkpoint()
+                records = self.history_appends or leftover
+                if not leftover:
+                    # with a leftover (an earlier fold failed) the journal stays
+                    # put: the files are rewritten anyway, it is folded next time
+                    if os.path.exists(HISTORY_JOURNAL):
+                        if self.history_unsynced:
+                            with open(HISTORY_JOURNAL, "a", encoding="utf-8") as f:
+                                os.fsync(f.fileno())
+                        os.replace(HISTORY_JOURNAL, HISTORY_FOLDING)
+                    self.history_appends = self.applied_appends = 0
+                    self.history_unsynced = False
+            if records:
+                for kind, path in HISTORY_FILES.items():
+                    save_json_records(path, getattr(self, kind).iter_all())
+            if os.path.exists(HISTORY_FOLDING):
+                os.remove(HISTORY_FOLDING)
+
+    def add_order(self, order):
+        self.put_history("orders", order)
+
+    def update_order(self, order):
+        self.put_history("orders", order)
+
+    def add_receipt(self, rec):
+        self.put_history("receipts", rec)
+
+    def update_receipt(self, rec):
+        self.put_history("receipts", rec)
+
+    def add_broadcast(self, entry):
+        self.put_history("broadcasts", entry)
+
+    def remove_orders(self, ids):
+        self.put_history("orders", drop=ids)
+
+    def remove_receipts(self, ids):
+        self.put_history("receipts", drop=ids)
+
+    def load_digest(self):
+        # {"i": seq, "v": item} adds an item, {"done": [after, upto]} marks
+        # the ones in between sent; rewritten with what is left, which also
+        # drops a torn tail before anything is appended to it
+        self.digest = []
+        if not os.path.exists(DIGEST_JOURNAL):
+            return
+        with open(DIGEST_JOURNAL, "r", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    break                   # torn tail
+                if "done" in entry:
+                    after, upto = entry["done"]
+                    self.digest = [(i, item) for i, item in self.digest if not after < i <= upto]
+                else:
+                    self.digest.append((entry["i"], entry["v"]))
+                    self.digest_seq = max(self.digest_seq, entry["i"])
+        tmp = f"{DIGEST_JOURNAL}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            for i, item in self.digest:
+                f.write(json.dumps({"i": i, "v": item}, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, DIGEST_JOURNAL)
+
+    def digest_add(self, item):
+        # called inside the update's shared_txn(), before its applied id is
+        # journaled: both reach the disk with the same sync()
+        with self.digest_lock:
+            self.digest_seq += 1
+            with open(DIGEST_JOURNAL, "a", encoding="utf-8") as f:
+                f.write(json.dumps({"i": self.digest_seq, "v": item}, ensure_ascii=False) + "\n")
+            self.digest.append((self.digest_seq, item))
+            self.digest_unsynced = True
+
+    def digest_items(self, after=0):
+        with self.digest_lock:
+            return [(i, item) for i, item in self.digest if i > after]
+
+    def digest_done(self, after, upto):
+        with self.digest_lock:
+            self.digest = [(i, item) for i, item in self.digest if not after < i <= upto]
+            if self.digest:
+                with open(DIGEST_JOURNAL, "a", encoding="utf-8") as f:
+                    f.write(json.dumps({"done": [after, upto]}) + "\n")
+            else:
+                open(DIGEST_JOURNAL, "w").close()
+
+    @metrics.timed("bot_storage_sync", backend="json")
+    def sync(self):
+        # "sync now" for money-critical changes: pending files hit the disk
+        # and the journal is fsynced before the caller replies to anyone
+        self.flusher.flush()
+        with self.digest_lock:
+            if self.digest_unsynced and os.path.exists(DIGEST_JOURNAL):
+                with open(DIGEST_JOURNAL, "a", encoding="utf-8") as f:
+                    os.fsync(f.fileno())
+            self.digest_unsynced = False
+        if PERSIST_MODE == "journal":
+            for shard in self.shards:
+                shard.sync()
+            with self.history_lock:
+                if self.history_unsynced and os.path.exists(HISTORY_JOURNAL):
+                    with open(HISTORY_JOURNAL, "a", encoding="utf-8") as f:
+                        os.fsync(f.fileno())
+                self.history_unsynced = False
+
+    def maintenance(self):
+        # compacts a shard as soon as put_user() finds its journal long enough,
+        # and every shard with a journal each JOURNAL_COMPACT_INTERVAL
+        while True:
+            due = self.compact_wanted.wait(JOURNAL_COMPACT_INTERVAL)
+            self.compact_wanted.clear()
+            try:
+                least = self.compact_threshold() if due else 1
+                for shard in self.shards:
+                    if shard.appends >= least:
+                        shard.compact()
+                if self.history_appends and self.history_appends + self.applied_appends >= JOURNAL_COMPACT_EVERY:
+                    self.fold_history()
+            except Exception:
+                traceback.print_exc()
+
+    def load_checkpoint(self):
+        # (offset, ids above it whose writes are already stored); ids replayed
+        # from HISTORY_JOURNAL are kept
+        data = load_json(UPDATES_FILE)
+        self.update_offset = max(self.update_offset, data.get("offset", 0))
+        self.applied = {u for u in self.applied.union(data.get("applied", ())) if u > self.update_offset}
+        return self.update_offset, set(self.applied)
+
+    def _checkpoint_data(self):
+        return {"offset": self.update_offset, "applied": sorted(self.applied)}
+
+    def _write_checkpoint(self):
+        save_json(UPDATES_FILE, self._checkpoint_data())
+
+    def mark_applied(self, update_id):
+        # called at the end of the update's transaction, after its writes: the
+        # id goes into the same journal (or the same flush, written after the
+        # data files) and reaches the disk with the next sync()
+        with self.history_lock:
+            self.applied.add(update_id)
+            if PERSIST_MODE != "journal":
+                self.flusher.mark_dirty(UPDATES_FILE, self._checkpoint_data())
+                return
+            with open(HISTORY_JOURNAL, "a", encoding="utf-8") as f:
+                f.write(json.dumps({"t": "applied", "u": update_id}) + "\n")
+            self.applied_appends += 1
+            self.history_unsynced = True
+
+    def save_checkpoint(self, offset):
+        # from checkpoint_loop: the data is synced before the offset moves past it.
+        # A journal holding only applied ids is cleared here, UPDATES_FILE has them
+        self.sync()
+        with self.history_lock:
+            self.update_offset = offset
+            self.applied = {u for u in self.applied if u > offset}
+            self._write_checkpoint()
+            if self.applied_appends and not self.history_appends:
+                open(HISTORY_JOURNAL, "w").close()
+                self.applied_appends = 0
+
+    def write_snapshot(self):
+        sources = BinarySnapshot.sources(self.source_files())
+        if self.snapshot and self.snapshot.footer["sources"] == sources:
+            return                          # nothing changed since it was written
+        # streamed; records not loaded this run come from the old snapshot,
+        # so it is closed only once the new one is complete
+        history = {kind: (id_key, getattr(self, kind).iter_all()) for kind, id_key in HISTORY_IDS.items()}
+        fresh = f"{SNAPSHOT_FILE}.new"
+        try:
+            BinarySnapshot.write(fresh, sources, [shard.users for shard in self.shards], history)
+        except Exception:
+            # only a cache: the next start reads the JSON files instead
+            traceback.print_exc()
+            fresh = None
+        if self.snapshot:
+            self.snapshot.close()
+            self.snapshot = None
+        if fresh:
+            os.replace(fresh, SNAPSHOT_FILE)
+
+    def close(self):
+        self.flusher.stop()
+        if PERSIST_MODE == "journal":
+            for shard in self.shards:
+                if shard.appends:
+                    shard.compact()
+            self.fold_history()
+            self.write_snapshot()
+
+
+class SqliteStorage:
+    """Single SQLite file in WAL mode; every change is a single-row statement.
+
+    With shared = True (cluster workers) several processes use the file at
+    once: users are not bulk-loaded but read through get_user(), and
+    transaction() holds SQLite's write lock for a read-modify-write."""
+
+    shared = False
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS users (
+        user_id TEXT PRIMARY KEY,
+        data TEXT NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS orders (
+        order_id TEXT PRIMARY KEY,
+        user_id INTEGER,
+        status TEXT,
+        time TEXT,
+        data TEXT NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS orders_user ON orders(user_id);
+    CREATE TABLE IF NOT EXISTS receipts (
+        receipt_id TEXT PRIMARY KEY,
+        user_id INTEGER,
+        status TEXT,
+        time TEXT,
+        data TEXT NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS receipts_user ON receipts(user_id);
+    CREATE TABLE IF NOT EXISTS broadcasts (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        admin INTEGER,
+        time TEXT,
+        data TEXT NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS meta (
+        key TEXT PRIMARY KEY,
+        value TEXT NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS applied_updates (
+        update_id INTEGER PRIMARY KEY
+    );
+    CREATE TABLE IF NOT EXISTS analytics_log (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        kind TEXT NOT NULL,
+        data TEXT NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS admin_digest (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        data TEXT NOT NULL
+    );
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.RLock()       # re-entrant: statements run inside transaction()
+        self.in_transaction = False
+        # autocommit; multi-row work opens explicit transactions; other
+        # processes holding the write lock are waited for up to `timeout`
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(self.SCHEMA)
+
+    def load(self):
+        users = {}
+        if not self.shared:
+            with self.lock:
+                users = {k: UserRecord.from_dict(json.loads(d)) for k, d in self.db.execute("SELECT user_id, data FROM users")}
+        # order/receipt/broadcast history stays in the database until asked for
+        return (users, self._history("orders", "order_id", "rowid"),
+                self._history("receipts", "receipt_id", "rowid"), self._history("broadcasts", None, "id"))
+
+    def _history(self, table, id_key, order):
+        def fetch_one(rid):
+            with self.lock:
+                row = self.db.execute(f"SELECT data FROM {table} WHERE {id_key} = ?", (rid,)).fetchone()
+            return json.loads(row[0]) if row else None
+
+        def fetch_all():
+            with self.lock:
+                return [json.loads(d) for (d,) in self.db.execute(f"SELECT data FROM {table} ORDER BY {order}")]
+
+        def fetch_where(statuses, before):
+            marks = ",".join("?" * len(statuses))
+            return fetch_pages(f"status IN ({marks}) AND time < ? AND", (*statuses, before.isoformat()))
+
+        def fetch_pages(where="", args=()):
+            # pages keyed by rowid: one pass over the table, lock held per page
+            last = 0
+            while True:
+                with self.lock:
+                    rows = self.db.execute(
+                        f"SELECT rowid, data FROM {table} WHERE {where} rowid > ? ORDER BY rowid LIMIT 1000",
+                        (*args, last)).fetchall()
+                if not rows:
+                    return
+                for _, data in rows:
+                    yield json.loads(data)
+                last = rows[-1][0]
+
+        with self.lock:
+            (count,) = self.db.execute(f"SELECT COUNT(*) FROM {table}").fetchone()
+        return LazyHistory(id_key, stored=count, fetch_one=fetch_one if id_key else None, fetch_all=fetch_all,
+                           fetch_where=fetch_where if id_key else None, fetch_iter=fetch_pages)
+
+    @staticmethod
+    def _dump(obj):
+        return json.dumps(obj, ensure_ascii=False, default=json_default)
+
+    def get_user(self, key):
+        with self.lock:
+            row = self.db.execute("SELECT data FROM users WHERE user_id = ?", (key,)).fetchone()
+        return UserRecord.from_dict(json.loads(row[0])) if row else None
+
+    def user_ids(self):
+        with self.lock:
+            return [k for (k,) in self.db.execute("SELECT user_id FROM users")]
+
+    @contextmanager
+    def transaction(self):
+        # BEGIN IMMEDIATE takes the write lock up front, so a concurrent
+        # read-modify-write in another process waits instead of interleaving
+        with self.lock:
+            if self.in_transaction:
+                yield
+                return
+            self.db.execute("BEGIN IMMEDIATE")
+            self.in_transaction = True
+            try:
+                yield
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+            else:
+                self.db.execute("COMMIT")
+            finally:
+                self.in_transaction = False
+
+    @metrics.timed("bot_storage_write", backend="sqlite")
+    def put_user(self, key, prof):
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO users (user_id, data) VALUES (?, ?)", (key, self._dump(prof)))
+
+    def add_order(self, order):
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO orders (order_id, user_id, status, time, data) VALUES (?, ?, ?, ?, ?)",
+                (order["order_id"], order.get("user_id"), order.get("status"), order.get("time"), self._dump(order)))
+
+    def update_order(self, order):
+        with self.lock:
+            self.db.execute("UPDATE orders SET status = ?, data = ? WHERE order_id = ?",
+                            (order.get("status"), self._dump(order), order["order_id"]))
+
+    def add_receipt(self, rec):
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO receipts (receipt_id, user_id, status, time, data) VALUES (?, ?, ?, ?, ?)",
+                (rec["receipt_id"], rec.get("user_id"), rec.get("status"), rec.get("time"), self._dump(rec)))
+
+    def update_receipt(self, rec):
+        with self.lock:
+            self.db.execute("UPDATE receipts SET status = ?, data = ? WHERE receipt_id = ?",
+                            (rec.get("status"), self._dump(rec), rec["receipt_id"]))
+
+    def add_broadcast(self, entry):
+        with self.lock:
+            self.db.execute("INSERT INTO broadcasts (admin, time, data) VALUES (?, ?, ?)",
+                            (entry.get("admin"), entry.get("time"), self._dump(entry)))
+
+    def _delete(self, table, key, ids):
+        with self.lock:
+            cur = self.db.cursor()
+            cur.execute("BEGIN")
+            try:
+                cur.executemany(f"DELETE FROM {table} WHERE {key} = ?", ((i,) for i in ids))
+                cur.execute("COMMIT")
+            except Exception:
+                cur.execute("ROLLBACK")
+                raise
+
+    def remove_orders(self, ids):
+        self._delete("orders", "order_id", ids)
+
+    def remove_receipts(self, ids):
+        self._delete("receipts", "receipt_id", ids)
+
+    def is_empty(self):
+        with self.lock:
+            return not any(self.db.execute(f"SELECT 1 FROM {table} LIMIT 1").fetchone()
+                           for table in ("users", "orders", "receipts", "broadcasts"))
+
+    def import_all(self, users, orders, receipts, broadcasts):
+        # one transaction; replaces whatever was there (migrate checks first)
+        with self.lock:
+            cur = self.db.cursor()
+            cur.execute("BEGIN")
+            try:
+                for table in ("users", "orders", "receipts", "broadcasts", "admin_digest"):
+                    cur.execute(f"DELETE FROM {table}")
+                cur.executemany("INSERT INTO users (user_id, data) VALUES (?, ?)",
+                                ((k, self._dump(v)) for k, v in users.items()))
+                cur.executemany("INSERT OR REPLACE INTO orders (order_id, user_id, status, time, data) VALUES (?, ?, ?, ?, ?)",
+                                ((o["order_id"], o.get("user_id"), o.get("status"), o.get("time"), self._dump(o)) for o in orders))
+                cur.executemany("INSERT OR REPLACE INTO receipts (receipt_id, user_id, status, time, data) VALUES (?, ?, ?, ?, ?)",
+                                ((r["receipt_id"], r.get("user_id"), r.get("status"), r.get("time"), self._dump(r)) for r in receipts))
+                cur.executemany("INSERT INTO broadcasts (admin, time, data) VALUES (?, ?, ?)",
+                                ((b.get("admin"), b.get("time"), self._dump(b)) for b in broadcasts))
+                cur.execute("COMMIT")
+            except Exception:
+                cur.execute("ROLLBACK")
+                raise
+
+    def log_analytics(self, kind, rec):
+        # cluster mode: a sale/top-up counted by any worker, for the one
+        # that answers /report (see SalesAnalytics)
+        with self.lock:
+            self.db.execute("INSERT INTO analytics_log (kind, data) VALUES (?, ?)", (kind, self._dump(rec)))
+
+    def analytics_log(self, after):
+        with self.lock:
+            return [(i, kind, json.loads(d)) for i, kind, d in self.db.execute(
+                "SELECT id, kind, data FROM analytics_log WHERE id > ? ORDER BY id", (after,))]
+
+    def trim_analytics_log(self, upto):
+        with self.lock:
+            self.db.execute("DELETE FROM analytics_log WHERE id <= ?", (upto,))
+
+    def digest_add(self, item):
+        # an AdminDigest item, committed with the update that made it; in
+        # cluster mode from any worker, sent by worker 0
+        with self.lock:
+            self.db.execute("INSERT INTO admin_digest (data) VALUES (?)", (self._dump(item),))
+
+    def digest_items(self, after=0):
+        with self.lock:
+            return [(i, json.loads(d)) for i, d in self.db.execute(
+                "SELECT id, data FROM admin_digest WHERE id > ? ORDER BY id", (after,))]
+
+    def digest_done(self, after, upto):
+        with self.lock:
+            self.db.execute("DELETE FROM admin_digest WHERE id > ? AND id <= ?", (after, upto))
+
+    @contextmanager
+    def snapshot_reader(self):
+        # a second connection inside one read transaction: a consistent view
+        # of every table (WAL) while this and other processes keep writing
+        db = sqlite3.connect(self.path, isolation_level=None, timeout=30)
+        try:
+            db.execute("BEGIN")
+            yield db
+        finally:
+            db.close()
+
+    def load_checkpoint(self):
+        with self.lock:
+            row = self.db.execute("SELECT value FROM meta WHERE key = 'update_offset'").fetchone()
+            offset = int(row[0]) if row else 0
+            applied = {u for (u,) in self.db.execute(
+                "SELECT update_id FROM applied_updates WHERE update_id > ?", (offset,))}
+        return offset, applied
+
+    def mark_applied(self, update_id):
+        # called inside transaction(): commits together with the update's writes
+        with self.lock:
+            self.db.execute("INSERT OR IGNORE INTO applied_updates (update_id) VALUES (?)", (update_id,))
+
+    def save_checkpoint(self, offset):
+        with self.transaction():
+            self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('update_offset', ?)", (str(offset),))
+            self.db.execute("DELETE FROM applied_updates WHERE update_id <= ?", (offset,))
+
+    @metrics.timed("bot_storage_sync", backend="sqlite")
+    def sync(self):
+        # synchronous=NORMAL may lose the last commits on power loss; a
+        # checkpoint fsyncs the WAL first
+        with self.lock:
+            self.db.execute("PRAGMA wal_checkpoint(PASSIVE)")
+
+    def maintenance(self):
+        pass
+
+    def close(self):
+        with self.lock:
+            self.db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            self.db.close()
+
+
+def make_storage(backend=None):
+    backend = backend or STORAGE_BACKEND
+    if backend == "sqlite":
+        return SqliteStorage(SQLITE_FILE)
+    if backend == "json":
+        return JsonStorage()
+    raise ValueError(f"unknown storage backend: {backend}")
+
+def migrate_json_to_sqlite(force=False):
+    # one-shot import of bot_data/*.json (including the users journal) into
+    # SQLITE_FILE. A database that already has data (a bot ran on it since)
+    # is only replaced with force=True (python bot.py migrate --force)
+    target = SqliteStorage(SQLITE_FILE)
+    if not force and not target.is_empty():
+        target.close()
+        sys.exit(f"{SQLITE_FILE} already has data; python bot.py migrate --force replaces it")
+    source = JsonStorage()
+    users, orders, receipts, broadcasts = source.load()
+    target.import_all(users, orders, receipts, broadcasts)
+    # polling resumes where the JSON-backed bot stopped
+    offset, applied = source.load_checkpoint()
+    with target.transaction():
+        for update_id in applied:
+            target.mark_applied(update_id)
+        target.save_checkpoint(offset)
+        for _, item in source.digest_items():   # admin digests not sent yet
+            target.digest_add(item)
+    target.close()
+    print(f"migrated {len(users)} users, {len(orders)} orders, {len(receipts)} receipts, "
+          f"{len(broadcasts)} broadcasts -> {SQLITE_FILE}")
+
+def reshard_users(n):
+    # offline tool (stop the bot first): rewrite the users into n shards, then
+    # switch the manifest; the old layout is removed only after the switch
+    old = JsonStorage()
+    users = old.load()[0]
+    old.flusher.stop()
+    new = JsonStorage(shards=n)
+    for key, prof in users.items():
+        new.shard(key).users[key] = prof
+    if n > 1:
+        os.makedirs(USERS_SHARD_DIR, exist_ok=True)
+    for shard in new.shards:
+        shard.compact()
+    if n > 1:
+        save_json(USERS_SHARD_MANIFEST, {"shards": n})
+    elif os.path.exists(USERS_SHARD_MANIFEST):
+        os.remove(USERS_SHARD_MANIFEST)
+    if old.shard_count != n:
+        for shard in old.shards:
+            for path in (shard.path, shard.journal, shard.pending):
+                if os.path.exists(path):
+                    os.remove(path)
+    new.flusher.stop()
+    print(f"resharded {len(users)} users: {old.shard_count} -> {n} shard(s)")
+
+# ================= order archive =================
+_ID_STAMP = re.compile(r"-(\d{2})(\d{2})\d{8}-\d{4}$")   # gen_order_id: ...-YYMMDDHHMMSS-NNNN
+
+def archive_month(rid, rec=None):
+    # partition key "YYYYMM"; taken from the id so a lookup knows where to look
+    m = _ID_STAMP.search(str(rid))
+    if m:
+        return f"20{m.group(1)}{m.group(2)}"
+    if rec is not None and str(rec.get("time", ""))[:7].count("-") == 1:
+        return rec["time"][:7].replace("-", "")
+    return "000000"
+
+class OrderArchive:
+    """Settled orders/receipts moved out of the hot set. Segments are
+    immutable: ARCHIVE_DIR/{kind}-{YYYYMM}-{seq}.jsonl.gz holds JSON lines
+    as a chain of gzip members (ARCHIVE_BLOCK records each, so the file is
+    still plain gzip for zcat), and the matching .idx.json maps every id to
+    the offset and length of its member. A lookup reads one index and
+    inflates one member. The index is written last: a segment without one
+    was interrupted and is ignored."""
+
+    def __init__(self, root):
+        self.root = root
+        self.lock = threading.Lock()
+        self.indexes = OrderedDict()        # index path -> {id: [offset, length]}
+
+    def segments(self, kind, month=None):
+        # index paths, newest first
+        try:
+            names = os.listdir(self.root)
+        except OSError:
+            return []
+        prefix = f"{kind}-{month}-" if month else f"{kind}-"
+        return [os.path.join(self.root, n) for n in sorted(names, reverse=True)
+                if n.startswith(prefix) and n.endswith(".idx.json")]
+
+    def write(self, kind, id_key, records):
+        os.makedirs(self.root, exist_ok=True)
+        by_month = {}
+        for rec in records:
+            by_month.setdefault(archive_month(rec.get(id_key), rec), []).append(rec)
+        with self.lock:
+            for month, recs in sorted(by_month.items()):
+                seq = len(self.segments(kind, month))
+                base = os.path.join(self.root, f"{kind}-{month}-{seq:04d}")
+                ids = {}
+                with open(f"{base}.jsonl.gz.tmp", "wb") as f:
+                    for i in range(0, len(recs), ARCHIVE_BLOCK):
+                        block = recs[i:i + ARCHIVE_BLOCK]
+                        data = gzip.compress("".join(
+                            json.dumps(r, ensure_ascii=False, default=json_default) + "\n" for r in block).encode("utf-8"))
+                        at = f.tell()
+                        f.write(data)
+                        for r in block:
+                            ids[r.get(id_key)] = [at, len(data)]
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(f"{base}.jsonl.gz.tmp", f"{base}.jsonl.gz")
+                save_json(f"{base}.idx.json", {"kind": kind, "month": month, "count": len(recs), "ids": ids})
+
+    def records(self, kind):
+        # every archived record of a kind, oldest segment first
+        for path in reversed(self.segments(kind)):
+            with gzip.open(path[:-len(".idx.json")] + ".jsonl.gz", "rt", encoding="utf-8") as f:
+                for line in f:
+                    yield json.loads(line)
+
+    def _index(self, path):
+        with self.lock:
+            ids = self.indexes.get(path)
+            if ids is None:
+                ids = (load_json(path) or {}).get("ids", {})
+                self.indexes[path] = ids
+                while len(self.indexes) > ARCHIVE_INDEX_CACHE:
+                    self.indexes.popitem(last=False)
+            else:
+                self.indexes.move_to_end(path)
+            return ids
+
+    def get(self, kind, rid):
+        id_key = HISTORY_IDS[kind]
+        month = archive_month(rid)
+        for path in self.segments(kind, None if month == "000000" else month):
+            where = self._index(path).get(rid)
+            if where is None:
+                continue
+            with open(path[:-len(".idx.json")] + ".jsonl.gz", "rb") as f:
+                f.seek(where[0])
+                block = gzip.decompress(f.read(where[1])).decode("utf-8")
+            for line in block.splitlines():
+                rec = json.loads(line)
+                if rec.get(id_key) == rid:
+                    return rec
+        return None
+
+# load databases
+storage = make_storage()
+# cluster workers share the SQLite file: profiles and records are read through.
+# The ingress needs no users or analytics at all, so it loads them the same way
+storage.shared = bool(CLUSTER_WORKER or CLUSTER_INGRESS)
+# guards users_db / orders_db / receipts_db; re-entrant because helpers such
+# as user_profile are called with it already held
+db_lock = threading.RLock()
+# orders_db / receipts_db / broadcast_db are LazyHistory: older records are
+# read from disk on first use, look ups by id go through find_order/find_receipt
+users_db, orders_db, receipts_db, broadcast_db = storage.load()
+archive = OrderArchive(ARCHIVE_DIR)
+
+# ================ config data ================
+COUNTRIES = {
+    "🇺🇸 USA": 40000,
+    "🇨🇦 Canada": 40000,
+    "🇮🇷 Iran": 150000,
+    "🇸🇦 Saudi Arabia": 100000,
+}
+
+# multilingual messages
+MESSAGES = {
+    "fa": {
+        "welcome": "👋 سلام! خوش آمدی به ربات.",
+        "menu": "منوی اصلی:",
+        "choose_country": "🌍 کشور شماره مجازی را انتخاب کن:",
+        "price_for": "💵 قیمت برای {country}: {price:,} تومان",
+        "confirm_order": "آیا می‌خواهی سفارش را اضافه کنی به سبد؟",
+        "enter_qty": "🔢 تعداد را وارد کن (عدد صحیح):",
+        "cart_added": "🧾 آیتم به سبد اضافه شد.",
+        "cart_empty": "🛒 سبد شما خالی است.",
+        "view_cart": "🧾 سبد خرید شما:\n{summary}\n\n💰 مجموع: {total:,} تومان",
+        "checkout_confirm": "آیا می‌خواهی سفارش را نهایی کنی؟",
+        "enter_name": "✍️ لطفاً نام و نام خانوادگی را وارد کن:",
+        "send_contact": "📲 شماره خود را با دکمه زیر ارسال کن:",
+        "enter_code": "⏰ کد ارسال شد. لطفاً وارد کن:",
+        "invalid_code": "❌ کد اشتباه یا منقضی شده.",
+        "order_registered": "🎉 سفارش ثبت شد! کد: {order_id}",
+        "profile_created": "✅ پروفایل بروزرسانی شد.",
+        "wallet_balance": "💰 موجودی: {amount:,} تومان",
+        "send_receipt": "📸 لطفاً عکس فیش پرداخت را ارسال کن.",
+        "receipt_sent_admin": "📤 رسید ارسال شد؛ پس از تایید، کیف‌پول شارژ می‌شود.",
+        "receipt_approved": "✅ رسید تایید شد؛ کیف‌پول شما {amount:,} تومان شارژ شد.",
+        "receipt_rejected": "❌ رسید رد شد.",
+        "support_prompt": "🛠 لطفاً پیام پشتیبانی خود را ارسال کن:",
+        "support_sent": "پیام شما برای پشتیبانی ارسال شد."
+    },
+    "en": {
+        "welcome": "👋 Welcome to the bot!",
+        "menu": "Main menu:",
+        "choose_country": "🌍 Choose virtual-number country:",
+        "price_for": "💵 Price for {country}: {price:,} Toman",
+        "confirm_order": "Do you want to add this to your cart?",
+        "enter_qty": "🔢 Enter quantity (integer):",
+        "cart_added": "🧾 Item added to cart.",
+        "cart_empty": "🛒 Your cart is empty.",
+        "view_cart": "🧾 Your cart:\n{summary}\n\n💰 Total: {total:,} Toman",
+        "checkout_confirm": "Do you want to complete the checkout?",
+        "enter_name": "✍️ Please enter your full name:",
+        "send_contact": "📲 Please send your Telegram contact (button):",
+        "enter_code": "⏰ Code sent. Please enter it:",
+        "invalid_code": "❌ Code invalid or expired.",
+        "order_registered": "🎉 Order registered! ID: {order_id}",
+        "profile_created": "✅ Profile updated.",
+        "wallet_balance": "💰 Balance: {amount:,} Toman",
+        "send_receipt": "📸 Please send payment receipt photo.",
+        "receipt_sent_admin": "📤 Receipt sent for review.",
+        "receipt_approved": "✅ Receipt approved; wallet credited {amount:,} Toman.",
+        "receipt_rejected": "❌ Receipt rejected.",
+        "support_prompt": "🛠 Please send your support message:",
+        "support_sent": "Your support message was sent."
+    },
+    "ar": {
+        "welcome": "👋 مرحباً بك في البوت!",
+        "menu": "القائمة الرئيسية:",
+        "choose_country": "🌍 اختر دولة الرقم الافتراضي:",
+        "price_for": "💵 السعر لـ {country}: {price:,} تومان",
+        "confirm_order": "هل تريد إضافة هذا للسلة؟",
+        "enter_qty": "🔢 أدخل الكمية (عدد صحيح):",
+        "cart_added": "🧾 تم إضافة العنصر للسلة.",
+        "cart_empty": "🛒 سلتك فارغة.",
+        "view_cart": "🧾 سلتك:\n{summary}\n\n💰 المجموع: {total:,} تومان",
+        "checkout_confirm": "هل تريد إنهاء الطلب؟",
+        "enter_name": "✍️ الرجاء إدخال اسمك الكامل:",
+        "send_contact": "📲 الرجاء إرسال جهة اتصال تلغرام (زر):",
+        "enter_code": "⏰ تم إرسال الرمز. الرجاء إدخاله:",
+        "invalid_code": "❌ الرمز غير صالح أو منتهي.",
+        "order_registered": "🎉 تم تسجيل الطلب! رقم: {order_id}",
+        "profile_created": "✅ تم تحديث الملف الشخصي.",
+        "wallet_balance": "💰 الرصيد: {amount:,} تومان",
+        "send_receipt": "📸 الرجاء إرسال إيصال الدفع صورة.",
+        "receipt_sent_admin": "📤 تم إرسال الإيصال للمراجعة.",
+        "receipt_approved": "✅ تم الموافقة؛ تم شحن المحفظة بمقدار {amount:,} تومان.",
+        "receipt_rejected": "❌ تم رفض الإيصال.",
+        "support_prompt": "🛠 أرسل رسالة الدعم:",
+        "support_sent": "تم إرسال رسالتك للدعم."
+    }
+}
+
+# ================ Utilities ================
+def user_profile(chat_id):
+    key = str(chat_id)
+    with db_lock:
+        if storage.shared:
+            # another worker may have changed it (an admin crediting the wallet)
+            fresh = storage.get_user(key)
+            if fresh is not None:
+                users_db[key] = fresh
+        if key not in users_db:
+            users_db[key] = UserRecord(
+                first_name="",
+                last_name="",
+                phone="",
+                lang="fa",
+                wallet=0,
+                points=0,
+                vip=False,
+                created_at=int(time.time())
+            )
+            storage.put_user(key, users_db[key])
+        return users_db[key]
+
+def set_profile(chat_id, profile):
+    key = str(chat_id)
+    profile = UserRecord.from_dict(profile)
+    with db_lock:
+        users_db[key] = profile
+        storage.put_user(key, profile)
+
+handling = threading.local()           # .update_id: the update this thread is handling
+
+@contextmanager
+def shared_txn():
+    # read-modify-write of a profile or status: db_lock inside this process
+    # and, on SQLite, one write transaction (atomic across cluster workers).
+    # The update being handled is recorded as applied with its writes, so a
+    # redelivery after a restart is dropped instead of applied twice.
+    with db_lock, storage.transaction():
+        yield
+        update_id = getattr(handling, "update_id", None)
+        if update_id is not None:
+            storage.mark_applied(update_id)
+
+class MessageCatalog:
+    """MESSAGES compiled once at startup.
+
+    Every language gets every key, with its fallback chain (lang, then
+    LANG_FALLBACKS[lang], then DEFAULT_LANG) already resolved, and each
+    template records whether it has format fields, so render() is two dict
+    lookups plus at most one str.format.
+    """
+
+    def __init__(self, messages, default="fa", fallbacks=None):
+        fallbacks = fallbacks or {}
+        self.default = default
+        keys = set()
+        for table in messages.values():
+            keys.update(table)
+        self.compiled = {}
+        for lang in messages:
+            chain = [lang, *fallbacks.get(lang, ()), default]
+            compiled = {}
+            for key in keys:
+                template = next((messages[l][key] for l in chain if key in messages.get(l, {})), "")
+                has_fields = any(field is not None for _, field, _, _ in string.Formatter().parse(template))
+                compiled[key] = (template, has_fields)
+            self.compiled[lang] = compiled
+
+    def render(self, lang, key, **kw):
+        table = self.compiled.get(lang) or self.compiled[self.default]
+        template, has_fields = table.get(key, ("", False))
+        return template.format(**kw) if kw and has_fields else template
+
+LANG_FALLBACKS = {}                  # e.g. {"ar": ["en"]}; DEFAULT_LANG is always last
+DEFAULT_LANG = "fa"
+LANG_CACHE_SIZE = 100000
+
+catalog = MessageCatalog(MESSAGES, DEFAULT_LANG, LANG_FALLBACKS)
+lang_cache = {}                      # chat_id -> lang, bounded; oldest entries dropped first
+lang_cache_lock = threading.Lock()
+
+def remember_lang(chat_id, lang):
+    with lang_cache_lock:
+        if chat_id not in lang_cache and len(lang_cache) >= LANG_CACHE_SIZE:
+            lang_cache.pop(next(iter(lang_cache)))
+        lang_cache[chat_id] = lang
+
+def user_lang(chat_id):
+    # read-only: never creates a profile just to pick a language
+    if storage.shared:
+        # any worker may change it, and no other worker would hear of it:
+        # read the stored profile instead of caching per process
+        prof = storage.get_user(str(chat_id))
+        return prof.get("lang", DEFAULT_LANG) if prof else DEFAULT_LANG
+    lang = lang_cache.get(chat_id)
+    if lang is None:
+        prof = users_db.get(str(chat_id))
+        lang = prof.get("lang", DEFAULT_LANG) if prof else DEFAULT_LANG
+        remember_lang(chat_id, lang)
+    return lang
+
+def get_msg(chat_id, key, **kw):
+    return catalog.render(user_lang(chat_id), key, **kw)
+
+def gen_code():
+    return "{:06d}".format(random.randint(0, 999999))
+
+_issued_ids = (None, set())   # (second, ids handed out in that second)
+
+def gen_order_id(prefix="ARSH", history=None):
+    # ids have second resolution and a 4-digit tail, so busy seconds clash;
+    # draw again until the id is new (this second and in the history)
+    global _issued_ids
+    history = orders_db if history is None else history
+    now = datetime.utcnow().strftime("%y%m%d%H%M%S")
+    with db_lock:
+        if _issued_ids[0] != now:
+            _issued_ids = (now, set())
+        while True:
+            # cluster workers draw from disjoint residues, so they never clash
+            oid = f"{prefix}-{now}-{random.randrange(1000 + CLUSTER_INDEX, 10000, CLUSTER_SIZE)}"
+            if oid not in _issued_ids[1] and history.get(oid) is None:
+                _issued_ids[1].add(oid)
+                return oid
+
+def save_order(order):
+    with db_lock:
+        orders_db.append(order)
+        storage.add_order(order)
+        analytics.add_order(order)
+
+def save_receipt(r):
+    with db_lock:
+        receipts_db.append(r)
+        storage.add_receipt(r)
+
+def find_order(order_id):
+    # hot set first; an archived order is a read-only copy
+    if storage.shared:
+        return orders_db.refresh(order_id) or archive.get("orders", order_id)
+    return orders_db.get(order_id) or archive.get("orders", order_id)
+
+def find_receipt(receipt_id):
+    if storage.shared:
+        return receipts_db.refresh(receipt_id) or archive.get("receipts", receipt_id)
+    return receipts_db.get(receipt_id) or archive.get("receipts", receipt_id)
+
+def set_order_status(order, status):
+    with db_lock:
+        counted = order.get("status") in REVENUE_STATUSES
+        order["status"] = status
+        if orders_db.get(order["order_id"]) is None:
+            # an archived order that changes again comes back to the hot set
+            orders_db.append(order)
+            storage.add_order(order)
+        else:
+            storage.update_order(order)
+        if not counted:
+            analytics.add_order(order)
+
+def set_receipt_status(rec, status):
+    with db_lock:
+        counted = rec.get("status") == "approved"
+        rec["status"] = status
+        if receipts_db.get(rec["receipt_id"]) is None:
+            receipts_db.append(rec)
+            storage.add_receipt(rec)
+        else:
+            storage.update_receipt(rec)
+        if not counted:
+            analytics.add_topup(rec)
+
+def record_time(rec):
+    try:
+        return datetime.fromisoformat(rec["time"])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+def archive_settled(days=None):
+    # move settled orders/receipts older than `days` to the archive; segments
+    # are on disk before the records leave storage, so a crash in between
+    # only leaves a duplicate (the hot copy wins on lookup)
+    days = ARCHIVE_AFTER_DAYS if days is None else days
+    cutoff = datetime.utcnow() - timedelta(days=days)
+    moved = {}
+    for kind, history, remove in (("orders", orders_db, storage.remove_orders),
+                                  ("receipts", receipts_db, storage.remove_receipts)):
+        id_key = HISTORY_IDS[kind]
+        with db_lock:
+            # streamed from the backend; the hot history stays unloaded
+            picked = [dict(r) for r in history.iter_settled(ARCHIVE_STATUSES, cutoff)]
+        if not picked:
+            continue
+        archive.write(kind, id_key, picked)
+        with db_lock:
+            # skip anything whose status changed while the segment was written
+            ids = [r[id_key] for r in picked
+                   if (history.get(r[id_key]) or {}).get("status") == r["status"]]
+            history.remove(ids)
+            remove(ids)
+        metrics.inc("bot_archived_total", len(ids), kind=kind)
+        moved[kind] = len(ids)
+    return moved
+
+def archive_loop(interval):
+    while True:
+        time.sleep(interval)
+        try:
+            archive_settled()
+        except Exception:
+            traceback.print_exc()
+
+def user_cart_summary(cart):
+    lines = []
+    total = 0
+    for idx, item in enumerate(cart, 1):
+        if item["kind"] == "number":
+            lines.append(f"{idx}. {item['country']} × {item['qty']} — {item['price']:,} each")
+            total += item['price'] * item['qty']
+        elif item["kind"] == "stars":
+            lines.append(f"{idx}. ⭐ {item['qty']} × {item['price']:,}")
+            total += item['price'] * item['qty']
+    return "\n".join(lines), total
+
+# ================ Sales analytics ================
+ANALYTICS_IDS = {"order": "order_id", "topup": "receipt_id"}
+DAY_FIELDS = ("revenue", "orders", "numbers", "stars", "stars_revenue", "topups", "topup_amount", "vip")
+
+class SalesAnalytics:
+    """Running sales aggregates for /report, updated by save_order,
+    set_order_status and set_receipt_status instead of scanning history.
+
+    daily: "YYYY-MM-DD" -> DAY_FIELDS counters; countries: country ->
+    {"qty", "revenue"} of number items. Orders count once they reach a
+    REVENUE_STATUSES status, top-ups once the receipt is approved, a VIP
+    conversion is the paid order flagged "vip_upgrade". rebuild() derives
+    the same numbers from the full history (hot set and archive).
+
+    ANALYTICS_FILE is kept between runs. The first change after it was
+    written leaves a ".dirty" marker next to it, so after a crash the file
+    is not trusted and the numbers are rebuilt (in the background).
+
+    In cluster mode (shared storage) a change is only logged to the
+    database (log_analytics); the worker answering /report rebuilds once
+    and then folds in the log since (catch_up)."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.rebuild_lock = threading.RLock()
+        self.daily = {}
+        self.countries = {}
+        self.ready = False                  # the aggregates cover the whole history
+        self.pending = None                 # changes seen while a rebuild runs
+        self.pending_ids = set()            # (kind, id) of those; the rebuild leaves them out
+        self.path = None                    # ANALYTICS_FILE once restored or saved
+        self.marked = False                 # its dirty marker is on disk
+        self.rebuilt = None                 # (seconds, rows) of the last rebuild
+        self.log_seen = 0                   # cluster mode: analytics_log folded in up to here
+
+    def _day(self, rec):
+        day = str(rec.get("time", ""))[:10] or "?"
+        counters = self.daily.get(day)
+        if counters is None:
+            counters = self.daily[day] = dict.fromkeys(DAY_FIELDS, 0)
+        return counters
+
+    def _changed(self, kind, rec):
+        # under self.lock (and db_lock); False: the record is counted later
+        if storage.shared:
+            storage.log_analytics(kind, rec)
+            return False
+        if self.pending is not None:
+            self.pending.append((kind, dict(rec)))
+            self.pending_ids.add((kind, rec.get(ANALYTICS_IDS[kind])))
+            return False
+        if self.path and not self.marked:
+            with open(f"{self.path}.dirty", "w") as f:
+                os.fsync(f.fileno())
+            self.marked = True
+        return True
+
+    def add_order(self, order):
+        if order.get("status") not in REVENUE_STATUSES:
+            return
+        with self.lock:
+            if self._changed("order", order):
+                self._add_order(order)
+
+    def _add_order(self, order):
+        day = self._day(order)
+        day["revenue"] += int(order.get("total", 0))
+        day["orders"] += 1
+        day["vip"] += bool(order.get("vip_upgrade"))
+        for item in order.get("cart") or ():
+            qty, amount = int(item.get("qty", 1)), int(item.get("price", 0)) * int(item.get("qty", 1))
+            if item.get("kind") == "number":
+                day["numbers"] += qty
+                c = self.countries.setdefault(item.get("country"), {"qty": 0, "revenue": 0})
+                c["qty"] += qty
+                c["revenue"] += amount
+            elif item.get("kind") == "stars":
+                day["stars"] += qty
+                day["stars_revenue"] += amount
+
+    def add_topup(self, rec):
+        if rec.get("status") != "approved":
+            return
+        with self.lock:
+            if self._changed("topup", rec):
+                self._add_topup(rec)
+
+    def _add_topup(self, rec):
+        day = self._day(rec)
+        day["topups"] += 1
+        day["topup_amount"] += int(rec.get("amount", 0))
+
+    def to_dict(self):
+        with self.lock:
+            return {"daily": self.daily, "countries": self.countries}
+
+    def save(self, path):
+        # only complete numbers are written; the file replaces the marker
+        with self.lock:
+            if not self.ready:
+                return False
+            save_json(path, {"daily": self.daily, "countries": self.countries})
+            if os.path.exists(f"{path}.dirty"):
+                os.remove(f"{path}.dirty")
+            self.path, self.marked = path, False
+        return True
+
+    def restore(self, path):
+        data = load_json(path)
+        if not data or "daily" not in data or os.path.exists(f"{path}.dirty"):
+            return False
+        with self.lock:
+            self.daily, self.countries = data["daily"], data["countries"]
+            self.ready, self.path, self.marked = True, path, False
+        return True
+
+    def start_rebuild(self):
+        # changes from here on wait in self.pending
+        with self.lock:
+            self.pending = []
+            self.pending_ids = set()
+
+    def rebuild(self, orders, receipts, guard=nullcontext()):
+        # orders/receipts are streamed; every REBUILD_BATCH of them is counted
+        # under `guard` (db_lock, which status changes hold), so a record
+        # changed since start_rebuild() counts once: through self.pending
+        start = time.perf_counter()
+        fresh = SalesAnalytics()
+        rows = 0
+        for kind, records, statuses in (("order", orders, REVENUE_STATUSES), ("topup", receipts, ("approved",))):
+            id_key, add = ANALYTICS_IDS[kind], fresh._add_order if kind == "order" else fresh._add_topup
+            records = iter(records)
+            while True:
+                batch = list(itertools.islice(records, REBUILD_BATCH))
+                if not batch:
+                    break
+                with guard:
+                    with self.lock:
+                        changed = self.pending_ids
+                    for rec in batch:
+                        if rec.get("status") in statuses and (kind, rec.get(id_key)) not in changed:
+                            add(rec)
+                            rows += kind == "order"
+        with self.lock:
+            self.daily, self.countries = fresh.daily, fresh.countries
+            self._apply(self.pending or ())
+            self.pending = None
+            self.pending_ids = set()
+            self.ready = True
+        self.rebuilt = (time.perf_counter() - start, rows)
+        return self.rebuilt
+
+    def _apply(self, changes):
+        for kind, rec in changes:
+            (self._add_order if kind == "order" else self._add_topup)(rec)
+
+    def catch_up(self):
+        # cluster mode: fold in what every worker logged since the last call
+        rows = storage.analytics_log(self.log_seen)
+        if rows:
+            with self.lock:
+                self._apply((kind, rec) for _, kind, rec in rows)
+                self.log_seen = rows[-1][0]
+            storage.trim_analytics_log(self.log_seen)
+        return len(rows)
+
+def full_history(kind, hot):
+    # hot set plus archive; a record in both (revived, or a crash mid-archive)
+    # counts once, the hot copy wins
+    id_key = HISTORY_IDS[kind]
+    seen = set()
+    for rec in hot:
+        seen.add(rec.get(id_key))
+        yield rec
+    for rec in archive.records(kind):
+        rid = rec.get(id_key)
+        if rid not in seen:
+            seen.add(rid)
+            yield rec
+
+def rebuild_analytics():
+    # streams the hot set (LazyHistory.iter_all: from the snapshot or SQLite
+    # unless already in memory) and the archive; db_lock is only held while
+    # a batch is counted
+    with analytics.rebuild_lock:
+        if storage.shared:
+            return rebuild_shared_analytics()
+        analytics.start_rebuild()
+        return analytics.rebuild(full_history("orders", orders_db.iter_all()),
+                                 full_history("receipts", receipts_db.iter_all()), guard=db_lock)
+
+def rebuild_shared_analytics():
+    # every worker's records, read in one transaction together with the
+    # analytics_log position they include; later log rows are folded in by
+    # analytics.catch_up()
+    with storage.snapshot_reader() as db:
+        (seen,) = db.execute("SELECT COALESCE(MAX(id), 0) FROM analytics_log").fetchone()
+        orders = (json.loads(d) for (d,) in db.execute("SELECT data FROM orders ORDER BY rowid"))
+        receipts = (json.loads(d) for (d,) in db.execute("SELECT data FROM receipts ORDER BY rowid"))
+        rebuilt = analytics.rebuild(full_history("orders", orders), full_history("receipts", receipts))
+    analytics.log_seen = seen
+    storage.trim_analytics_log(seen)
+    return rebuilt
+
+def ensure_analytics():
+    # startup (in the background) and /report: rebuild unless restored;
+    # a /report during the startup rebuild waits for it
+    with analytics.rebuild_lock:
+        if not analytics.ready:
+            rebuild_analytics()
+        elif storage.shared:
+            analytics.catch_up()
+
+def report_text(days=REPORT_DAYS):
+    data = analytics.to_dict()
+    daily = data["daily"]
+    since = (datetime.utcnow() - timedelta(days=days - 1)).strftime("%Y-%m-%d")
+    window = {f: 0 for f in DAY_FIELDS}
+    lines = [f"📈 گزارش فروش ({days} روز اخیر)", "روز: درآمد | سفارش | ستاره | شارژ کیف‌پول | VIP"]
+    for day in sorted(d for d in daily if d >= since):
+        c = daily[day]
+        for f in DAY_FIELDS:
+            window[f] += c[f]
+        lines.append(f"{day}: {c['revenue']:,} | {c['orders']} | ⭐{c['stars']:,} | {c['topups']} ({c['topup_amount']:,}) | {c['vip']}")
+    lines.append(f"جمع: {window['revenue']:,} | {window['orders']} | ⭐{window['stars']:,} ({window['stars_revenue']:,}) "
+                 f"| {window['topups']} ({window['topup_amount']:,}) | {window['vip']}")
+    total = sum(c["revenue"] for c in daily.values())
+    lines += ["", f"کل درآمد: {total:,} | کل VIP: {sum(c['vip'] for c in daily.values())}", "کشورها (تعداد، درآمد):"]
+    for name in COUNTRIES:
+        c = data["countries"].get(name, {"qty": 0, "revenue": 0})
+        lines.append(f"  {name}: {c['qty']:,}, {c['revenue']:,}")
+    for name, c in data["countries"].items():
+        if name not in COUNTRIES:
+            lines.append(f"  {name}: {c['qty']:,}, {c['revenue']:,}")
+    if analytics.rebuilt:
+        seconds, rows = analytics.rebuilt
+        lines.append(f"\nبازسازی: {rows:,} سفارش در {seconds:.2f}s")
+    return "\n".join(lines)
+
+analytics = SalesAnalytics()
+# a cluster worker only sees its own chats' updates; /report rebuilds there
+# once, then reads the analytics log. Otherwise a missing or stale file is
+# rebuilt once the bot runs (see __main__), not here: tools and startup do
+# not read all history
+if not storage.shared:
+    analytics.restore(ANALYTICS_FILE)
+
+# ================ Conversation state ================
+def _encode_state(obj):
+    if isinstance(obj, datetime):
+        return {"__dt__": obj.isoformat()}
+    raise TypeError(f"not JSON serializable: {type(obj).__name__}")
+
+def _decode_state(obj):
+    if "__dt__" in obj:
+        return datetime.fromisoformat(obj["__dt__"])
+    return obj
+
+def _copy_state(state):
+    # the chat's worker may change the dict while it is copied; copy again then
+    while True:
+        try:
+            return copy.deepcopy(state)
+        except RuntimeError:            # changed size during iteration
+            continue
+
+class StateStore:
+    """Dict-like chat_id -> state store with an LRU size cap and idle TTL.
+
+    Reads refresh an entry; entries idle longer than `ttl` are dropped on
+    access or by sweep(). Open conversations can be spilled to a JSON file
+    and restored after a restart. stats() feeds sizing decisions.
+    """
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.data = OrderedDict()    # chat_id -> [state, last_used (wall clock)]
+        self.lock = threading.Lock()
+        self.hits = self.misses = self.evicted = self.expired = 0
+
+    def get(self, chat_id, default=None):
+        now = time.time()
+        with self.lock:
+            entry = self.data.get(chat_id)
+            if entry is None:
+                self.misses += 1
+                return default
+            if now - entry[1] > self.ttl:
+                del self.data[chat_id]
+                self.expired += 1
+                self.misses += 1
+                return default
+            entry[1] = now
+            self.data.move_to_end(chat_id)
+            self.hits += 1
+            return entry[0]
+
+    def __getitem__(self, chat_id):
+        state = self.get(chat_id)
+        if state is None:
+            raise KeyError(chat_id)
+        return state
+
+    def get_or_create(self, chat_id, default):
+        # the chat's state, or `default` stored in its place when it was
+        # evicted or expired; one locked step, so a handler that changes the
+        # returned dict never writes to a state that is no longer stored
+        now = time.time()
+        with self.lock:
+            entry = self.data.get(chat_id)
+            if entry is not None and now - entry[1] > self.ttl:
+                self.expired += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                entry = self.data[chat_id] = [default, now]
+            else:
+                self.hits += 1
+                entry[1] = now
+            self.data.move_to_end(chat_id)
+            while len(self.data) > self.max_size:
+                self.data.popitem(last=False)
+                self.evicted += 1
+            return entry[0]
+
+    def __setitem__(self, chat_id, state):
+        with self.lock:
+            self.data[chat_id] = [state, time.time()]
+            self.data.move_to_end(chat_id)
+            while len(self.data) > self.max_size:
+                self.data.popitem(last=False)
+                self.evicted += 1
+
+    def __contains__(self, chat_id):
+        return self.get(chat_id) is not None
+
+    def __len__(self):
+        return len(self.data)
+
+    def pop(self, chat_id, default=None):
+        with self.lock:
+            entry = self.data.pop(chat_id, None)
+        return entry[0] if entry is not None else default
+
+    def sweep(self):
+        # entries are kept in last-used order, so expired ones sit at the front
+        cutoff = time.time() - self.ttl
+        removed = 0
+        with self.lock:
+            while self.data:
+                chat_id, entry = next(iter(self.data.items()))
+                if entry[1] > cutoff:
+                    break
+                del self.data[chat_id]
+                removed += 1
+            self.expired += removed
+        return removed
+
+    def stats(self):
+        with self.lock:
+            size = len(self.data)
+            sample = [e[0] for _, e in zip(range(200), self.data.values())]
+            lookups = self.hits + self.misses
+            stats = {"sessions": size, "max_sessions": self.max_size, "hits": self.hits,
+                     "misses": self.misses, "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                     "evicted": self.evicted, "expired": self.expired}
+        # rough footprint: average over a sample of states, scaled to the store size
+        if sample:
+            per_state = sum(sys.getsizeof(st) + sum(sys.getsizeof(v) for v in st.values()) for st in sample) / len(sample)
+            stats["approx_bytes"] = int(per_state * size + sys.getsizeof(self.data))
+        else:
+            stats["approx_bytes"] = sys.getsizeof(self.data)
+        return stats
+
+    def save(self, path):
+        # which chats are open is taken under the lock; each state is then
+        # copied on its own (handlers change their state dict in place)
+        with self.lock:
+            entries = [(str(k), e[0], e[1]) for k, e in self.data.items()]
+        snapshot = {key: [_copy_state(state), ts] for key, state, ts in entries}
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(snapshot, f, ensure_ascii=False, default=_encode_state)
+        os.replace(tmp, path)
+
+    def restore(self, path):
+        if not os.path.exists(path):
+            return 0
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                snapshot = json.load(f, object_hook=_decode_state)
+        except Exception:
+            traceback.print_exc()
+            return 0
+        cutoff = time.time() - self.ttl
+        live = sorted(((int(k), st, ts) for k, (st, ts) in snapshot.items() if ts > cutoff), key=lambda e: e[2])
+        with self.lock:
+            for chat_id, st, ts in live[-self.max_size:]:
+                self.data[chat_id] = [st, ts]
+        return len(live)
+
+    def sweeper(self, interval, path=None):
+        while True:
+            time.sleep(interval)
+            try:
+                self.sweep()
+                if path:
+                    self.save(path)
+            except Exception:
+                traceback.print_exc()
+
+# ================ Bot init ================
+# handlers run on ChatDispatcher workers, not on telebot's own thread pool
+bot = telebot.TeleBot(TOKEN_BOT, threaded=False)
+if API_URL:
+    telebot.apihelper.API_URL = API_URL
+# chat_id -> state dict (flow, stage, temp data); an entry is only ever touched
+# by the dispatcher worker that owns its chat, so no lock is needed per entry
+user_states = StateStore(STATE_MAX_SESSIONS, STATE_TTL)
+
+# every Bot API call goes through apihelper._make_request; time it per method
+_api_request = telebot.apihelper._make_request
+
+def timed_api_request(token, method_name, method='get', params=None, files=None):
+    start = time.perf_counter()
+    try:
+        return _api_request(token, method_name, method, params, files)
+    except ApiTelegramException as e:
+        metrics.inc("bot_api_errors_total", method=method_name, code=e.error_code)
+        raise
+    except Exception:
+        metrics.inc("bot_api_errors_total", method=method_name, code="network")
+        raise
+    finally:
+        metrics.observe("bot_api_seconds", time.perf_counter() - start, method=method_name)
+
+telebot.apihelper._make_request = timed_api_request
+
+# ================ Dispatcher ================
+def update_chat_id(obj):
+    if isinstance(obj, types.Update):
+        obj = (obj.message or obj.edited_message or obj.callback_query
+               or obj.channel_post or obj.edited_channel_post)
+        if obj is None:
+            return 0
+    if isinstance(obj, types.CallbackQuery):
+        return obj.message.chat.id if obj.message else obj.from_user.id
+    return obj.chat.id
+
+class UpdateLedger:
+    """Which updates are handled, for restarts and redeliveries.
+
+    watermark is the highest update_id at or below which every submitted
+    update has finished; it is what storage.save_checkpoint() persists and
+    where polling resumes. Finished ids (and those stored as applied before
+    a restart) sit in a bounded recent set, so a duplicate costs one set
+    lookup in begin(). wait_past() and wait_done() block on `cond`, which
+    is notified whenever an update finishes."""
+
+    def __init__(self, offset=0, applied=(), size=UPDATE_DEDUP_SIZE):
+        self.lock = threading.Lock()
+        self.cond = threading.Condition(self.lock)
+        self.floor = self.watermark = self.highest = offset
+        self.inflight = set()
+        self.heap = []                      # inflight ids; stale entries skipped lazily
+        self.size = size
+        self.order = deque(sorted(applied))
+        self.recent = set(self.order)
+
+    def begin(self, update_id):
+        # False for an update that is done or already being handled
+        with self.lock:
+            if update_id <= self.floor or update_id in self.inflight:
+                return False
+            if update_id in self.recent:
+                # done before a restart: counts as finished, the watermark moves past it
+                self.highest = max(self.highest, update_id)
+                self._advance()
+                return False
+            self.inflight.add(update_id)
+            heapq.heappush(self.heap, update_id)
+            self.highest = max(self.highest, update_id)
+            return True
+
+    def abandon(self, update_id):
+        # never got queued (webhook answered 503; Telegram will resend it)
+        with self.lock:
+            self.inflight.discard(update_id)
+            self._advance()
+
+    def finish(self, update_id):
+        with self.lock:
+            if update_id not in self.inflight:
+                return
+            self.inflight.discard(update_id)
+            self.recent.add(update_id)
+            self.order.append(update_id)
+            while len(self.order) > self.size:
+                self.recent.discard(self.order.popleft())
+            self._advance()
+
+    def _advance(self):
+        while self.heap and self.heap[0] not in self.inflight:
+            heapq.heappop(self.heap)
+        self.watermark = max(self.floor, self.heap[0] - 1 if self.heap else self.highest)
+        self.cond.notify_all()
+
+    def _done(self, update_id):
+        return update_id not in self.inflight and (update_id in self.recent or update_id <= self.watermark)
+
+    def wait_done(self, update_id, timeout):
+        # True once update_id has been handled; False after timeout
+        with self.cond:
+            return self.cond.wait_for(lambda: self._done(update_id), timeout)
+
+    def wait_past(self, watermark, timeout):
+        with self.cond:
+            return self.cond.wait_for(lambda: self.watermark > watermark, timeout)
+
+# every update's fate since the last checkpoint; polling resumes after its watermark
+update_ledger = UpdateLedger(*storage.load_checkpoint())
+
+def checkpoint_loop(interval):
+    saved = update_ledger.watermark
+    while True:
+        time.sleep(interval)
+        try:
+            watermark = update_ledger.watermark
+            if watermark != saved:
+                storage.save_checkpoint(watermark)
+                saved = watermark
+        except Exception:
+            traceback.print_exc()
+
+def poll_from_watermark(tb):
+    # Telegram forgets every update below the offset it is asked for, so the
+    # offset is the ledger's watermark, not the newest id seen: updates still
+    # queued or running are fetched again and dropped by begin() instead of
+    # being lost to a crash. Polling's own offset (last_update_id + 1) is
+    # ignored; TeleBot.process_new_updates() on a worker thread moves
+    # last_update_id past updates other workers have not finished
+    fetch = type(tb).get_updates
+
+    def get_updates(offset=None, *args, **kwargs):
+        return fetch(tb, update_ledger.watermark + 1, *args, **kwargs)
+
+    tb.get_updates = get_updates
+
+def submit_polled(dispatcher, updates, wait=POLL_STALL_WAIT):
+    # every polled page is fetched from the watermark (poll_from_watermark);
+    # to keep re-fetches down, a full page waits until its first half is
+    # done before the next poll, a page with nothing new until anything is
+    watermark = update_ledger.watermark
+    fresh = 0
+    for update in updates:
+        fresh += dispatcher.submit(update)
+    if len(updates) >= CATCH_UP_BATCH:
+        update_ledger.wait_past(updates[len(updates) // 2].update_id - 1, wait)
+    elif updates and not fresh:
+        update_ledger.wait_past(watermark, wait)
+
+def catch_up(dispatcher, batch=CATCH_UP_BATCH):
+    # after a restart: drain what queued up while the bot was down in full
+    # getUpdates pages; normal polling takes over after. telebot turns a long
+    # poll of 0 into its 20 s default, so an empty last page waits 1 s instead.
+    # Each page is asked for from the watermark (see poll_from_watermark):
+    # the handlers move bot.last_update_id past updates still running
+    start = time.perf_counter()
+    total = 0
+    while True:
+        updates = dispatcher.bot.get_updates(offset=update_ledger.watermark + 1, limit=batch,
+                                             long_polling_timeout=1)
+        if updates:
+            dispatcher.submit_updates(updates)
+            total += len(updates)
+        if len(updates) < batch:
+            break
+    if total:
+        print(f"caught up on {total} updates in {time.perf_counter() - start:.1f}s")
+    return total
+
+class ChatDispatcher:
+    """Runs updates from different chats in parallel. Every chat is pinned to
+    one worker queue (chat_id % workers), so its own updates stay in order.
+    Updates pass through update_ledger, which drops duplicates."""
+
+    track = True                        # False: the ingress process keeps the ledger
+
+    def __init__(self, bot, workers, queue_size=DISPATCH_QUEUE_SIZE):
+        self.bot = bot
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in range(workers)]
+        self.threads = []
+        for i, q in enumerate(self.queues):
+            t = threading.Thread(target=self.worker, args=(q,), name=f"dispatch-{i}", daemon=True)
+            t.start()
+            self.threads.append(t)
+
+    def submit(self, update, timeout=None):
+        # blocks while the worker's queue is full; raises queue.Full after timeout.
+        # False for a duplicate, which is dropped
+        if self.track and not update_ledger.begin(update.update_id):
+            metrics.inc("bot_updates_duplicate_total")
+            return False
+        try:
+            self.queues[update_chat_id(update) % len(self.queues)].put(update, timeout=timeout)
+        except queue.Full:
+            if self.track:
+                update_ledger.abandon(update.update_id)
+            raise
+        return True
+
+    def submit_updates(self, updates):
+        submit_polled(self, updates)
+
+    def wait_applied(self, update_id, timeout):
+        return update_ledger.wait_done(update_id, timeout)
+
+    def worker(self, q):
+        while True:
+            update = q.get()
+            if update is None:
+                return
+            try:
+                self.handle(update)
+            except Exception:
+                traceback.print_exc()
+
+    def handle(self, update):
+        handling.update_id = update.update_id
+        try:
+            telebot.TeleBot.process_new_updates(self.bot, [update])
+        finally:
+            handling.update_id = None
+            if self.track:
+                update_ledger.finish(update.update_id)
+
+    def install(self):
+        # polling calls self.process_new_updates(); route it through the queues
+        self.bot.process_new_updates = self.submit_updates
+        poll_from_watermark(self.bot)
+        return self
+
+    def stop(self):
+        for q in self.queues:
+            q.put(None)
+        for t in self.threads:
+            t.join()
+
+# ================ Outbound delivery ================
+class TokenBucket:
+    """Thread-safe token bucket; pause() makes every caller wait (429 retry_after)."""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity or rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_take(self):
+        # returns 0 when a token was taken, otherwise seconds to wait
+        with self.lock:
+            now = time.monotonic()
+            if now < self.paused_until:
+                return self.paused_until - now
+            self._refill(now)
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+    def acquire(self):
+        while True:
+            wait = self.try_take()
+            if not wait:
+                return
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+def retry_after_of(exc):
+    params = (getattr(exc, "result_json", None) or {}).get("parameters") or {}
+    return params.get("retry_after")
+
+PRIO_USER, PRIO_ADMIN, PRIO_BROADCAST = 0, 1, 2
+
+class Outbox:
+    """Central queue for outgoing messages.
+
+    Each chat has its own FIFO, so its messages keep their order; chats
+    whose head message has the best priority are served first. A global
+    token bucket (OUTBOX_GLOBAL_RATE) and a per-chat bucket
+    (OUTBOX_CHAT_RATE) pace the senders, a 429 delays the chat by its
+    retry_after, and other failures are retried up to OUTBOX_MAX_RETRIES.
+    submit() returns a Future with the API result.
+    """
+
+    def __init__(self, bot, senders, global_rate, chat_rate, chat_burst, max_retries):
+        self.bot = bot
+        self.global_bucket = TokenBucket(global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.cond = threading.Condition()
+        self.chats = {}          # chat_id -> deque of pending items
+        self.buckets = {}        # chat_id -> TokenBucket
+        self.ready = []          # heap of (priority, seq, chat_id); one entry per idle chat with work
+        self.delayed = []        # heap of (not_before, seq, chat_id)
+        self.seq = 0
+        self.depth = 0
+        self.sent = self.failed = self.retried = 0
+        self.latencies = deque(maxlen=1000)
+        self.threads = []
+        for i in range(senders):
+            t = threading.Thread(target=self.worker, name=f"outbox-{i}", daemon=True)
+            t.start()
+            self.threads.append(t)
+
+    def submit(self, method, chat_id, *args, priority=PRIO_USER, **kwargs):
+        item = {"method": method, "chat_id": chat_id, "args": args, "kwargs": kwargs,
+                "priority": priority, "future": Future(), "queued": time.monotonic(), "attempts": 0}
+        with self.cond:
+            pending = self.chats.get(chat_id)
+            if pending is None:
+                pending = self.chats[chat_id] = deque()
+            pending.append(item)
+            self.depth += 1
+            if len(pending) == 1:
+                self._schedule(chat_id, item)
+            self.cond.notify()
+        return item["future"]
+
+    def _schedule(self, chat_id, head, not_before=0.0):
+        self.seq += 1
+        if not_before:
+            heapq.heappush(self.delayed, (not_before, self.seq, chat_id))
+        else:
+            heapq.heappush(self.ready, (head["priority"], self.seq, chat_id))
+
+    def _next_chat(self):
+        with self.cond:
+            while True:
+                now = time.monotonic()
+                while self.delayed and self.delayed[0][0] <= now:
+                    _, _, chat_id = heapq.heappop(self.delayed)
+                    self._schedule(chat_id, self.chats[chat_id][0])
+                if self.ready:
+                    return heapq.heappop(self.ready)[2]
+                self.cond.wait(self.delayed[0][0] - now if self.delayed else None)
+
+    def _finish(self, chat_id, not_before=0.0):
+        # head item is done (or must wait): put the chat back in line if needed
+        with self.cond:
+            pending = self.chats[chat_id]
+            if pending:
+                self._schedule(chat_id, pending[0], not_before)
+                self.cond.notify()
+            else:
+                del self.chats[chat_id]
+
+    def _chat_bucket(self, chat_id):
+        # senders share self.buckets; look up and evict under the queue lock
+        with self.cond:
+            bucket = self.buckets.get(chat_id)
+            if bucket is None:
+                if len(self.buckets) > 50000:
+                    # idle buckets are full again; dropping them loses nothing
+                    horizon = time.monotonic() - self.chat_burst / self.chat_rate
+                    for cid in [c for c, b in self.buckets.items() if b.updated < horizon]:
+                        del self.buckets[cid]
+                bucket = self.buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+            return bucket
+
+    def worker(self):
+        while True:
+            chat_id = self._next_chat()
+            item = self.chats[chat_id][0]   # this worker owns the chat until _finish
+            wait = self._chat_bucket(chat_id).try_take()
+            if wait:
+                self._finish(chat_id, time.monotonic() + wait)
+                continue
+            self.global_bucket.acquire()
+            try:
+                result = getattr(self.bot, item["method"])(item["chat_id"], *item["args"], **item["kwargs"])
+            except Exception as e:
+                delay = self._retry_delay(item, e)
+                if delay is not None:
+                    self.retried += 1
+                    self._finish(chat_id, time.monotonic() + delay)
+                    continue
+                self._done(chat_id, item, error=e)
+                continue
+            self._done(chat_id, item, result=result)
+
+    def _retry_delay(self, item, exc):
+        item["attempts"] += 1
+        if item["attempts"] > self.max_retries:
+            return None
+        if isinstance(exc, ApiTelegramException):
+            if exc.error_code == 429:
+                # flood limit: every sender waits, not just this chat,
+                # or the others keep hitting it
+                retry_after = retry_after_of(exc) or 1
+                self.global_bucket.pause(retry_after)
+                return retry_after
+            if exc.error_code < 500:
+                return None           # 400/403: retrying will not help
+        return min(30, 0.5 * 2 ** item["attempts"])
+
+    def _done(self, chat_id, item, result=None, error=None):
+        with self.cond:
+            self.chats[chat_id].popleft()
+            self.depth -= 1
+            if error is None:
+                self.sent += 1
+                self.latencies.append(time.monotonic() - item["queued"])
+            else:
+                self.failed += 1
+        self._finish(chat_id)
+        if error is None:
+            item["future"].set_result(result)
+        else:
+            if item["priority"] != PRIO_BROADCAST:
+                print(f"outbox: {item['method']} to {chat_id} failed: {error}")
+            item["future"].set_exception(error)
+
+    def stats(self):
+        lat = sorted(self.latencies)
+        pick = lambda q: round(lat[min(len(lat) - 1, int(q * len(lat)))], 3) if lat else 0.0
+        return {"depth": self.depth, "chats_waiting": len(self.chats), "sent": self.sent,
+                "failed": self.failed, "retried": self.retried,
+                "latency_p50": pick(0.50), "latency_p95": pick(0.95), "latency_max": lat[-1] if lat else 0.0}
+
+    def drain(self, timeout=10):
+        # on shutdown: give queued replies a chance to go out
+        deadline = time.monotonic() + timeout
+        while self.depth and time.monotonic() < deadline:
+            time.sleep(0.05)
+
+outbox = Outbox(bot, OUTBOX_SENDERS, OUTBOX_GLOBAL_RATE, OUTBOX_CHAT_RATE, OUTBOX_CHAT_BURST, OUTBOX_MAX_RETRIES)
+
+def send_message(chat_id, text, priority=PRIO_USER, **kw):
+    return outbox.submit("send_message", chat_id, text, priority=priority, **kw)
+
+def send_photo(chat_id, photo, priority=PRIO_USER, **kw):
+    return outbox.submit("send_photo", chat_id, photo, priority=priority, **kw)
+
+def send_document(chat_id, document, priority=PRIO_USER, **kw):
+    return outbox.submit("send_document", chat_id, document, priority=priority, **kw)
+
+# ================ Media cache ================
+class MediaCache:
+    """Local media file -> the file_id Telegram gave it, so a file is uploaded
+    once and later sends (creator photo, media broadcasts) only pass the id.
+
+    Entries are keyed by kind and absolute path and keep the file's sha256
+    and (size, mtime): an unchanged stat skips hashing, a changed stat with
+    the same hash keeps the id, new content uploads again. While the first
+    upload of a file is in flight, other sends of it wait for its file_id
+    instead of uploading too. The file belongs to one bot (file_ids are per
+    bot), so it is discarded when the token changes."""
+
+    def __init__(self, path, bot_id):
+        self.path = path
+        self.bot_id = bot_id
+        self.lock = threading.RLock()    # re-entrant: a finished upload's callback may run inside send_media
+        data = load_json(path)
+        self.entries = data.get("entries", {}) if data.get("bot") == bot_id else {}
+        self.uploads = {}        # key -> Future of the upload in flight
+
+    @staticmethod
+    def key(kind, path):
+        return f"{kind}:{os.path.abspath(path)}"
+
+    def save(self):
+        save_json(self.path, {"bot": self.bot_id, "entries": self.entries})
+
+    def lookup(self, key, path):
+        # -> (file_id, None, None) if cached, else (None, data, stamp) to upload; under self.lock
+        st = os.stat(path)
+        stat = [st.st_size, st.st_mtime_ns]
+        entry = self.entries.get(key)
+        if entry and entry["stat"] == stat:
+            return entry["file_id"], None, None
+        with open(path, "rb") as f:
+            data = f.read()
+        digest = hashlib.sha256(data).hexdigest()
+        if entry and entry["sha256"] == digest:
+            entry["stat"] = stat            # touched, not changed
+            self.save()
+            return entry["file_id"], None, None
+        return None, data, (digest, stat)
+
+    def uploaded(self, key, kind, stamp, future):
+        with self.lock:
+            self.uploads.pop(key, None)
+            if future.exception() is not None:
+                return
+            msg = future.result()
+            media = msg.photo[-1] if kind == "photo" else getattr(msg, kind, None)
+            if media is None:
+                return
+            self.entries[key] = {"sha256": stamp[0], "stat": stamp[1], "file_id": media.file_id}
+            self.save()
+
+    def check(self, key, file_id, future):
+        # a 400 on a cached id (file gone on Telegram's side): upload next time
+        exc = future.exception()
+        if isinstance(exc, ApiTelegramException) and exc.error_code == 400:
+            with self.lock:
+                if self.entries.get(key, {}).get("file_id") == file_id:
+                    del self.entries[key]
+                    self.save()
+
+media_cache = MediaCache(MEDIA_CACHE_FILE, TOKEN_BOT.split(":")[0])
+
+def _copy_future(src, dst):
+    if src.exception() is not None:
+        dst.set_exception(src.exception())
+    else:
+        dst.set_result(src.result())
+
+def send_media(chat_id, kind, path, priority=PRIO_USER, **kw):
+    # kind: "photo", "document", "video" or "animation"; path is a local file
+    key = MediaCache.key(kind, path)
+    method = f"send_{kind}"
+    with media_cache.lock:
+        inflight = media_cache.uploads.get(key)
+        if inflight is None:
+            file_id, data, stamp = media_cache.lookup(key, path)
+            if data is not None:
+                future = outbox.submit(method, chat_id, data, priority=priority, **kw)
+                media_cache.uploads[key] = future
+                # registered before anyone can wait on it, so it always runs first
+                future.add_done_callback(lambda f: media_cache.uploaded(key, kind, stamp, f))
+                return future
+    if inflight is not None:
+        # the upload's own callback has stored the id by the time this runs
+        out = Future()
+        inflight.add_done_callback(lambda _: send_media(chat_id, kind, path, priority, **kw)
+                                   .add_done_callback(lambda f: _copy_future(f, out)))
+        return out
+    future = outbox.submit(method, chat_id, file_id, priority=priority, **kw)
+    future.add_done_callback(lambda f: media_cache.check(key, file_id, f))
+    return future
+
+# ================ Admin notifications ================
+class AdminDigest:
+    """Collects new orders and receipts for ADMIN_DIGEST_WINDOW seconds, then
+    sends every admin one text digest with per-item inline buttons (same
+    approve_receipt:/approve_order:/... callback data as before) and one
+    media group with the receipt photos.
+
+    Items are stored (storage.digest_add) with the update that made them and
+    deleted once their messages went out, so a crash in between sends them
+    again rather than never. In cluster mode every worker stores its items
+    in the shared admin_digest table and only worker 0 sends digests
+    (run_shared), so the admins get one digest per window and their chats
+    one sender."""
+
+    def __init__(self, window):
+        self.window = window
+        self.pending = 0                # items added here since the last flush
+        self.sent_upto = 0              # stored items up to this one are with the outbox
+        self.lock = threading.Lock()
+        self.timer = None
+
+    def add(self, text, buttons, photo=None):
+        # buttons: [(label, callback_data)] shown on one row for this item.
+        # Call it inside the update's shared_txn(): the item is stored with
+        # the update's writes, the send is left to a timer
+        storage.digest_add({"text": text, "buttons": buttons, "photo": photo})
+        if storage.shared:
+            return
+        with self.lock:
+            self.pending += 1
+            if self.timer is None:
+                self.timer = threading.Timer(max(self.window, 0), self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def flush(self):
+        # sends the stored items not handed to the outbox yet (in cluster
+        # mode worker 0 only); also what a crash left behind, at startup
+        if storage.shared and CLUSTER_INDEX != 0:
+            return
+        with self.lock:
+            self.timer = None
+            self.pending = 0
+            rows = storage.digest_items(self.sent_upto)
+            if not rows:
+                return
+            after, upto = self.sent_upto, rows[-1][0]
+            self.sent_upto = upto
+            sent = self.send([item for _, item in rows])
+        self.forget_when_sent(sent, after, upto)
+
+    @staticmethod
+    def forget_when_sent(futures, after, upto):
+        # the items go once all their messages are out (or the outbox gave
+        # up on them; not retried here)
+        left = [len(futures)]
+        lock = threading.Lock()
+
+        def done(_):
+            with lock:
+                left[0] -= 1
+                if left[0]:
+                    return
+            storage.digest_done(after, upto)
+
+        if not futures:
+            storage.digest_done(after, upto)
+        for future in futures:
+            future.add_done_callback(done)
+
+    def run_shared(self):
+        # worker 0's digest loop in cluster mode
+        while True:
+            time.sleep(max(self.window, 1))
+            try:
+                self.flush()
+            except Exception:
+                traceback.print_exc()
+
+    def send(self, items):
+        sent = []
+        for i in range(0, len(items), ADMIN_DIGEST_MAX_ITEMS):
+            chunk = items[i:i + ADMIN_DIGEST_MAX_ITEMS]
+            text, markup, media = self.render(chunk)
+            for aid in ADMIN_IDS:
+                if media:
+                    sent += self.send_media(aid, media)
+                sent.append(send_message(aid, text, priority=PRIO_ADMIN, reply_markup=markup))
+        return sent
+
+    @staticmethod
+    def render(items):
+        lines = [f"🔔 {len(items)} مورد جدید:"] if len(items) > 1 else []
+        markup = types.InlineKeyboardMarkup()
+        media = []
+        for n, item in enumerate(items, 1):
+            lines.append(f"{n}. {item['text']}" if len(items) > 1 else item["text"])
+            markup.row(*[types.InlineKeyboardButton(f"{n}. {label}" if len(items) > 1 else label, callback_data=data)
+                         for label, data in item["buttons"]])
+            if item["photo"]:
+                media.append(types.InputMediaPhoto(item["photo"], caption=f"{n}" if len(items) > 1 else None))
+        return "\n\n".join(lines), markup.to_json(), media
+
+    @staticmethod
+    def send_media(aid, media):
+        if len(media) == 1:
+            return [send_photo(aid, media[0].media, priority=PRIO_ADMIN, caption=media[0].caption)]
+        sent = []
+        for i in range(0, len(media), 10):   # Telegram takes 2-10 items per group
+            group = media[i:i + 10]
+            if len(group) == 1:
+                sent.append(send_photo(aid, group[0].media, priority=PRIO_ADMIN, caption=group[0].caption))
+            else:
+                sent.append(outbox.submit("send_media_group", aid, group, priority=PRIO_ADMIN))
+        return sent
+
+admin_digest = AdminDigest(ADMIN_DIGEST_WINDOW)
+
+def drop_item_buttons(call, item_id):
+    # after a decision, strip that item's buttons from a digest keyboard
+    markup = call.message.reply_markup if call.message else None
+    if not markup:
+        return
+    rows = [[b.to_dict() for b in row if item_id not in (b.callback_data or "")] for row in markup.keyboard]
+    rows = [row for row in rows if row]
+    try:
+        bot.edit_message_reply_markup(call.message.chat.id, call.message.message_id,
+                                      reply_markup=json.dumps({"inline_keyboard": rows}))
+    except Exception:
+        pass
+
+# ================ Broadcast engine ================
+broadcast_bucket = TokenBucket(BROADCAST_RATE)
+broadcast_jobs = {}                 # job_id -> job dict, persisted in BROADCAST_JOBS_FILE
+broadcast_jobs_lock = threading.Lock()
+
+def save_broadcast_jobs():
+    with broadcast_jobs_lock:
+        save_json(BROADCAST_JOBS_FILE, {k: dict(v) for k, v in broadcast_jobs.items()})
+
+def broadcast_deliver(uid, text):
+    # -> "sent" | "blocked" | "failed"; retries and 429 waits happen in the outbox
+    broadcast_bucket.acquire()
+    try:
+        send_message(uid, text, priority=PRIO_BROADCAST).result()
+        return "sent"
+    except ApiTelegramException as e:
+        return "blocked" if e.error_code == 403 else "failed"
+    except Exception:
+        return "failed"
+
+def broadcast_progress(job, final=False):
+    head = "✅ ارسال تمام شد" if final else "📣 در حال ارسال..."
+    txt = (f"{head}\n{job['done']}/{job['total']}\n"
+           f"موفق: {job['sent']} / ناموفق: {job['failed']} / مسدود: {job['blocked']}")
+    try:
+        if job.get("progress_msg"):
+            bot.edit_message_text(txt, chat_id=job["admin"], message_id=job["progress_msg"])
+        else:
+            job["progress_msg"] = send_message(job["admin"], txt, priority=PRIO_ADMIN).result().message_id
+    except Exception:
+        pass
+
+def run_broadcast(job):
+    # recipients are walked in user-id order; "cursor" is the last id whose
+    # batch fully completed, so a restart re-sends at most one batch
+    text = f"📣 Broadcast:\n\n{job['text']}"
+    cursor = job.get("cursor")
+    uids = storage.user_ids() if storage.shared else list(users_db.keys())
+    recipients = sorted(int(uid) for uid in uids)
+    if cursor is not None:
+        recipients = [uid for uid in recipients if uid > cursor]
+    job["total"] = job["done"] + len(recipients)
+    last_progress = 0
+    with ThreadPoolExecutor(max_workers=BROADCAST_WORKERS) as pool:
+        for i in range(0, len(recipients), BROADCAST_BATCH):
+            batch = recipients[i:i + BROADCAST_BATCH]
+            for result in pool.map(lambda uid: broadcast_deliver(uid, text), batch):
+                job[result] += 1
+            job["done"] += len(batch)
+            job["cursor"] = batch[-1]
+            save_broadcast_jobs()
+            if time.monotonic() - last_progress >= BROADCAST_PROGRESS_EVERY:
+                last_progress = time.monotonic()
+                broadcast_progress(job)
+    entry = {"job_id": job["job_id"], "admin": job["admin"], "text": job["text"], "time": job["time"],
+             "finished": datetime.utcnow().isoformat(), "total": job["total"],
+             "sent": job["sent"], "failed": job["failed"], "blocked": job["blocked"]}
+    broadcast_db.append(entry)
+    storage.add_broadcast(entry)
+    with broadcast_jobs_lock:
+        broadcast_jobs.pop(job["job_id"], None)
+    save_broadcast_jobs()
+    broadcast_progress(job, final=True)
+
+def start_broadcast_thread(job):
+    def target():
+        try:
+            run_broadcast(job)
+        except Exception:
+            traceback.print_exc()
+    threading.Thread(target=target, name=f"broadcast-{job['job_id']}", daemon=True).start()
+
+def start_broadcast(admin_id, text):
+    job = {"job_id": gen_order_id("BC"), "admin": admin_id, "text": text,
+           "time": datetime.utcnow().isoformat(), "cursor": None, "done": 0, "total": 0,
+           "sent": 0, "failed": 0, "blocked": 0, "progress_msg": None}
+    with broadcast_jobs_lock:
+        broadcast_jobs[job["job_id"]] = job
+    save_broadcast_jobs()
+    start_broadcast_thread(job)
+    return job
+
+def resume_broadcasts():
+    # pick up jobs interrupted by a restart, continuing after their cursor
+    pending = load_json(BROADCAST_JOBS_FILE) or {}
+    for job_id, job in pending.items():
+        with broadcast_jobs_lock:
+            broadcast_jobs[job_id] = job
+        start_broadcast_thread(job)
+    return len(pending)
+
+# ================ Markups/UI ================
+LANGS = ("fa", "en", "ar")
+
+class KeyboardRegistry:
+    """Builds each static keyboard once per language and keeps its JSON.
+
+    telebot passes a str reply_markup through unchanged, so handlers reuse the
+    cached JSON without building or serializing a markup per message. A
+    keyboard registered with a `version` callable is rebuilt when the value
+    it returns changes (e.g. the country list).
+    """
+
+    def __init__(self):
+        self.builders = {}
+        self.versions = {}
+        self.cache = {}          # (name, lang) -> (version, json)
+
+    def register(self, name, version=None):
+        def deco(builder):
+            self.builders[name] = builder
+            if version is not None:
+                self.versions[name] = version
+            return builder
+        return deco
+
+    def get(self, name, lang="fa"):
+        version = self.versions[name]() if name in self.versions else None
+        hit = self.cache.get((name, lang))
+        if hit is not None and hit[0] == version:
+            return hit[1]
+        js = self.builders[name](lang).to_json()
+        self.cache[(name, lang)] = (version, js)
+        return js
+
+    def invalidate(self, name=None):
+        for key in [k for k in self.cache if name is None or k[0] == name]:
+            self.cache.pop(key, None)
+
+    def warm(self, langs=LANGS):
+        for name in self.builders:
+            for lang in langs:
+                self.get(name, lang)
+
+keyboards = KeyboardRegistry()
+
+@keyboards.register("main_menu")
+def _main_menu_kb(lang):
+    kb = types.ReplyKeyboardMarkup(resize_keyboard=True, row_width=2)
+    kb.add(types.KeyboardButton("📱 خرید شماره مجازی"), types.KeyboardButton("⭐ خرید استارز"))
+    kb.add(types.KeyboardButton("🧾 سبد خرید"), types.KeyboardButton("💳 کیف‌پول / شارژ"))
+    kb.add(types.KeyboardButton("👤 پروفایل"), types.KeyboardButton("ℹ️ درباره ما"))
+    kb.add(types.KeyboardButton("🛠 پشتیبانی"), types.KeyboardButton("🌐 تغییر زبان"))
+    kb.add(types.KeyboardButton("👨‍💻 سازنده"), types.KeyboardButton("📣 خبر/اعلان"))
+    return kb
+
+@keyboards.register("country_choice", version=lambda: tuple(COUNTRIES.items()))
+def _country_choice_kb(lang):
+    kb = types.ReplyKeyboardMarkup(resize_keyboard=True, row_width=1)
+    for c, p in COUNTRIES.items():
+        kb.add(types.KeyboardButton(f"{c} — {p:,}"))
+    kb.add(types.KeyboardButton("🔙 بازگشت"))
+    return kb
+
+@keyboards.register("qty")
+def _qty_kb(lang):
+    kb = types.ReplyKeyboardMarkup(resize_keyboard=True)
+    kb.add(types.KeyboardButton("1"), types.KeyboardButton("2"), types.KeyboardButton("3"))
+    kb.add(types.KeyboardButton("🔙 بازگشت"))
+    return kb
+
+@keyboards.register("confirm_yesno")
+def _confirm_yesno_kb(lang):
+    kb = types.ReplyKeyboardMarkup(resize_keyboard=True)
+    # localized labels:
+    yes = {"fa":"✅ تایید سفارش","en":"✅ Confirm Order","ar":"✅ تأكيد"}[lang if lang in ["fa","en","ar"] else "fa"]
+    no = {"fa":"❌ لغو","en":"❌ Cancel","ar":"❌ إلغاء"}[lang if lang in ["fa","en","ar"] else "fa"]
+    kb.add(types.KeyboardButton(yes), types.KeyboardButton(no))
+    return kb
+
+@keyboards.register("contact_request")
+def _contact_request_kb(lang):
+    kb = types.ReplyKeyboardMarkup(one_time_keyboard=True, resize_keyboard=True)
+    labels = {"fa":"📲 ارسال شماره من","en":"📲 Send my contact","ar":"📲 إرسال رقمي"}
+    kb.add(types.KeyboardButton(labels.get(lang,"📲 ارسال شماره من"), request_contact=True))
+    kb.add(types.KeyboardButton({"fa":"❌ انصراف","en":"❌ Cancel","ar":"❌ إلغاء"}.get(lang, "❌ انصراف")))
+    return kb
+
+@keyboards.register("lang_choice")
+def _lang_choice_kb(lang):
+    kb = types.ReplyKeyboardMarkup(resize_keyboard=True)
+    kb.add(types.KeyboardButton("🇮🇷 فارسی"), types.KeyboardButton("🇬🇧 English"), types.KeyboardButton("🇸🇦 العربية"))
+    kb.add(types.KeyboardButton("🔙 بازگشت"))
+    return kb
+
+@keyboards.register("shop_type")
+def _shop_type_kb(lang):
+    kb = types.ReplyKeyboardMarkup(resize_keyboard=True, row_width=2)
+    kb.add(types.KeyboardButton("📱 شماره مجازی"), types.KeyboardButton("⭐ استارز"))
+    kb.add(types.KeyboardButton("🧾 مشاهده سبد"), types.KeyboardButton("🔙 بازگشت"))
+    return kb
+
+@keyboards.register("cart_added")
+def _cart_added_kb(lang):
+    return types.ReplyKeyboardMarkup(resize_keyboard=True).add(types.KeyboardButton("📱 ادامه خرید"), types.KeyboardButton("🧾 مشاهده سبد"), types.KeyboardButton("🔙 بازگشت"))
+
+@keyboards.register("cart_review")
+def _cart_review_kb(lang):
+    kb = types.ReplyKeyboardMarkup(resize_keyboard=True)
+    kb.add(types.KeyboardButton("✅ نهایی‌سازی و پرداخت"), types.KeyboardButton("❌ خالی‌سازی سبد"))
+    kb.add(types.KeyboardButton("🔙 بازگشت"))
+    return kb
+
+@keyboards.register("checkout_pay")
+def _checkout_pay_kb(lang):
+    kb = types.ReplyKeyboardMarkup(resize_keyboard=True)
+    kb.add(types.KeyboardButton("💳 پرداخت با کیف‌پول"), types.KeyboardButton("📤 ارسال رسید و پرداخت دستی"))
+    kb.add(types.KeyboardButton("🔙 بازگشت"))
+    return kb
+
+@keyboards.register("wallet_menu")
+def _wallet_menu_kb(lang):
+    return types.ReplyKeyboardMarkup(resize_keyboard=True).add(types.KeyboardButton("⬆️ شارژ کیف‌پول"), types.KeyboardButton("💰 مشاهده موجودی"), types.KeyboardButton("🔙 بازگشت"))
+
+@keyboards.register("wallet_amounts")
+def _wallet_amounts_kb(lang):
+    kb = types.ReplyKeyboardMarkup(resize_keyboard=True)
+    kb.add(types.KeyboardButton("50,000"), types.KeyboardButton("100,000"), types.KeyboardButton("150,000"))
+    kb.add(types.KeyboardButton("🔙 بازگشت"))
+    return kb
+
+@keyboards.register("profile_menu")
+def _profile_menu_kb(lang):
+    kb = types.ReplyKeyboardMarkup(resize_keyboard=True)
+    kb.add(types.KeyboardButton("✏️ ویرایش پروفایل"), types.KeyboardButton("🌐 تغییر زبان"))
+    kb.add(types.KeyboardButton("🔙 بازگشت"))
+    return kb
+
+@keyboards.register("remove")
+def _remove_kb(lang):
+    return types.ReplyKeyboardRemove()
+
+def main_menu_markup(chat_id):
+    return keyboards.get("main_menu")
+
+def country_choice_markup(chat_id):
+    return keyboards.get("country_choice")
+
+def qty_kb():
+    return keyboards.get("qty")
+
+def confirm_yesno_markup(chat_id):
+    return keyboards.get("confirm_yesno", user_lang(chat_id))
+
+def contact_request_kb(lang="fa"):
+    return keyboards.get("contact_request", lang)
+
+def remove_kb():
+    return keyboards.get("remove")
+
+# ================ Profiling ================
+# threads parked in these modules are waiting, not working
+IDLE_MODULES = ("threading.py", "queue.py", "selectors.py", "socket.py", "socketserver.py", "ssl.py")
+
+def approx_size(container, sample=200):
+    # container plus an average of a sample of its entries, scaled up; only
+    # what is in memory counts for a LazyHistory
+    if isinstance(container, LazyHistory):
+        container = container.in_memory()
+    values = container.values() if isinstance(container, dict) else container
+    picked = [v for _, v in zip(range(sample), values)]
+    if not picked:
+        return sys.getsizeof(container)
+    def entry_size(v):
+        if isinstance(v, UserRecord):
+            return sys.getsizeof(v) + sum(sys.getsizeof(getattr(v, k)) for k in UserRecord.__slots__ if hasattr(v, k))
+        if isinstance(v, dict):
+            return sys.getsizeof(v) + sum(sys.getsizeof(x) for x in v.values())
+        return sys.getsizeof(v)
+    per_item = sum(entry_size(v) for v in picked) / len(picked)
+    return int(sys.getsizeof(container) + per_item * len(container))
+
+def structure_sizes():
+    return {
+        "users_db": (len(users_db), approx_size(users_db)),
+        "orders_db": (len(orders_db.in_memory()), approx_size(orders_db)),
+        "receipts_db": (len(receipts_db.in_memory()), approx_size(receipts_db)),
+        "user_states": (len(user_states), user_states.stats().get("approx_bytes", 0)),
+    }
+
+class SamplingProfiler:
+    """Live profiler for /profile. Every PROFILE_SAMPLE_INTERVAL it reads the
+    stacks of all threads with sys._current_frames() (cProfile would only see
+    its own thread) and counts, per function, samples on top of the stack
+    (self) and anywhere in it (cumulative). Optionally diffs tracemalloc
+    snapshots and the sizes of the main in-memory structures."""
+
+    def __init__(self, interval=PROFILE_SAMPLE_INTERVAL):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.running = False
+
+    def start(self, seconds, memory, done):
+        # runs in the background; done(report_text) when finished
+        with self.lock:
+            if self.running:
+                return False
+            self.running = True
+        threading.Thread(target=self._run, args=(seconds, memory, done), name="profiler", daemon=True).start()
+        return True
+
+    def _run(self, seconds, memory, done):
+        try:
+            report = self.profile(seconds, memory)
+        except Exception:
+            report = "profile failed:\n" + traceback.format_exc()
+        finally:
+            with self.lock:
+                self.running = False
+        done(report)
+
+    def profile(self, seconds, memory=False):
+        me = threading.get_ident()
+        cum, own, threads = {}, {}, {}
+        samples = busy = 0
+        started_tracing = memory and not tracemalloc.is_tracing()
+        if started_tracing:
+            tracemalloc.start()
+        mem_before = tracemalloc.take_snapshot() if memory else None
+        sizes_before = structure_sizes() if memory else None
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            names = {t.ident: t.name.rstrip("0123456789").rstrip("-") or t.name for t in threading.enumerate()}
+            for tid, frame in sys._current_frames().items():
+                if tid == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append((code.co_name, code.co_filename, code.co_firstlineno))
+                    frame = frame.f_back
+                group = threads.setdefault(names.get(tid, "?"), [0, 0])
+                group[0] += 1
+                samples += 1
+                if stack[0][1].endswith(IDLE_MODULES):
+                    continue
+                group[1] += 1
+                busy += 1
+                own[stack[0]] = own.get(stack[0], 0) + 1
+                for key in set(stack):
+                    cum[key] = cum.get(key, 0) + 1
+            time.sleep(self.interval)
+        lines = [f"profile: {seconds}s, interval {self.interval * 1000:g}ms, {samples} thread samples, {busy} busy",
+                 "", "threads (busy / all samples):"]
+        for name, (total, working) in sorted(threads.items(), key=lambda kv: -kv[1][1]):
+            lines.append(f"  {name}: {working} / {total}")
+        for title, table in (("top by cumulative (busy samples)", cum), ("top by self (busy samples)", own)):
+            lines += ["", title + ":", "   cum%   self%  function"]
+            for key, _ in sorted(table.items(), key=lambda kv: -kv[1])[:PROFILE_TOP]:
+                name, filename, line = key
+                lines.append(f"  {100 * cum.get(key, 0) / max(busy, 1):5.1f}  {100 * own.get(key, 0) / max(busy, 1):5.1f}  "
+                             f"{name} ({os.path.basename(filename)}:{line})")
+        if memory:
+            mem_after = tracemalloc.take_snapshot()
+            sizes_after = structure_sizes()
+            if started_tracing:
+                tracemalloc.stop()
+            lines += ["", "structures (entries, ~bytes): before -> after"]
+            for name, (n0, b0) in sizes_before.items():
+                n1, b1 = sizes_after[name]
+                lines.append(f"  {name}: {n0:,} / {b0:,} -> {n1:,} / {b1:,} ({b1 - b0:+,} bytes)")
+            lines += ["", "allocation growth by line (tracemalloc):"]
+            for stat in mem_after.compare_to(mem_before, "lineno")[:PROFILE_TOP // 2]:
+                lines.append(f"  {stat}")
+        return "\n".join(lines) + "\n"
+
+profiler = SamplingProfiler()
+
+# ================ Handlers ================
+@bot.message_handler(commands=["start","help"])
+@metrics.timed("bot_handler", handler="start")
+def cmd_start(m):
+    chat_id = m.chat.id
+    prof = user_profile(chat_id)
+    send_message(chat_id, get_msg(chat_id,"welcome"))
+    send_message(chat_id, get_msg(chat_id,"menu"), reply_markup=main_menu_markup(chat_id))
+
+@bot.message_handler(commands=["stats"])
+@metrics.timed("bot_handler", handler="stats")
+def cmd_stats(m):
+    chat_id = m.chat.id
+    if chat_id not in ADMIN_IDS:
+        send_message(chat_id, "فقط ادمین.", reply_markup=main_menu_markup(chat_id))
+        return
+    send_message(chat_id, stats_text(), priority=PRIO_ADMIN)
+
+@bot.message_handler(commands=["report"])
+@metrics.timed("bot_handler", handler="report")
+def cmd_report(m):
+    # /report [days] | /report rebuild
+    chat_id = m.chat.id
+    if chat_id not in ADMIN_IDS:
+        send_message(chat_id, "فقط ادمین.", reply_markup=main_menu_markup(chat_id))
+        return
+    args = (m.text or "").split()[1:]
+    if args[:1] == ["rebuild"]:
+        rebuild_analytics()
+        args = [a for a in args if a != "rebuild"]
+    else:
+        ensure_analytics()
+    days = max(1, min(int(args[0]), 366)) if args and args[0].isdigit() else REPORT_DAYS
+    send_message(chat_id, report_text(days), priority=PRIO_ADMIN)
+
+@bot.message_handler(commands=["profile"])
+@metrics.timed("bot_handler", handler="profile")
+def cmd_profile(m):
+    # /profile [seconds] [mem]
+    chat_id = m.chat.id
+    if chat_id not in ADMIN_IDS:
+        send_message(chat_id, "فقط ادمین.", reply_markup=main_menu_markup(chat_id))
+        return
+    args = (m.text or "").split()[1:]
+    try:
+        seconds = int(args[0]) if args else 30
+        if not 1 <= seconds <= PROFILE_MAX_SECONDS:
+            raise ValueError()
+    except ValueError:
+        send_message(chat_id, f"استفاده: /profile [1-{PROFILE_MAX_SECONDS}] [mem]", priority=PRIO_ADMIN)
+        return
+    memory = "mem" in args[1:]
+
+    def done(report):
+        name = f"profile-{datetime.utcnow().strftime('%y%m%d-%H%M%S')}.txt"
+        send_document(chat_id, report.encode("utf-8"), priority=PRIO_ADMIN,
+                      visible_file_name=name, caption=report.split("\n", 1)[0])
+
+    if not profiler.start(seconds, memory, done):
+        send_message(chat_id, "یک پروفایل دیگر در حال اجراست.", priority=PRIO_ADMIN)
+        return
+    send_message(chat_id, f"پروفایل {seconds} ثانیه‌ای شروع شد{' (با حافظه)' if memory else ''}؛ گزارش به صورت فایل ارسال می‌شود.",
+                 priority=PRIO_ADMIN)
+
+# ---- text dispatch tables ----
+# Every text message goes through router(): one dict lookup for buttons that
+# work everywhere, then one for the conversation state (flow, stage) and one
+# for the exact button text inside that state.
+global_buttons = {}   # exact text -> action, wins over any state
+state_buttons = {}    # (flow, stage) -> {exact button text: action}; None = no state
+state_handlers = {}   # (flow, stage) -> action for any other text; flow None = any flow
+
+def on_global(*texts):
+    def deco(fn):
+        for t in texts:
+            global_buttons[t] = fn
+        return fn
+    return deco
+
+def on_button(key, *texts):
+    def deco(fn):
+        table = state_buttons.setdefault(key, {})
+        for t in texts:
+            table[t] = fn
+        return fn
+    return deco
+
+def on_text(key):
+    def deco(fn):
+        state_handlers[key] = fn
+        return fn
+    return deco
+
+# handle quick menu choices and stateful flows
+@bot.message_handler(content_types=['text'])
+def router(m):
+    chat_id = m.chat.id
+    text = (m.text or "").strip()
+    action = global_buttons.get(text) or global_buttons.get(text.lower())
+    if action:
+        with metrics.timer("bot_handler", handler=action.__name__, flow="-", stage="-"):
+            return action(chat_id, text, None)
+    state = user_states.get(chat_id)
+    key = (state.get("flow"), state.get("stage")) if state else None
+    buttons = state_buttons.get(key)
+    action = (buttons and buttons.get(text)) or state_handlers.get(key)
+    if action is None and state:
+        action = state_handlers.get((None, key[1]))
+    if action is None:
+        action = menu_fallback if not state else unknown_command
+    with metrics.timer("bot_handler", handler=action.__name__,
+                       flow=key[0] if key else "-", stage=key[1] if key else "-"):
+        action(chat_id, text, state)
+
+def menu_fallback(chat_id, text, state):
+    send_message(chat_id, "از منو انتخاب کن:", reply_markup=main_menu_markup(chat_id))
+
+def unknown_command(chat_id, text, state):
+    send_message(chat_id, "دستور نامشخص — از منو استفاده کن.", reply_markup=main_menu_markup(chat_id))
+
+def back_to_menu(chat_id, text, state, note="بازگشت."):
+    user_states.pop(chat_id, None)
+    send_message(chat_id, note, reply_markup=main_menu_markup(chat_id))
+
+def back_to_shop(chat_id, text, state):
+    user_states.get_or_create(chat_id, state)["stage"]="choose_type"
+    send_message(chat_id, "بازگشت.", reply_markup=main_menu_markup(chat_id))
+
+# ---- buttons available everywhere ----
+@on_global('👨‍💻 سازنده', 'creator', 'developer')
+def creator_handler(chat_id, text, state):
+    # مسیر عکس سازنده (فایل logo.jpg باید کنار فایل اصلی بات باشه)
+    photo_path = "logo.jpg"  # اسم فایل رو هرچی خواستی بذار، مثلاً "creator.jpg"
+
+    caption = (
+        "✨ این ربات با عشق ساخته شده توسط [@Eryone0101](https://t.me/Eryone0101)\n\n"
+        "📞 برای سفارش بات مشابه یا شخصی‌سازی، به من پیام بده 🌟"
+    )
+
+    markup = types.InlineKeyboardMarkup()
+    markup.add(
+        types.InlineKeyboardButton("👨‍💻 مشاهده پروفایل سازنده", url="https://t.me/Eryone0101"),
+        types.InlineKeyboardButton("📩 تماس با سازنده", url="https://t.me/Eryone0101")
+    )
+
+    # اگر عکس وجود داشت، با عکس بفرست
+    if os.path.exists(photo_path):
+        # uploaded once; later presses send the cached file_id
+        send_media(chat_id, "photo", photo_path, caption=caption, parse_mode="Markdown", reply_markup=markup)
+    else:
+        # اگر عکس نبود فقط پیام متنی ارسال کن
+        send_message(chat_id, caption, parse_mode="Markdown", reply_markup=markup)
+
+@on_global("🌐 تغییر زبان")
+def choose_lang(chat_id, text, state):
+    user_states[chat_id] = {"flow":"profile_edit","stage":"await_lang"}
+    send_message(chat_id, "زبان را انتخاب کن:", reply_markup=keyboards.get("lang_choice"))
+
+@on_global("ℹ️ درباره ما")
+def about(chat_id, text, state):
+    send_message(chat_id, "🤖 این بات نسخهٔ پیشرفته است. برای پشتیبانی «🛠 پشتیبانی» را انتخاب کن.", reply_markup=main_menu_markup(chat_id))
+
+@on_global("🛠 پشتیبانی")
+def support_start(chat_id, text, state):
+    user_states[chat_id] = {"flow":"support","stage":"await_msg"}
+    send_message(chat_id, get_msg(chat_id,"support_prompt"), reply_markup=remove_kb())
+
+@on_global("📣 خبر/اعلان")
+def broadcast_info(chat_id, text, state):
+    if chat_id not in ADMIN_IDS:
+        send_message(chat_id, "فقط ادمین می‌تواند پیام بفرستد.", reply_markup=main_menu_markup(chat_id))
+        return
+    user_states[chat_id] = {"flow":"broadcast","stage":"await_broadcast"}
+    send_message(chat_id, "متن پیامی که می‌خواهی برای همه ارسال کنی را ارسال کن:", reply_markup=remove_kb())
+
+@on_global("📱 خرید شماره مجازی")
+def start_virtual(chat_id, text, state):
+    user_states[chat_id] = {"flow":"shop","stage":"choose_type","cart": []}
+    send_message(chat_id, "خرید: شماره یا استارز را انتخاب کن:", reply_markup=keyboards.get("shop_type"))
+
+# ---- admin broadcast / support ----
+@on_text(("broadcast", "await_broadcast"))
+def broadcast_text(chat_id, text, state):
+    if chat_id in ADMIN_IDS:
+        job = start_broadcast(chat_id, text)
+        send_message(chat_id, f"ارسال همگانی شروع شد ({job['job_id']}). پیشرفت همین‌جا نمایش داده می‌شود.", reply_markup=main_menu_markup(chat_id))
+        user_states.pop(chat_id, None)
+    else:
+        send_message(chat_id, "دسترسی ندارید.", reply_markup=main_menu_markup(chat_id))
+
+@on_text(("support", "await_msg"))
+def support_text(chat_id, text, state):
+    user_states.pop(chat_id, None)
+    text_msg = text
+    # forward to support and admins; a cluster worker leaves admin chats to
+    # worker 0 (through the digest)
+    if storage.shared:
+        admin_digest.add(f"[Support] From {chat_id}:\n{text_msg}", [])
+    else:
+        send_message(SUPPORT_ID, f"[Support] From {chat_id}:\n{text_msg}", priority=PRIO_ADMIN)
+        for aid in ADMIN_IDS:
+            if aid == SUPPORT_ID: continue
+            send_message(aid, f"[Support] From {chat_id}:\n{text_msg}", priority=PRIO_ADMIN)
+    send_message(chat_id, get_msg(chat_id,"support_sent"), reply_markup=main_menu_markup(chat_id))
+
+# ---- main menu (no active state) ----
+@on_button(None, "💳 کیف‌پول / شارژ", "کیف‌پول", "💳 کیف‌پول")
+def wallet_menu(chat_id, text, state):
+    user_states[chat_id] = {"flow":"wallet","stage":"menu"}
+    send_message(chat_id, "💼 منوی کیف پول:", reply_markup=keyboards.get("wallet_menu"))
+
+@on_button(None, "👤 پروفایل", "پروفایل")
+def show_profile(chat_id, text, state):
+    prof = user_profile(chat_id)
+    txt = (
+        f"👤 پروفایل شما:\n"
+        f"نام: {prof.get('first_name','(ثبت نشده)')}\n"
+        f"نام خانوادگی: {prof.get('last_name','(ثبت نشده)')}\n"
+        f"شماره: {prof.get('phone','(ثبت نشده)')}\n"
+        f"زبان: {prof.get('lang')}\n"
+        f"موجودی: {prof.get('wallet',0):,} تومان\n"
+        f"امتیاز: {prof.get('points',0)}\n"
+        f"سطح: {'VIP' if prof.get('vip') else 'Regular'}\n"
+    )
+    send_message(chat_id, txt, reply_markup=keyboards.get("profile_menu"))
+
+@on_button(None, "⭐ خرید استارز", "خرید استارز", "استارز")
+def start_stars(chat_id, text, state):
+    user_states[chat_id] = {"flow":"shop","stage":"choose_stars","cart": []}
+    send_message(chat_id, "چند ستارز می‌خواهی؟ (حداقل {})".format(1), reply_markup=remove_kb())
+
+# --- wallet flow ---
+@on_button(("wallet", "menu"), "⬆️ شارژ کیف‌پول")
+def wallet_topup(chat_id, text, state):
+    user_states.get_or_create(chat_id, state)["stage"]="choose_amount"
+    send_message(chat_id, "مبلغ را انتخاب کن (تومان):", reply_markup=keyboards.get("wallet_amounts"))
+
+@on_button(("wallet", "menu"), "💰 مشاهده موجودی")
+def wallet_balance(chat_id, text, state):
+    prof = user_profile(chat_id)
+    send_message(chat_id, get_msg(chat_id,"wallet_balance", amount=prof.get("wallet",0)), reply_markup=main_menu_markup(chat_id))
+    user_states.pop(chat_id, None)
+
+on_button(("wallet", "choose_amount"), "🔙 بازگشت")(back_to_menu)
+
+@on_text(("wallet", "choose_amount"))
+def wallet_amount(chat_id, text, state):
+    # parse number
+    try:
+        amt = int(text.replace(",","").strip())
+    except Exception:
+        send_message(chat_id, "مقدار نامعتبر. یکی از گزینه‌ها را انتخاب کن.")
+        return
+    user_states.get_or_create(chat_id, state).update({"stage":"await_receipt","charge_amount":amt})
+    send_message(chat_id, get_msg(chat_id,"send_receipt"), reply_markup=remove_kb())
+
+# --- shop flow (numbers & stars & cart) ---
+# choosing between number or stars initially
+@on_button(("shop", "choose_type"), "📱 شماره مجازی", "شماره مجازی", "📱")
+def shop_numbers(chat_id, text, state):
+    user_states.get_or_create(chat_id, state)["stage"]="choose_country"
+    send_message(chat_id, get_msg(chat_id,"choose_country"), reply_markup=country_choice_markup(chat_id))
+
+@on_button(("shop", "choose_type"), "⭐ استارز", "استارز", "⭐")
+def shop_stars(chat_id, text, state):
+    user_states.get_or_create(chat_id, state)["stage"]="choose_stars"
+    send_message(chat_id, "چند استارز می‌خواهی؟ (مثال: 100)", reply_markup=remove_kb())
+
+@on_button(("shop", "choose_type"), "🧾 مشاهده سبد", "سبد", "🧾 سبد خرید")
+def shop_view_cart(chat_id, text, state):
+    cart = state.get("cart", [])
+    if not cart:
+        send_message(chat_id, get_msg(chat_id, "cart_empty"), reply_markup=main_menu_markup(chat_id))
+        user_states.pop(chat_id,None)
+        return
+    summary, total = user_cart_summary(cart)
+    send_message(chat_id, get_msg(chat_id,"view_cart", summary=summary, total=total), reply_markup=keyboards.get("cart_review"))
+    user_states.get_or_create(chat_id, state)["stage"]="cart_review"
+
+@on_button(("shop", "choose_type"), "🔙 بازگشت")
+def shop_exit(chat_id, text, state):
+    back_to_menu(chat_id, text, state, "بازگشت به منوی اصلی.")
+
+# choose_country stage: select a country to add number(s)
+on_button(("shop", "choose_country"), "🔙 بازگشت")(back_to_shop)
+
+_country_index = (None, {})
+
+def country_from_text(text):
+    # exact keyboard label first; typed text falls back to the prefix match
+    global _country_index
+    version = tuple(COUNTRIES.items())
+    if _country_index[0] != version:
+        _country_index = (version, {f"{c} — {p:,}": c for c, p in COUNTRIES.items()})
+    selected = _country_index[1].get(text)
+    if selected:
+        return selected
+    for label in COUNTRIES.keys():
+        if text.startswith(label):
+            return label
+    return None
+
+@on_text(("shop", "choose_country"))
+def shop_country(chat_id, text, state):
+    selected = country_from_text(text)
+    if not selected:
+        send_message(chat_id, "لطفاً از دکمه‌ها یک کشور انتخاب کن.", reply_markup=country_choice_markup(chat_id))
+        return
+    # ask quantity
+    user_states.get_or_create(chat_id, state).update({"stage":"choose_qty","pending_country":selected,"pending_price":COUNTRIES[selected]})
+    send_message(chat_id, f"{selected} انتخاب شد. قیمت هر شماره: {COUNTRIES[selected]:,}\n{get_msg(chat_id,'enter_qty')}", reply_markup=qty_kb())
+
+@on_button(("shop", "choose_qty"), "🔙 بازگشت")
+def shop_qty_back(chat_id, text, state):
+    user_states.get_or_create(chat_id, state)["stage"]="choose_country"
+    send_message(chat_id, get_msg(chat_id,"choose_country"), reply_markup=country_choice_markup(chat_id))
+
+@on_text(("shop", "choose_qty"))
+def shop_qty(chat_id, text, state):
+    try:
+        qty = int(text)
+        if qty <= 0:
+            raise ValueError()
+    except Exception:
+        send_message(chat_id, get_msg(chat_id,"invalid_code"))
+        return
+    cart = state.get("cart", [])
+    country = state.get("pending_country")
+    price = state.get("pending_price")
+    # add to cart: allow multiple items of same country by appending
+    cart.append({"kind":"number","country":country,"price":price,"qty":qty})
+    st = user_states.get_or_create(chat_id, state)
+    st["cart"] = cart
+    send_message(chat_id, get_msg(chat_id,"cart_added"), reply_markup=keyboards.get("cart_added"))
+    st["stage"]="choose_type"
+
+# choose_stars: adding stars into cart
+on_button(("shop", "choose_stars"), "🔙 بازگشت")(back_to_shop)
+
+@on_text(("shop", "choose_stars"))
+def shop_stars_qty(chat_id, text, state):
+    try:
+        qty = int(text.replace(",",""))
+        if qty <= 0:
+            raise ValueError()
+    except Exception:
+        send_message(chat_id, "عدد نامعتبر. یک عدد صحیح وارد کن.")
+        return
+    # price per star dynamic (could be based on promotions)
+    price_per = PRICE_PER_STAR
+    cart = state.get("cart", [])
+    cart.append({"kind":"stars","qty":qty,"price":price_per})
+    st = user_states.get_or_create(chat_id, state)
+    st["cart"] = cart
+    send_message(chat_id, get_msg(chat_id,"cart_added"), reply_markup=keyboards.get("cart_added"))
+    st["stage"]="choose_type"
+
+# cart review stage
+@on_button(("shop", "cart_review"), "❌ خالی‌سازی سبد", "❌ Empty cart")
+def cart_clear(chat_id, text, state):
+    send_message(chat_id, "سبد خالی شد.", reply_markup=main_menu_markup(chat_id))
+    user_states.pop(chat_id,None)
+
+@on_button(("shop", "cart_review"), "✅ نهایی‌سازی و پرداخت", "✅ Checkout")
+def cart_checkout(chat_id, text, state):
+    cart = state.get("cart",[])
+    if not cart:
+        send_message(chat_id, get_msg(chat_id,"cart_empty"), reply_markup=main_menu_markup(chat_id))
+        user_states.pop(chat_id,None)
+        return
+    summary, total = user_cart_summary(cart)
+    # require name and contact and optionally use wallet
+    st = user_states.get_or_create(chat_id, state)
+    st["stage"]="checkout_confirm"
+    st["checkout_total"]=total
+    send_message(chat_id, get_msg(chat_id,"view_cart", summary=summary, total=total), reply_markup=keyboards.get("checkout_pay"))
+
+on_button(("shop", "cart_review"), "🔙 بازگشت")(back_to_shop)
+
+# checkout confirm step
+on_button(("shop", "checkout_confirm"), "🔙 بازگشت")(back_to_shop)
+
+@on_button(("shop", "checkout_confirm"), "💳 پرداخت با کیف‌پول")
+def checkout_wallet(chat_id, text, state):
+    total = state.get("checkout_total",0)
+    # balance check and debit must be atomic against admin credits
+    with shared_txn():
+        prof = user_profile(chat_id)
+        paid = prof.get("wallet",0) >= total
+        if paid:
+            prof["wallet"] -= total
+            # finalize order
+            order_id = gen_order_id("ARSH-C")
+            order = {
+                "order_id": order_id,
+                "type": "checkout",
+                "cart": state.get("cart",[]),
+                "total": total,
+                "user_id": chat_id,
+                "status": "paid",
+                "time": datetime.utcnow().isoformat()
+            }
+            # reward points and VIP
+            prof["points"] = prof.get("points",0) + int(total//10000)  # example: 1 point per 10k
+            if prof["points"] >= 100 and not prof.get("vip"):
+                prof["vip"]=True
+                order["vip_upgrade"] = True     # counted as a VIP conversion by analytics
+            save_order(order)
+            set_profile(chat_id, prof)
+            # notify admins
+            admin_digest.add(f"سفارش جدید پرداخت شده: {order_id}\nکاربر: {chat_id}\nمجموع: {total:,}",
+                             [("📦 مشاهده سفارش", f"view_order:{order_id}")])
+    if not paid:
+        send_message(chat_id, "موجودی کافی نیست. لطفاً کیف‌پول را شارژ کن.", reply_markup=main_menu_markup(chat_id))
+        user_states.pop(chat_id,None)
+        return
+    storage.sync()
+    send_message(chat_id, f"پرداخت با کیف‌پول انجام شد. سفارش ثبت شد: {order_id}", reply_markup=main_menu_markup(chat_id))
+    user_states.pop(chat_id,None)
+
+@on_button(("shop", "checkout_confirm"), "📤 ارسال رسید و پرداخت دستی")
+def checkout_manual(chat_id, text, state):
+    # ask for receipt photo after sending contact
+    user_states.get_or_create(chat_id, state)["stage"]="await_contact_for_receipt"
+    send_message(chat_id, get_msg(chat_id,"send_contact"), reply_markup=contact_request_kb(user_lang(chat_id)))
+
+# profile edit flow
+on_button(("profile_edit", "await_lang"), "🔙 بازگشت")(back_to_menu)
+
+LANG_BUTTONS = {"🇮🇷 فارسی":"fa","🇬🇧 English":"en","🇸🇦 العربية":"ar"}
+
+@on_text(("profile_edit", "await_lang"))
+def profile_lang(chat_id, text, state):
+    if text not in LANG_BUTTONS:
+        send_message(chat_id, "زبان نامعتبر.", reply_markup=main_menu_markup(chat_id))
+        user_states.pop(chat_id,None)
+        return
+    with shared_txn():
+        prof = user_profile(chat_id)
+        prof["lang"] = LANG_BUTTONS[text]
+        set_profile(chat_id, prof)
+    remember_lang(chat_id, prof["lang"])
+    send_message(chat_id, get_msg(chat_id,"profile_created"), reply_markup=main_menu_markup(chat_id))
+    user_states.pop(chat_id,None)
+
+# contact handler (used for verification and receipts)
+@bot.message_handler(content_types=['contact'])
+@metrics.timed("bot_handler", handler="contact")
+def contact_handler(m):
+    chat_id = m.chat.id
+    state = user_states.get(chat_id)
+    if not state:
+        send_message(chat_id, "ابتدا از منو گزینه‌ای انتخاب کن.", reply_markup=main_menu_markup(chat_id))
+        return
+    contact = m.contact
+    phone = getattr(contact,"phone_number", None)
+    if not phone:
+        send_message(chat_id, "شماره معتبر فرستاده نشده.", reply_markup=main_menu_markup(chat_id))
+        return
+    # profile edit finalization
+    if state.get("flow")=="profile_edit" and state.get("stage")=="await_contact":
+        with shared_txn():
+            prof = user_profile(chat_id)
+            prof["phone"] = phone
+            set_profile(chat_id, prof)
+        send_message(chat_id, get_msg(chat_id,"profile_created"), reply_markup=main_menu_markup(chat_id))
+        user_states.pop(chat_id,None)
+        return
+    # if awaiting contact for receipt -> move to await_receipt stage and ask for photo
+    state = user_states.get_or_create(chat_id, state)
+    if state.get("stage")=="await_contact_for_receipt":
+        state["stage"]="await_receipt"
+        state["receipt_phone"]=phone
+        send_message(chat_id, get_msg(chat_id,"send_receipt"), reply_markup=remove_kb())
+        return
+    # if this is used for order verification -> create code and ask
+    state["phone"] = phone
+    code = gen_code()
+    state["code"] = code
+    state["expiry"] = datetime.utcnow() + timedelta(minutes=CODE_EXPIRY_MINUTES)
+    state["stage"]="await_code"
+    send_message(chat_id, f"کد سفارش شما: {code}")
+    send_message(chat_id, get_msg(chat_id,"enter_code"))
+
+# photo handler: receipts
+@bot.message_handler(content_types=['photo'])
+@metrics.timed("bot_handler", handler="photo")
+def photo_handler(m):
+    chat_id = m.chat.id
+    state = user_states.get(chat_id)
+    if not state:
+        send_message(chat_id, "عکس دریافت شد اما منتظر عکس نبودیم.", reply_markup=main_menu_markup(chat_id))
+        return
+    if state.get("stage")=="await_receipt":
+        file_id = m.photo[-1].file_id
+        amount = state.get("charge_amount", 0)
+        with shared_txn():
+            receipt_id = gen_order_id("R", receipts_db)
+            rec = {"receipt_id": receipt_id, "user_id": chat_id, "file_id": file_id, "amount": amount, "time": datetime.utcnow().isoformat(), "status":"pending"}
+            save_receipt(rec)
+            # send to admins
+            admin_digest.add(f"🧾 رسید جدید از کاربر {chat_id}\nمقدار: {amount:,} تومان\nایدی: {receipt_id}",
+                             [("✅ تایید", f"approve_receipt:{receipt_id}"), ("❌ رد", f"reject_receipt:{receipt_id}")],
+                             photo=file_id)
+        send_message(chat_id, get_msg(chat_id,"receipt_sent_admin"), reply_markup=main_menu_markup(chat_id))
+        user_states.pop(chat_id,None)
+        return
+    send_message(chat_id, "در حال حاضر تماشاگر عکس نیستیم.", reply_markup=main_menu_markup(chat_id))
+
+# code verification for any flow in the await_code stage (set by contact_handler)
+@on_text((None, "await_code"))
+def code_verification_router(chat_id, text, state):
+    expiry = state.get("expiry")
+    if expiry and datetime.utcnow() > expiry:
+        new_code = gen_code()
+        state["code"] = new_code
+        state["expiry"] = datetime.utcnow() + timedelta(minutes=CODE_EXPIRY_MINUTES)
+        send_message(chat_id, "کد قبلی منقضی شد. کد جدید ارسال شد.")
+        send_message(chat_id, f"کد جدید: {new_code}")
+        return
+    if text != state.get("code"):
+        send_message(chat_id, get_msg(chat_id,"invalid_code"))
+        return
+    # code valid -> finalize any pending order flow (if any)
+    # Example: if in checkout via contact/verification, create order record
+    if state.get("flow")=="shop":
+        # create single-order for demonstration (earlier flows usually store cart)
+        cart = state.get("cart",[])
+        if not cart:
+            send_message(chat_id, "سبد خالی است.", reply_markup=main_menu_markup(chat_id))
+            user_states.pop(chat_id,None)
+            return
+        with shared_txn():
+            order_id = gen_order_id("ARSH-V")
+            order = {
+                "order_id": order_id,
+                "user_id": chat_id,
+                "cart": cart,
+                "total": state.get("checkout_total", sum(i.get("price",0)*i.get("qty",1) for i in cart)),
+                "status": "pending_admin",
+                "time": datetime.utcnow().isoformat()
+            }
+            save_order(order)
+            # notify admins
+            admin_digest.add(f"📦 New order {order_id}\nUser: {chat_id}\nTotal: {order['total']:,}",
+                             [("📦 View Order", f"view_order:{order_id}"), ("✅ Approve & Assign", f"approve_order:{order_id}")])
+        send_message(chat_id, get_msg(chat_id,"order_registered", order_id=order_id), reply_markup=main_menu_markup(chat_id))
+    user_states.pop(chat_id,None)
+
+# callback router for admin actions
+@bot.callback_query_handler(func=lambda call: True)
+@metrics.timed("bot_handler", handler="callback")
+def callback_router(call):
+    try:
+        data = call.data or ""
+        user_id = call.from_user.id
+        # receipts
+        if data.startswith("approve_receipt:") or data.startswith("reject_receipt:"):
+            if user_id not in ADMIN_IDS:
+                bot.answer_callback_query(call.id, "فقط ادمین می‌تواند این کار را انجام دهد.")
+                return
+            action, rid = data.split(":")
+            target = find_receipt(rid)
+            if not target:
+                bot.answer_callback_query(call.id, "رسید پیدا نشد.")
+                return
+            with shared_txn():
+                if storage.shared:
+                    target = find_receipt(rid) or target    # re-read under the write lock
+                # two admins may click at once; only the first decision counts
+                done = target.get("status") != "pending"
+                if not done:
+                    if action=="approve_receipt":
+                        uid = target["user_id"]
+                        prof = user_profile(uid)
+                        prof["wallet"] = prof.get("wallet",0) + int(target.get("amount",0))
+                        set_profile(uid, prof)
+                        set_receipt_status(target, "approved")
+                    else:
+                        set_receipt_status(target, "rejected")
+            if done:
+                bot.answer_callback_query(call.id, "این رسید قبلاً بررسی شده.")
+                return
+            if action=="approve_receipt":
+                uid = target["user_id"]
+                storage.sync()
+                send_message(uid, get_msg(uid,"receipt_approved", amount=target.get("amount",0)))
+                bot.answer_callback_query(call.id, "رسید تایید شد.")
+                drop_item_buttons(call, rid)
+                return
+            else:
+                send_message(target["user_id"], get_msg(target["user_id"], "receipt_rejected"))
+                bot.answer_callback_query(call.id, "رسید رد شد.")
+                drop_item_buttons(call, rid)
+                return
+
+        # admin order actions
+        if data.startswith("view_order:"):
+            if user_id not in ADMIN_IDS:
+                bot.answer_callback_query(call.id, "فقط ادمین.")
+                return
+            _, oid = data.split(":",1)
+            target = find_order(oid)
+            if not target:
+                bot.answer_callback_query(call.id, "سفارش پیدا نشد.")
+                return
+            send_message(user_id, f"Order {oid} details:\n{json.dumps(target, ensure_ascii=False, indent=2)}")
+            bot.answer_callback_query(call.id, "ارسال شد.")
+            return
+
+        if data.startswith("approve_order:"):
+            if user_id not in ADMIN_IDS:
+                bot.answer_callback_query(call.id, "فقط ادمین.")
+                return
+            _, oid = data.split(":",1)
+            target = find_order(oid)
+            if not target:
+                bot.answer_callback_query(call.id, "سفارش پیدا نشد.")
+                return
+            # set status to approved and optionally assign a value
+            with shared_txn():
+                if storage.shared:
+                    target = find_order(oid) or target      # re-read under the write lock
+                done = target.get("status") == "approved"
+                if not done:
+                    set_order_status(target, "approved")
+            if done:
+                bot.answer_callback_query(call.id, "این سفارش قبلاً تایید شده.")
+                drop_item_buttons(call, f"approve_order:{oid}")
+                return
+            storage.sync()
+            drop_item_buttons(call, f"approve_order:{oid}")
+            send_message(user_id, f"سفارش {oid} تایید شد. می‌توانید اختصاص دهید یا اطلاعات را به کاربر ارسال کنید.")
+            send_message(target["user_id"], f"سفارش شما {oid} تایید شد. پس از ارسال اطلاعات، پیام می‌آید.")
+            bot.answer_callback_query(call.id, "تأیید شد.")
+            return
+
+    except Exception as e:
+        traceback.print_exc()
+        try:
+            bot.answer_callback_query(call.id, "خطا در پردازش.")
+        except Exception:
+            pass
+
+# ================ metrics export ================
+metrics.gauge("bot_users", lambda: len(users_db))
+metrics.gauge("bot_orders", lambda: len(orders_db))
+metrics.gauge("bot_receipts", lambda: len(receipts_db))
+metrics.gauge("bot_open_states", lambda: len(user_states))
+metrics.gauge("bot_outbox_depth", lambda: outbox.depth)
+metrics.gauge("bot_admin_digest_pending", lambda: admin_digest.pending)
+
+def fmt_ms(seconds):
+    return "∞" if seconds == float("inf") else f"{seconds * 1000:g}"
+
+def stats_text(top=10):
+    o = outbox.stats()
+    st = user_states.stats()
+    lines = [
+        "📊 آمار ربات",
+        f"کاربران: {len(users_db):,} | سفارش‌ها: {len(orders_db):,} | رسیدها: {len(receipts_db):,} | گفتگوهای باز: {len(user_states):,}",
+        f"outbox: depth={o['depth']} sent={o['sent']} failed={o['failed']} retried={o['retried']} p95={o['latency_p95']}s",
+        f"states: hit_rate={st['hit_rate']} evicted={st['evicted']} expired={st['expired']} ~{st.get('approx_bytes', 0) // 1024}KB",
+        f"handler errors: {metrics.counter_total('bot_handler_errors_total')}",
+        "",
+        "handlers (n, p50/p95 ms):",
+    ]
+    for labels, n, _, p50, p95 in metrics.summary("bot_handler_seconds")[:top]:
+        where = f" [{labels['flow']}/{labels['stage']}]" if labels.get("flow", "-") != "-" else ""
+        lines.append(f"  {labels['handler']}{where}: {n}, {fmt_ms(p50)}/{fmt_ms(p95)}")
+    lines += ["", "Bot API (n, errors, p50/p95 ms):"]
+    for labels, n, _, p50, p95 in metrics.summary("bot_api_seconds")[:top]:
+        errors = metrics.counter_total("bot_api_errors_total", method=labels["method"])
+        lines.append(f"  {labels['method']}: {n}, {errors}, {fmt_ms(p50)}/{fmt_ms(p95)}")
+    lines += ["", "disk (n, p50/p95 ms):"]
+    for name in ("bot_save_seconds", "bot_storage_write_seconds", "bot_storage_sync_seconds"):
+        for labels, n, _, p50, p95 in metrics.summary(name):
+            what = labels.get("file") or f"{name[12:-8]} ({labels.get('backend')})"
+            lines.append(f"  {what}: {n}, {fmt_ms(p50)}/{fmt_ms(p95)}")
+    return "\n".join(lines)
+
+class MetricsServer:
+    """GET /metrics in Prometheus text format. Meant for a local scraper;
+    keep METRICS_LISTEN on localhost."""
+
+    def __init__(self, host, port):
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_response(404)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                body = metrics.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+
+    def start(self):
+        threading.Thread(target=self.httpd.serve_forever, name="metrics", daemon=True).start()
+        return self
+
+# ================ webhook mode ================
+class WebhookServer:
+    """Local HTTP receiver for Telegram webhook POSTs.
+
+    Requests without the right secret token get 403, bodies over
+    WEBHOOK_MAX_BODY get 413 and unparsable ones 400. Accepted updates go
+    straight into the dispatcher's bounded queues; when they stay full for
+    WEBHOOK_ENQUEUE_TIMEOUT we answer 503 and Telegram redelivers later.
+    200 is sent only once the update has been handled (Telegram drops it
+    for good on 200), so a crash before that means a redelivery, which
+    the ledger recognises; past WEBHOOK_APPLY_TIMEOUT we answer 503 too.
+    """
+
+    def __init__(self, dispatcher, host, port, path=WEBHOOK_PATH, secret=WEBHOOK_SECRET):
+        self.dispatcher = dispatcher
+        self.path = path
+        self.secret = secret
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                server.handle_post(self)
+
+            def log_message(self, format, *args):
+                pass
+
+        class Server(ThreadingHTTPServer):
+            # Telegram opens up to WEBHOOK_MAX_CONNECTIONS at once; past the
+            # default listen backlog of 5 connections get reset
+            request_queue_size = max(WEBHOOK_MAX_CONNECTIONS, 5)
+            daemon_threads = True
+
+        self.httpd = Server((host, port), Handler)
+        self.thread = None
+
+    @property
+    def address(self):
+        return self.httpd.server_address
+
+    def handle_post(self, req):
+        if req.path != self.path:
+            return self._reply(req, 404)
+        token = req.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        if self.secret and not hmac.compare_digest(token, self.secret):
+            return self._reply(req, 403)
+        try:
+            length = int(req.headers.get("Content-Length", 0))
+        except ValueError:
+            length = -1
+        if length < 0:
+            return self._reply(req, 400)
+        if length > WEBHOOK_MAX_BODY:
+            return self._reply(req, 413)
+        try:
+            update = types.Update.de_json(req.rfile.read(length).decode("utf-8"))
+        except Exception:
+            return self._reply(req, 400)
+        try:
+            self.dispatcher.submit(update, timeout=WEBHOOK_ENQUEUE_TIMEOUT)
+        except queue.Full:
+            return self._reply(req, 503)
+        # a redelivered duplicate waits as well: it may still be running
+        if not self.dispatcher.wait_applied(update.update_id, WEBHOOK_APPLY_TIMEOUT):
+            return self._reply(req, 503)
+        self._reply(req, 200)
+
+    @staticmethod
+    def _reply(req, code):
+        req.send_response(code)
+        req.send_header("Content-Length", "0")
+        req.end_headers()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name="webhook", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+def run_webhook(dispatcher=None):
+    if not WEBHOOK_URL:
+        sys.exit("WEBHOOK_URL is not set")
+    secret = WEBHOOK_SECRET or secrets.token_urlsafe(32)
+    dispatcher = dispatcher or ChatDispatcher(bot, DISPATCH_WORKERS)
+    server = WebhookServer(dispatcher, WEBHOOK_LISTEN, WEBHOOK_PORT, secret=secret).start()
+    bot.set_webhook(url=WEBHOOK_URL, secret_token=secret, max_connections=WEBHOOK_MAX_CONNECTIONS)
+    try:
+        server.thread.join()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        bot.remove_webhook()
+        server.stop()
+        dispatcher.stop()
+
+# ================ cluster mode ================
+def update_json(update):
+    # the wire form of a parsed Update (telebot keeps each part's raw dict)
+    raw = {"update_id": update.update_id}
+    for name, value in vars(update).items():
+        if getattr(value, "json", None) is not None:
+            raw[name] = value.json
+    return raw
+
+class AckingDispatcher(ChatDispatcher):
+    """ChatDispatcher of a cluster worker: reports every finished update as
+    (worker, update_id, seconds) to the ingress."""
+
+    track = False
+
+    def __init__(self, bot, workers, done):
+        self.done = done
+        super().__init__(bot, workers)
+
+    def handle(self, update):
+        start = time.perf_counter()
+        try:
+            super().handle(update)
+        finally:
+            self.done.put((CLUSTER_INDEX, update.update_id, time.perf_counter() - start))
+
+class ClusterRouter:
+    """Ingress side of cluster mode, with ChatDispatcher's interface (submit,
+    submit_updates, wait_applied, install, stop) so polling and WebhookServer
+    use it as is.
+
+    Starts one worker process per queue (spawned: each opens its own SQLite
+    connection) and sends every update as JSON to the worker that owns its
+    chat: admins to worker 0, which also runs broadcasts, everyone else by
+    chat_id % workers. A conversation's state therefore stays in one process;
+    profiles, orders and receipts are shared through the database.
+    `initializer` (a picklable function) runs in each worker before it
+    starts serving."""
+
+    def __init__(self, bot, workers, queue_size=DISPATCH_QUEUE_SIZE, initializer=None):
+        ctx = multiprocessing.get_context("spawn")
+        self.bot = bot
+        self.queues = [ctx.Queue(queue_size) for _ in range(workers)]
+        self.done = ctx.Queue()
+        self.procs = []
+        for i, q in enumerate(self.queues):
+            os.environ["BOT_CLUSTER_WORKER"] = f"{i}/{workers}"   # read by the worker at import
+            try:
+                p = ctx.Process(target=cluster_worker, args=(q, self.done, initializer), name=f"bot-worker-{i}")
+                p.start()
+            finally:
+                os.environ.pop("BOT_CLUSTER_WORKER", None)
+            self.procs.append(p)
+        self.stopped = False
+        self.collector = threading.Thread(target=self.collect, name="cluster-acks", daemon=True)
+        self.collector.start()
+
+    def worker_of(self, chat_id):
+        return 0 if chat_id in ADMIN_IDS else chat_id % len(self.queues)
+
+    def submit(self, update, timeout=None):
+        # blocks while the worker's queue is full; raises queue.Full after timeout
+        if not update_ledger.begin(update.update_id):
+            metrics.inc("bot_updates_duplicate_total")
+            return False
+        try:
+            self.queues[self.worker_of(update_chat_id(update))].put(update_json(update), timeout=timeout)
+        except queue.Full:
+            update_ledger.abandon(update.update_id)
+            raise
+        return True
+
+    def submit_updates(self, updates):
+        submit_polled(self, updates)
+
+    def wait_applied(self, update_id, timeout):
+        return update_ledger.wait_done(update_id, timeout)
+
+    def install(self):
+        self.bot.process_new_updates = self.submit_updates
+        poll_from_watermark(self.bot)
+        return self
+
+    def collect(self):
+        while True:
+            ack = self.done.get()
+            if ack is None:
+                return
+            update_ledger.finish(ack[1])
+            self.on_done(*ack)
+
+    def on_done(self, worker, update_id, seconds):
+        metrics.observe("bot_cluster_update_seconds", seconds, worker=str(worker))
+
+    def stop(self, timeout=30):
+        if self.stopped:
+            return
+        self.stopped = True
+        for q in self.queues:
+            q.put(None)
+        for p in self.procs:
+            p.join(timeout)
+            if p.is_alive():
+                p.terminate()
+        self.done.put(None)
+        self.collector.join(5)
+
+def cluster_worker(inbox, done, initializer=None):
+    # main function of a worker process (imported with BOT_CLUSTER_WORKER set)
+    # the bot's global send rate is split between the workers
+    outbox.global_bucket = TokenBucket(OUTBOX_GLOBAL_RATE / CLUSTER_SIZE)
+    if initializer:
+        initializer()
+    states_path = f"{STATES_FILE}.{CLUSTER_INDEX}" if STATE_PERSIST else None
+    if states_path:
+        user_states.restore(states_path)
+    threading.Thread(target=user_states.sweeper, args=(STATE_SWEEP_INTERVAL, states_path), daemon=True).start()
+    if CLUSTER_INDEX == 0:
+        resume_broadcasts()
+        threading.Thread(target=admin_digest.run_shared, name="admin-digest", daemon=True).start()
+    keyboards.warm()
+    if METRICS_PORT:
+        MetricsServer(METRICS_LISTEN, METRICS_PORT + 1 + CLUSTER_INDEX).start()
+    dispatcher = AckingDispatcher(bot, DISPATCH_WORKERS, done)
+    try:
+        while True:
+            raw = inbox.get()
+            if raw is None:
+                break
+            dispatcher.submit(types.Update.de_json(raw))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        dispatcher.stop()
+        admin_digest.flush()
+        outbox.drain()
+        if states_path:
+            user_states.save(states_path)
+        storage.close()
+
+def run_cluster(workers, webhook=False):
+    if STORAGE_BACKEND != "sqlite":
+        sys.exit("cluster mode needs BOT_STORAGE=sqlite (python bot.py migrate first)")
+    router = ClusterRouter(bot, workers)
+    if METRICS_PORT:
+        MetricsServer(METRICS_LISTEN, METRICS_PORT).start()
+    threading.Thread(target=checkpoint_loop, args=(UPDATE_CHECKPOINT_INTERVAL,), daemon=True).start()
+    try:
+        if webhook:
+            run_webhook(router)
+        else:
+            router.install()
+            catch_up(router)
+            bot.infinity_polling()
+    finally:
+        router.stop()
+        storage.save_checkpoint(update_ledger.watermark)
+        storage.close()
+
+# ================ asyncio mode ================
+def build_async_bot():
+    """AsyncTeleBot that receives updates on the event loop and runs them
+    through the same handlers registered on `bot` (same filters, same order).
+
+    Handler bodies and their storage I/O run in a fixed thread pool so they
+    never block the loop; updates of one chat are serialized through a
+    sharded lock table so a conversation still advances one step at a time.
+
+    Updates pass through update_ledger as in the threaded modes: polling
+    asks for the watermark (AsyncTeleBot's own offset is ignored), a page
+    holding only updates already running waits for one to finish, and every
+    update is deduplicated, marked applied with its writes and checkpointed.
+    """
+    import asyncio
+    from telebot import asyncio_helper
+    from telebot.async_telebot import AsyncTeleBot   # needs aiohttp
+
+    if API_URL:
+        asyncio_helper.API_URL = API_URL
+    abot = AsyncTeleBot(TOKEN_BOT)
+    executor = ThreadPoolExecutor(max_workers=ASYNC_HANDLER_THREADS, thread_name_prefix="handler")
+    chat_locks = [asyncio.Lock() for _ in range(ASYNC_CHAT_LOCKS)]
+    fetch = abot.get_updates
+
+    async def get_updates(offset=None, *args, **kwargs):
+        # only updates begun here reach process_new_updates
+        while True:
+            watermark = update_ledger.watermark
+            updates = await fetch(watermark + 1, *args, **kwargs)
+            fresh = [u for u in updates if update_ledger.begin(u.update_id)]
+            if fresh or not updates:
+                return fresh
+            metrics.inc("bot_updates_duplicate_total", len(updates))
+            await asyncio.get_running_loop().run_in_executor(
+                None, update_ledger.wait_past, watermark, POLL_STALL_WAIT)
+
+    def handle(update):
+        handling.update_id = update.update_id
+        try:
+            telebot.TeleBot.process_new_updates(bot, [update])
+        finally:
+            handling.update_id = None
+            update_ledger.finish(update.update_id)
+
+    async def run(update):
+        try:
+            async with chat_locks[update_chat_id(update) % ASYNC_CHAT_LOCKS]:
+                await asyncio.get_running_loop().run_in_executor(executor, handle, update)
+        except BaseException:
+            update_ledger.abandon(update.update_id)      # cancelled at shutdown; polled again
+            raise
+
+    async def process_new_updates(updates):
+        for update in updates:
+            asyncio.create_task(run(update))
+
+    abot.get_updates = get_updates
+    abot.process_new_updates = process_new_updates
+    return abot, executor
+
+def run_async():
+    import asyncio
+    abot, executor = build_async_bot()
+
+    async def main():
+        try:
+            await abot.infinity_polling()
+        finally:
+            await abot.close_session()
+
+    try:
+        asyncio.run(main())
+    finally:
+        executor.shutdown(wait=True)
+
+# run
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["migrate"]:
+        migrate_json_to_sqlite(force="--force" in sys.argv[2:])
+        analytics.save(ANALYTICS_FILE)
+        sys.exit(0)
+    if sys.argv[1:2] == ["reshard"]:
+        reshard_users(int(sys.argv[2]))
+        analytics.save(ANALYTICS_FILE)
+        sys.exit(0)
+    if sys.argv[1:2] == ["archive"]:
+        # one pass now (bot stopped); optional age in days
+        moved = archive_settled(int(sys.argv[2]) if len(sys.argv) > 2 else None)
+        analytics.save(ANALYTICS_FILE)
+        storage.close()
+        print(f"archived {moved.get('orders', 0)} orders, {moved.get('receipts', 0)} receipts -> {ARCHIVE_DIR}")
+        sys.exit(0)
+    if sys.argv[1:2] == ["cluster"]:
+        # python bot.py cluster [N] [webhook]; settled orders are archived
+        # offline here (python bot.py archive with the cluster stopped)
+        run_cluster(int(sys.argv[2]) if len(sys.argv) > 2 and sys.argv[2].isdigit() else os.cpu_count() or 1,
+                    webhook="webhook" in sys.argv[2:])
+        sys.exit(0)
+    print("Super professional bot started...")
+    threading.Thread(target=storage.maintenance, daemon=True).start()
+    threading.Thread(target=ensure_analytics, name="analytics-rebuild", daemon=True).start()
+    if ARCHIVE_AFTER_DAYS:
+        threading.Thread(target=archive_loop, args=(ARCHIVE_INTERVAL,), daemon=True).start()
+    states_path = STATES_FILE if STATE_PERSIST else None
+    if states_path:
+        user_states.restore(states_path)
+    threading.Thread(target=user_states.sweeper, args=(STATE_SWEEP_INTERVAL, states_path), daemon=True).start()
+    resume_broadcasts()
+    admin_digest.flush()                # items a crash left unsent
+    keyboards.warm()
+    if METRICS_PORT:
+        MetricsServer(METRICS_LISTEN, METRICS_PORT).start()
+    threading.Thread(target=checkpoint_loop, args=(UPDATE_CHECKPOINT_INTERVAL,), daemon=True).start()
+    try:
+        if sys.argv[1:2] == ["async"]:
+            run_async()
+        elif sys.argv[1:2] == ["webhook"]:
+            run_webhook()
+        else:
+            dispatcher = ChatDispatcher(bot, DISPATCH_WORKERS).install()
+            catch_up(dispatcher)
+            bot.infinity_polling()
+            dispatcher.stop()
+    finally:
+        admin_digest.flush()
+        outbox.drain()
+        if states_path:
+            user_states.save(states_path)
+        analytics.save(ANALYTICS_FILE)
+        storage.save_checkpoint(update_ledger.watermark)
+        storage.close()
+
+
@@ -0,0 +1,39 @@
+# bot.py reads its configuration at import: point it at a scratch data dir
+# and a dummy token before any test imports it
+import os
+import subprocess
+import sys
+import tempfile
+import textwrap
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ["BOT_DATA_DIR"] = tempfile.mkdtemp(prefix="bot-tests-")
+os.environ["BOT_TOKEN"] = "123456:TEST"
+os.environ.pop("BOT_STORAGE", None)
+os.environ.pop("BOT_CLUSTER_WORKER", None)
+
+
+@pytest.fixture
+def fake_api():
+    # bench's stand-in for the Bot API; (api, BOT_API_URL pointing at it)
+    import bench
+    api = bench.FakeTelegram()
+    server = api.serve()
+    yield api, f"http://127.0.0.1:{server.server_address[1]}/bot{{0}}/{{1}}"
+    server.shutdown()
+
+
+@pytest.fixture
+def run_bot(tmp_path):
+    # runs code in a fresh interpreter after `import bot`, all runs of one test
+    # sharing a data dir: a run that ends in os._exit() is a crash
+    def run(code, **env):
+        env = dict(os.environ, BOT_DATA_DIR=str(tmp_path / "data"), **env)
+        proc = subprocess.run([sys.executable, "-c", "import bot\n" + textwrap.dedent(code)],
+                              cwd=ROOT, env=env, capture_output=True, text=True, timeout=120)
+        assert proc.returncode == 0, proc.stderr
+        return proc.stdout
+    return run
@@ -0,0 +1,84 @@
+import bot
+
+
+def order(oid, status="paid", total=100, time="2026-01-01T10:00:00"):
+    return {"order_id": oid, "user_id": 42, "total": total, "time": time, "status": status,
+            "cart": [{"kind": "number", "country": "Iran", "qty": 2, "price": 30},
+                     {"kind": "stars", "qty": 50, "price": 1}]}
+
+
+def receipt(rid, status="approved", amount=500):
+    return {"receipt_id": rid, "user_id": 42, "amount": amount, "time": "2026-01-01T11:00:00", "status": status}
+
+
+def test_counts_paid_orders_and_approved_topups():
+    a = bot.SalesAnalytics()
+    a.add_order(order("O-1"))
+    a.add_order(order("O-2", status="pending"))
+    a.add_order(dict(order("O-3"), vip_upgrade=True))
+    a.add_topup(receipt("R-1"))
+    a.add_topup(receipt("R-2", status="rejected"))
+    day = a.to_dict()["daily"]["2026-01-01"]
+    assert (day["revenue"], day["orders"], day["vip"]) == (200, 2, 1)
+    assert (day["numbers"], day["stars"], day["stars_revenue"]) == (4, 100, 100)
+    assert (day["topups"], day["topup_amount"]) == (1, 500)
+    assert a.to_dict()["countries"] == {"Iran": {"qty": 4, "revenue": 120}}
+
+
+def test_rebuild_counts_a_change_made_meanwhile_once(monkeypatch):
+    monkeypatch.setattr(bot, "REBUILD_BATCH", 1)
+    a = bot.SalesAnalytics()
+    early, late = order("O-1", status="pending"), order("O-2", status="pending")
+
+    def paid(rec):
+        rec["status"] = "paid"
+        a.add_order(rec)
+
+    def orders():
+        paid(early)                 # before the rebuild reads it
+        yield early
+        yield late
+        paid(late)                  # after
+
+    a.start_rebuild()
+    a.rebuild(orders(), [receipt("R-1")])
+    day = a.to_dict()["daily"]["2026-01-01"]
+    assert (day["orders"], day["revenue"], day["topups"]) == (2, 200, 1)
+    assert a.ready and a.pending is None
+
+
+def test_file_is_not_trusted_after_a_change(tmp_path):
+    path = str(tmp_path / "analytics.json")
+    a = bot.SalesAnalytics()
+    assert not a.save(path)                 # not rebuilt yet
+    a.start_rebuild()
+    a.rebuild([order("O-1")], [])
+    assert a.save(path)
+    a.add_order(order("O-2"))               # leaves the dirty marker
+    assert not bot.SalesAnalytics().restore(path)
+    a.save(path)
+    b = bot.SalesAnalytics()
+    assert b.restore(path) and b.to_dict() == a.to_dict()
+
+
+def test_cluster_report_folds_in_the_log(tmp_path, monkeypatch):
+    shared = bot.SqliteStorage(str(tmp_path / "bot.sqlite3"))
+    shared.shared = True
+    monkeypatch.setattr(bot, "storage", shared)
+    monkeypatch.setattr(bot, "analytics", bot.SalesAnalytics())
+
+    def sell(rec):                          # what save_order does in any worker
+        shared.add_order(rec)
+        bot.analytics.add_order(rec)
+
+    sell(order("O-1"))
+    bot.ensure_analytics()                  # first /report: one rebuild
+    assert bot.analytics.to_dict()["daily"]["2026-01-01"]["orders"] == 1
+    assert shared.analytics_log(0) == []
+    sell(order("O-2", total=50))
+    assert bot.analytics.to_dict()["daily"]["2026-01-01"]["orders"] == 1
+    bot.ensure_analytics()                  # later ones: only the log since
+    day = bot.analytics.to_dict()["daily"]["2026-01-01"]
+    assert (day["orders"], day["revenue"]) == (2, 150)
+    assert shared.analytics_log(0) == []
+    shared.close()
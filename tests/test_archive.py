@@ -0,0 +1,61 @@
+import gzip
+import json
+
+import bot
+
+
+def order(n, month="01", status="paid"):
+    return {"order_id": f"ARSH-25{month}15103000-{n:04d}", "user_id": 42, "total": n,
+            "time": f"2025-{month}-15T10:30:00", "status": status}
+
+
+def test_lookup_inflates_one_block(tmp_path, monkeypatch):
+    monkeypatch.setattr(bot, "ARCHIVE_BLOCK", 2)
+    archive = bot.OrderArchive(str(tmp_path))
+    records = [order(n) for n in range(5)] + [order(9, month="02")]
+    archive.write("orders", "order_id", records)
+    assert sorted(p.name for p in tmp_path.iterdir()) == [
+        "orders-202501-0000.idx.json", "orders-202501-0000.jsonl.gz",
+        "orders-202502-0000.idx.json", "orders-202502-0000.jsonl.gz"]
+    # still plain gzip, a chain of members of ARCHIVE_BLOCK records
+    with gzip.open(tmp_path / "orders-202501-0000.jsonl.gz", "rt") as f:
+        assert [json.loads(line)["total"] for line in f] == [0, 1, 2, 3, 4]
+    index = json.loads((tmp_path / "orders-202501-0000.idx.json").read_text())["ids"]
+    assert len({tuple(where) for where in index.values()}) == 3
+    assert archive.get("orders", order(3)["order_id"]) == order(3)
+    assert archive.get("orders", order(9, month="02")["order_id"])["total"] == 9
+    assert archive.get("orders", order(7)["order_id"]) is None
+    assert [r["total"] for r in archive.records("orders")] == [0, 1, 2, 3, 4, 9]
+
+
+def test_segment_without_index_is_ignored(tmp_path):
+    archive = bot.OrderArchive(str(tmp_path))
+    archive.write("orders", "order_id", [order(1)])
+    archive.write("orders", "order_id", [order(2)])
+    (tmp_path / "orders-202501-0001.idx.json").unlink()     # interrupted write
+    assert archive.get("orders", order(2)["order_id"]) is None
+    assert [r["total"] for r in archive.records("orders")] == [1]
+
+
+ARCHIVE = """
+for rec in %r:
+    bot.save_order(rec)
+print(bot.archive_settled(30), flush=True)
+bot.storage.close()
+"""
+
+
+def test_find_order_falls_back_to_the_archive(run_bot):
+    old, pending = order(1), order(2, status="pending")
+    out = run_bot(ARCHIVE % [old, pending])
+    assert out.strip() == str({"orders": 1})
+    out = run_bot("""
+    oid = %r
+    print(len(bot.orders_db), bot.orders_db.get(oid) is None, bot.find_order(oid)["total"], flush=True)
+    # a change brings it back to the hot set
+    bot.set_order_status(bot.find_order(oid), "refunded")
+    bot.storage.close()
+    """ % old["order_id"])
+    assert out.split() == ["1", "True", "1"]
+    out = run_bot("print(bot.orders_db.get(%r)['status'])" % old["order_id"])
+    assert out.strip() == "refunded"
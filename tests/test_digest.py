@@ -0,0 +1,77 @@
+from concurrent.futures import Future
+
+import pytest
+
+import bot
+
+
+@pytest.fixture
+def sent(monkeypatch):
+    # (chat_id, text) of every digest message, answered at once
+    out = []
+
+    def send_message(chat_id, text, **kw):
+        out.append((chat_id, text))
+        done = Future()
+        done.set_result(None)
+        return done
+
+    monkeypatch.setattr(bot, "send_message", send_message)
+    return out
+
+
+def test_cluster_workers_leave_the_digest_to_worker_0(tmp_path, monkeypatch, sent):
+    shared = bot.SqliteStorage(str(tmp_path / "bot.sqlite3"))
+    shared.shared = True
+    monkeypatch.setattr(bot, "storage", shared)
+    digest = bot.AdminDigest(5)
+    for worker, order_id in ((1, "O-1"), (2, "O-2"), (0, "O-3")):
+        monkeypatch.setattr(bot, "CLUSTER_INDEX", worker)
+        digest.add(f"order {order_id}", [("ok", f"approve_order:{order_id}")])
+        digest.flush()
+        if worker:
+            assert sent == []
+    # one digest per admin, with every worker's items
+    assert [chat for chat, _ in sent] == bot.ADMIN_IDS
+    assert all("O-1" in text and "O-2" in text and "O-3" in text for _, text in sent)
+    assert shared.digest_items() == []
+    shared.close()
+
+
+def json_storage(monkeypatch):
+    storage = bot.JsonStorage()
+    storage.load_digest()
+    storage.flusher.stop()
+    monkeypatch.setattr(bot, "storage", storage)
+    return storage
+
+
+def test_unsent_items_survive_a_crash(tmp_path, monkeypatch, sent):
+    journal = tmp_path / "admin_digest.jsonl"
+    monkeypatch.setattr(bot, "DIGEST_JOURNAL", str(journal))
+    first = json_storage(monkeypatch)
+    digest = bot.AdminDigest(60)
+    digest.add("order O-1", [("ok", "approve_order:O-1")])
+    digest.add("order O-2", [("ok", "approve_order:O-2")])
+    digest.timer.cancel()                       # dies before the window ends
+    first.sync()
+    with open(journal, "a") as f:
+        f.write('{"i": 3, "v": {"te')           # torn tail
+    again = json_storage(monkeypatch)
+    assert [item["text"] for _, item in again.digest_items()] == ["order O-1", "order O-2"]
+    bot.AdminDigest(60).flush()                 # what startup does
+    assert [chat for chat, _ in sent] == bot.ADMIN_IDS
+    assert all("O-1" in text and "O-2" in text for _, text in sent)
+    assert again.digest_items() == []
+    assert json_storage(monkeypatch).digest_items() == []
+
+
+def test_sent_items_are_not_sent_again(tmp_path, monkeypatch, sent):
+    monkeypatch.setattr(bot, "DIGEST_JOURNAL", str(tmp_path / "admin_digest.jsonl"))
+    json_storage(monkeypatch)
+    digest = bot.AdminDigest(60)
+    digest.add("order O-1", [])
+    digest.flush()
+    digest.add("order O-2", [])
+    digest.timer.cancel()
+    assert [item["text"] for _, item in json_storage(monkeypatch).digest_items()] == ["order O-2"]
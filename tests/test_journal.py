@@ -0,0 +1,131 @@
+import json
+import os
+import threading
+
+import bot
+
+
+def shard(tmp_path):
+    return bot.UserShard(str(tmp_path / "users.json"), str(tmp_path / "users.journal.jsonl"))
+
+
+def wallets(users):
+    return {k: p["wallet"] for k, p in users.items()}
+
+
+def test_journal_replays_over_the_snapshot(tmp_path):
+    s = shard(tmp_path)
+    s.append("1", bot.UserRecord(wallet=10))
+    s.compact()
+    s.append("1", bot.UserRecord(wallet=20))
+    s.append("2", bot.UserRecord(wallet=5))
+    with open(s.journal, "a") as f:
+        f.write('{"k": "3", "v": {"wal')          # torn tail from a crash mid-append
+    again = shard(tmp_path)
+    assert wallets(again.load()) == {"1": 20, "2": 5}
+    # folded into the snapshot on load
+    assert json.loads(open(again.path).read())["1"]["wallet"] == 20
+    assert not os.path.exists(again.journal)
+
+
+def test_crash_during_compaction_loses_nothing(tmp_path):
+    s = shard(tmp_path)
+    s.append("1", bot.UserRecord(wallet=10))
+    s.compact()
+    s.append("1", bot.UserRecord(wallet=20))
+    # what compact() leaves if the process dies before the snapshot is rewritten:
+    # the old journal set aside, newer appends in a fresh one
+    os.replace(s.journal, s.pending)
+    s.append("1", bot.UserRecord(wallet=30))
+    s.append("2", bot.UserRecord(wallet=5))
+    again = shard(tmp_path)
+    assert wallets(again.load()) == {"1": 30, "2": 5}
+    assert not os.path.exists(again.pending)
+    assert wallets(shard(tmp_path).load()) == {"1": 30, "2": 5}
+
+
+def test_compaction_does_not_hold_up_appends(tmp_path, monkeypatch):
+    s = shard(tmp_path)
+    s.append("1", bot.UserRecord(wallet=10))
+    writing, release = threading.Event(), threading.Event()
+    save_json = bot.save_json
+
+    def slow_save(path, data):
+        writing.set()
+        release.wait(5)
+        save_json(path, data)
+
+    monkeypatch.setattr(bot, "save_json", slow_save)
+    compactor = threading.Thread(target=s.compact)
+    compactor.start()
+    assert writing.wait(5)
+    s.append("2", bot.UserRecord(wallet=5))       # would block if compact() held the lock
+    release.set()
+    compactor.join(5)
+    assert wallets(shard(tmp_path).load()) == {"1": 10, "2": 5}
+
+
+def test_put_user_leaves_compaction_to_maintenance(monkeypatch):
+    storage = bot.JsonStorage()
+    monkeypatch.setattr(bot, "PERSIST_MODE", "journal")
+    monkeypatch.setattr(bot, "JOURNAL_COMPACT_EVERY", 2 * len(storage.shards))
+    compacted = []
+    monkeypatch.setattr(bot.UserShard, "compact", compacted.append)
+    storage.put_user("7", bot.UserRecord(wallet=1))
+    assert not storage.compact_wanted.is_set()
+    storage.put_user("7", bot.UserRecord(wallet=2))
+    assert storage.compact_wanted.is_set() and compacted == []
+    storage.flusher.stop()
+
+
+ORDERS = """
+for n in (1, 2, 3):
+    bot.save_order({"order_id": f"O-{n}", "user_id": 42, "total": n, "cart": [],
+                    "time": "2026-01-01T00:00:00", "status": "pending"})
+bot.storage.close()
+"""
+
+# starts from the snapshot, changes old and new orders, folds, then dies
+FOLD = """
+import os
+assert bot.storage.snapshot is not None
+order = bot.find_order("O-2")
+order["status"] = "approved"
+bot.storage.update_order(order)
+bot.save_order({"order_id": "O-4", "user_id": 42, "total": 4, "cart": [],
+                "time": "2026-01-02T00:00:00", "status": "pending"})
+bot.orders_db.remove(["O-1"])
+bot.storage.remove_orders(["O-1"])
+bot.storage.fold_history()
+print(bot.orders_db.loaded, flush=True)
+os._exit(0)
+"""
+
+
+def test_fold_streams_from_the_snapshot(run_bot, tmp_path):
+    run_bot(ORDERS)
+    assert run_bot(FOLD).strip() == "False"
+    data = tmp_path / "data"
+    folded = json.loads((data / "orders.json").read_text())
+    assert [(o["order_id"], o["status"]) for o in folded] == [
+        ("O-2", "approved"), ("O-3", "pending"), ("O-4", "pending")]
+    assert not (data / "history.journal.jsonl").exists()
+    assert not (data / "history.journal.jsonl.folding").exists()
+
+
+def test_crash_during_fold_replays_the_set_aside_journal(run_bot, tmp_path):
+    run_bot(ORDERS)
+    data = tmp_path / "data"
+    run_bot("""
+    import os
+    bot.save_order({"order_id": "O-4", "user_id": 42, "total": 4, "cart": [],
+                    "time": "2026-01-02T00:00:00", "status": "pending"})
+    # dies right after the journal was set aside, before the files were rewritten
+    os.replace(bot.HISTORY_JOURNAL, bot.HISTORY_FOLDING)
+    bot.save_order({"order_id": "O-5", "user_id": 42, "total": 5, "cart": [],
+                    "time": "2026-01-02T00:00:00", "status": "pending"})
+    os._exit(0)
+    """)
+    out = run_bot("print(sorted(o['order_id'] for o in bot.orders_db))")
+    assert out.strip() == str(["O-1", "O-2", "O-3", "O-4", "O-5"])
+    assert not (data / "history.journal.jsonl.folding").exists()
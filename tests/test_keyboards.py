@@ -0,0 +1,43 @@
+import json
+
+import bot
+
+
+def test_keyboard_is_built_once_per_language():
+    registry = bot.KeyboardRegistry()
+    built = []
+
+    @registry.register("menu")
+    def menu(lang):
+        built.append(lang)
+        kb = bot.types.ReplyKeyboardMarkup(resize_keyboard=True)
+        kb.add(bot.types.KeyboardButton(f"menu-{lang}"))
+        return kb
+
+    registry.warm(("fa", "en"))
+    first = registry.get("menu", "en")
+    assert registry.get("menu", "en") is first
+    assert built == ["fa", "en"]
+    assert json.loads(first)["keyboard"] == [[{"text": "menu-en"}]]
+    registry.invalidate("menu")
+    registry.get("menu", "en")
+    assert built == ["fa", "en", "en"]
+
+
+def test_versioned_keyboard_follows_its_source():
+    registry = bot.KeyboardRegistry()
+    countries = {"Iran": 100}
+
+    @registry.register("countries", version=lambda: tuple(countries.items()))
+    def choice(lang):
+        kb = bot.types.ReplyKeyboardMarkup()
+        for name in countries:
+            kb.add(bot.types.KeyboardButton(name))
+        return kb
+
+    def labels():
+        return [row[0]["text"] for row in json.loads(registry.get("countries"))["keyboard"]]
+
+    assert labels() == ["Iran"]
+    countries["Turkey"] = 200
+    assert labels() == ["Iran", "Turkey"]
@@ -0,0 +1,77 @@
+import os
+from concurrent.futures import Future
+from types import SimpleNamespace
+
+import pytest
+from telebot.apihelper import ApiTelegramException
+
+import bot
+
+
+class Outbox:
+    # records (method, media) and leaves the futures to the test
+    def __init__(self):
+        self.sent = []
+
+    def submit(self, method, chat_id, media, priority=None, **kw):
+        future = Future()
+        self.sent.append((method, media, future))
+        return future
+
+
+def photo_message(file_id):
+    return SimpleNamespace(photo=[SimpleNamespace(file_id="thumb"), SimpleNamespace(file_id=file_id)])
+
+
+@pytest.fixture
+def media(tmp_path, monkeypatch):
+    out = Outbox()
+    cache_file = str(tmp_path / "media_cache.json")
+    monkeypatch.setattr(bot, "outbox", out)
+    monkeypatch.setattr(bot, "media_cache", bot.MediaCache(cache_file, "1"))
+    image = tmp_path / "creator.jpg"
+    image.write_bytes(b"jpeg-1")
+    return out, cache_file, str(image)
+
+
+def test_uploaded_once_then_sent_by_file_id(media):
+    out, cache_file, image = media
+    first = bot.send_media(1, "photo", image)
+    waiting = bot.send_media(2, "photo", image)            # same file while the upload runs
+    assert [(m, data) for m, data, _ in out.sent] == [("send_photo", b"jpeg-1")]
+    out.sent[0][2].set_result(photo_message("F1"))
+    assert first.result() is not None
+    assert [data for _, data, _ in out.sent] == [b"jpeg-1", "F1"]
+    out.sent[1][2].set_result("ok")
+    assert waiting.result() == "ok"
+    bot.send_media(3, "photo", image)
+    assert out.sent[-1][1] == "F1"
+    # kept on disk for this bot only
+    assert bot.MediaCache(cache_file, "1").entries == bot.media_cache.entries
+    assert bot.MediaCache(cache_file, "2").entries == {}
+
+
+def test_new_content_uploads_again(media):
+    out, cache_file, image = media
+    bot.send_media(1, "photo", image)
+    out.sent[0][2].set_result(photo_message("F1"))
+    stat = os.stat(image)
+    os.utime(image, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))    # touched only
+    bot.send_media(1, "photo", image)
+    assert out.sent[-1][1] == "F1"
+    with open(image, "wb") as f:
+        f.write(b"jpeg-2")
+    bot.send_media(1, "photo", image)
+    assert out.sent[-1][1] == b"jpeg-2"
+
+
+def test_rejected_file_id_is_forgotten(media):
+    out, cache_file, image = media
+    bot.send_media(1, "photo", image)
+    out.sent[0][2].set_result(photo_message("F1"))
+    bot.send_media(1, "photo", image)
+    out.sent[-1][2].set_exception(ApiTelegramException("sendPhoto", None, {
+        "error_code": 400, "description": "Bad Request: wrong file identifier"}))
+    assert bot.media_cache.entries == {}
+    bot.send_media(1, "photo", image)
+    assert out.sent[-1][1] == b"jpeg-1"
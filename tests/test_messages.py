@@ -0,0 +1,30 @@
+import bot
+
+MESSAGES = {
+    "fa": {"hello": "سلام {name}", "bye": "خداحافظ", "only_fa": "فقط فارسی"},
+    "en": {"hello": "Hello {name}", "bye": "Bye"},
+    "ar": {"hello": "مرحبا {name}"},
+}
+
+
+def test_missing_keys_follow_the_fallback_chain():
+    catalog = bot.MessageCatalog(MESSAGES, default="fa", fallbacks={"ar": ["en"]})
+    assert catalog.render("ar", "hello", name="x") == "مرحبا x"
+    assert catalog.render("ar", "bye") == "Bye"                  # ar -> en
+    assert catalog.render("en", "only_fa") == "فقط فارسی"        # en -> fa
+    assert catalog.render("de", "bye") == "خداحافظ"              # unknown language
+    assert catalog.render("en", "nope") == ""
+
+
+def test_fields_are_filled_only_where_there_are_some():
+    catalog = bot.MessageCatalog({"fa": {"plain": "50% off", "x": "{n} items"}})
+    assert catalog.compiled["fa"]["plain"] == ("50% off", False)
+    assert catalog.render("fa", "plain", n=1) == "50% off"
+    assert catalog.render("fa", "x", n=3) == "3 items"
+
+
+def test_every_shipped_message_renders():
+    catalog = bot.MessageCatalog(bot.MESSAGES, bot.DEFAULT_LANG, bot.LANG_FALLBACKS)
+    for lang in bot.MESSAGES:
+        for key in catalog.compiled[lang]:
+            assert catalog.render(lang, key) == catalog.compiled[lang][key][0]
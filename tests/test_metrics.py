@@ -0,0 +1,51 @@
+import urllib.error
+import urllib.request
+
+import pytest
+
+import bot
+
+
+@pytest.fixture
+def fresh(monkeypatch):
+    m = bot.Metrics(buckets=(0.01, 0.1, 1))
+    monkeypatch.setattr(bot, "metrics", m)
+    return m
+
+
+def test_histograms_and_errors(fresh):
+    @fresh.timed("h", handler="x")
+    def fails():
+        raise ValueError()
+
+    for seconds in (0.005, 0.05, 0.05, 5):
+        fresh.observe("h_seconds", seconds, handler="x")
+    with pytest.raises(ValueError):
+        fails()
+    [(labels, count, total, p50, p95)] = fresh.summary("h_seconds")
+    assert labels == {"handler": "x"} and count == 5
+    assert (p50, p95) == (0.1, float("inf"))
+    assert fresh.counter_total("h_errors_total", handler="x") == 1
+
+
+def test_endpoint_serves_prometheus_text(fresh):
+    fresh.inc("updates_total", kind="message")
+    fresh.observe("h_seconds", 0.05, handler="start")
+    fresh.gauge("queue_depth", lambda: 7)
+    fresh.gauge("broken", lambda: 1 / 0)
+    server = bot.MetricsServer("127.0.0.1", 0).start()
+    base = f"http://127.0.0.1:{server.httpd.server_address[1]}"
+    try:
+        body = urllib.request.urlopen(base + "/metrics", timeout=5).read().decode()
+        with pytest.raises(urllib.error.HTTPError) as err:
+            urllib.request.urlopen(base + "/", timeout=5)
+        assert err.value.code == 404
+    finally:
+        server.httpd.shutdown()
+    lines = body.splitlines()
+    assert 'updates_total{kind="message"} 1' in lines
+    assert 'h_seconds_bucket{handler="start",le="0.1"} 1' in lines
+    assert 'h_seconds_bucket{handler="start",le="+Inf"} 1' in lines
+    assert 'h_seconds_count{handler="start"} 1' in lines
+    assert "queue_depth 7" in lines
+    assert not any(line.startswith("broken") for line in lines)
@@ -0,0 +1,54 @@
+import threading
+import time
+
+from telebot.apihelper import ApiTelegramException
+
+import bot
+
+
+class FloodedBot:
+    # the first send_message answers 429 retry_after=1, the rest succeed
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = []
+
+    def send_message(self, chat_id, text, **kw):
+        with self.lock:
+            self.calls.append((time.monotonic(), chat_id, text))
+            first = len(self.calls) == 1
+        if first:
+            raise ApiTelegramException("sendMessage", None, {
+                "ok": False, "error_code": 429, "description": "Too Many Requests: retry after 1",
+                "parameters": {"retry_after": 1}})
+        return {"chat": chat_id, "text": text}
+
+
+def test_429_pauses_every_chat():
+    api = FloodedBot()
+    outbox = bot.Outbox(api, 2, global_rate=1000, chat_rate=1000, chat_burst=10, max_retries=3)
+    first = outbox.submit("send_message", 1, "a")
+    time.sleep(0.2)                     # the 429 has come back by now
+    flooded_at = api.calls[0][0]
+    other = outbox.submit("send_message", 2, "b")
+    assert other.result(timeout=5) == {"chat": 2, "text": "b"}
+    assert first.result(timeout=5) == {"chat": 1, "text": "a"}
+    # the other chat was held back by the global pause, not only chat 1
+    sent_other = next(t for t, chat, _ in api.calls if chat == 2)
+    assert sent_other - flooded_at >= 0.9
+    assert outbox.retried == 1 and outbox.failed == 0
+
+
+def test_many_chats_share_buckets_safely():
+    sent = []
+
+    class QuickBot:
+        def send_message(self, chat_id, text, **kw):
+            sent.append(chat_id)
+
+    outbox = bot.Outbox(QuickBot(), 8, global_rate=1e9, chat_rate=1e9, chat_burst=1e9, max_retries=0)
+    futures = [outbox.submit("send_message", chat, "x") for chat in range(60000)]
+    for f in futures[-100:]:
+        f.result(timeout=60)
+    outbox.drain(60)
+    assert outbox.failed == 0 and len(sent) == 60000
+    assert all(t.is_alive() for t in outbox.threads)
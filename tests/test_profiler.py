@@ -0,0 +1,43 @@
+import threading
+
+import bot
+
+
+def spin(stop):
+    n = 0
+    while not stop.is_set():
+        n += 1
+
+
+def test_report_finds_the_busy_function():
+    stop = threading.Event()
+    worker = threading.Thread(target=spin, args=(stop,), name="spinner-1")
+    worker.start()
+    try:
+        report = bot.SamplingProfiler(interval=0.005).profile(0.3, memory=True)
+    finally:
+        stop.set()
+        worker.join()
+    assert report.startswith("profile: 0.3s")
+    assert "  spinner: " in report                 # thread names lose their number
+    cumulative = report.split("top by cumulative")[1].split("top by self")[0]
+    assert "spin (test_profiler.py:" in cumulative
+    assert "structures (entries, ~bytes)" in report and "user_states:" in report
+
+
+def test_one_profile_at_a_time():
+    profiler = bot.SamplingProfiler(interval=0.005)
+    reports = []
+    finished = threading.Event()
+
+    def done(report):
+        reports.append(report)
+        finished.set()
+
+    assert profiler.start(1, False, done)
+    assert not profiler.start(1, False, done)
+    assert finished.wait(10)
+    assert len(reports) == 1 and reports[0].startswith("profile: 1s")
+    finished.clear()
+    assert profiler.start(1, False, done)          # free again
+    assert finished.wait(10)
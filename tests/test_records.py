@@ -0,0 +1,26 @@
+import sys
+
+import bot
+
+STORED = {"first_name": "Ali", "lang": "fa", "wallet": 5000, "points": 3,
+          "created_at": "2026-01-02T03:04:05", "note": "vip soon"}
+
+
+def test_reads_like_the_old_profile_dict():
+    rec = bot.UserRecord.from_dict(dict(STORED))
+    assert rec["wallet"] == 5000 and rec.get("phone", "-") == "-"
+    assert "lang" in rec and "phone" not in rec
+    assert rec["note"] == "vip soon"                # outside FIELDS
+    rec["wallet"] -= 1000
+    rec["phone"] = "+98"
+    assert rec.to_dict() == dict(STORED, wallet=4000, phone="+98")
+    assert isinstance(rec.created_at, int)
+    assert rec.lang is sys.intern("fa")
+
+
+def test_snapshot_row_round_trip():
+    rec = bot.UserRecord.from_dict(dict(STORED))
+    again = bot.UserRecord.from_row(rec.to_row())
+    assert again.to_dict() == rec.to_dict()
+    assert "phone" not in again
+    assert bot.UserRecord.from_row(bot.UserRecord(wallet=1).to_row()).keys() == ["wallet"]
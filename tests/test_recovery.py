@@ -0,0 +1,245 @@
+import threading
+import time
+
+import pytest
+import telebot
+from telebot import types
+
+import bench
+import bot
+
+ADMIN = bot.ADMIN_IDS[0]
+
+PREP = """
+bot.save_receipt({"receipt_id": "R-1", "user_id": 42, "amount": 5000,
+                  "time": "2026-01-01T00:00:00", "status": "pending"})
+bot.save_order({"order_id": "O-1", "user_id": 42, "total": 100, "cart": [],
+                "time": "2026-01-01T00:00:00", "status": "pending"})
+bot.storage.close()
+"""
+
+# handle what getUpdates has, then die: no checkpoint, no clean close
+CRASH = """
+import os, time
+dispatcher = bot.ChatDispatcher(bot.bot, 2).install()
+bot.catch_up(dispatcher)
+while bot.update_ledger.inflight:
+    time.sleep(0.01)
+bot.outbox.drain()
+print(bot.user_profile(42).get("wallet", 0), bot.find_order("O-1")["status"], flush=True)
+os._exit(0)
+"""
+
+
+# the same in asyncio mode
+ASYNC_CRASH = """
+import asyncio, os
+abot, executor = bot.build_async_bot()
+
+async def main():
+    asyncio.create_task(abot.polling(non_stop=True, timeout=1, request_timeout=5))
+    while bot.update_ledger.watermark < 2 or bot.update_ledger.inflight:
+        await asyncio.sleep(0.05)
+
+asyncio.run(asyncio.wait_for(main(), 30))
+bot.outbox.drain()
+print(bot.user_profile(42).get("wallet", 0), bot.find_order("O-1")["status"], flush=True)
+os._exit(0)
+"""
+
+
+def last_line(out):
+    return out.strip().splitlines()[-1]
+
+
+def approvals_sent(api):
+    return [m["text"] for method, chat, m in api.sent if chat == 42 and "O-1" in m.get("text", "")]
+
+
+@pytest.mark.parametrize("storage", ["json", "sqlite"])
+def test_replay_after_crash_is_dropped(storage, fake_api, run_bot):
+    api, url = fake_api
+    env = {"BOT_STORAGE": storage, "BOT_API_URL": url}
+    run_bot(PREP, **env)
+    digest = api.new_message(ADMIN, text="digest")
+    api.inject(bench.callback_update(ADMIN, "approve_receipt:R-1", digest))
+    api.inject(bench.callback_update(ADMIN, "approve_order:O-1", digest))
+    assert last_line(run_bot(CRASH, **env)) == "5000 approved"
+    # polling never moved past them, so both come again after the restart
+    assert len(api.updates) == 2
+    assert last_line(run_bot(CRASH, **env)) == "5000 approved"
+    assert api.calls["answerCallbackQuery"] == 2
+    assert len(approvals_sent(api)) == 1
+
+
+def test_async_mode_drops_a_replay(fake_api, run_bot):
+    api, url = fake_api
+    env = {"BOT_API_URL": url}
+    run_bot(PREP, **env)
+    digest = api.new_message(ADMIN, text="digest")
+    updates = [bench.callback_update(ADMIN, data, digest) for data in ("approve_receipt:R-1", "approve_order:O-1")]
+    for u in updates:
+        api.inject(u)
+    assert last_line(run_bot(ASYNC_CRASH, **env)) == "5000 approved"
+    # polling goes on after they are done; as if Telegram never saw the new offset
+    with api.lock:
+        api.updates = [dict(u) for u in updates]
+    assert last_line(run_bot(ASYNC_CRASH, **env)) == "5000 approved"
+    assert api.calls["answerCallbackQuery"] == 2
+    assert len(approvals_sent(api)) == 1
+
+
+@pytest.mark.parametrize("storage", ["json", "sqlite"])
+def test_second_click_does_not_apply_twice(storage, fake_api, run_bot):
+    api, url = fake_api
+    env = {"BOT_STORAGE": storage, "BOT_API_URL": url}
+    run_bot(PREP, **env)
+    digest = api.new_message(ADMIN, text="digest")
+    for data in ("approve_receipt:R-1", "approve_order:O-1") * 2:
+        api.inject(bench.callback_update(ADMIN, data, digest))
+    assert last_line(run_bot(CRASH, **env)) == "5000 approved"
+    assert api.calls["answerCallbackQuery"] == 4
+    assert len(approvals_sent(api)) == 1
+
+
+class StubBot:
+    last_update_id = 0
+
+
+@pytest.fixture
+def ledger(monkeypatch):
+    handled = []
+    release = threading.Event()
+
+    def process(self, updates):
+        release.wait(5)
+        handled.extend(u.update_id for u in updates)
+
+    fresh = bot.UpdateLedger()
+    monkeypatch.setattr(bot, "update_ledger", fresh)
+    monkeypatch.setattr(telebot.TeleBot, "process_new_updates", process)
+    return fresh, handled, release
+
+
+def update(update_id, chat_id=42):
+    return types.Update.de_json({"update_id": update_id, "message": {
+        "message_id": 1, "date": 0, "text": "/start", "chat": {"id": chat_id, "type": "private"},
+        "from": {"id": chat_id, "is_bot": False, "first_name": "t"}}})
+
+
+def test_double_submit_is_handled_once(ledger):
+    fresh, handled, release = ledger
+    dispatcher = bot.ChatDispatcher(StubBot(), 2)
+    try:
+        assert dispatcher.submit(update(1)) is True
+        assert dispatcher.submit(update(1)) is False          # still running
+        assert not dispatcher.wait_applied(1, 0.05)
+        release.set()
+        assert dispatcher.wait_applied(1, 5)
+        assert dispatcher.submit(update(1)) is False          # done
+    finally:
+        dispatcher.stop()
+    assert handled == [1]
+    assert fresh.watermark == 1
+
+
+def test_polling_resumes_from_the_watermark(ledger):
+    fresh, handled, release = ledger
+    stub = StubBot()
+    dispatcher = bot.ChatDispatcher(stub, 2)
+    try:
+        # both still running: polling must not confirm either to Telegram
+        dispatcher.submit_updates([update(1, chat_id=1), update(2, chat_id=2)])
+        assert fresh.watermark == 0
+        release.set()
+        assert dispatcher.wait_applied(2, 5) and dispatcher.wait_applied(1, 5)
+        dispatcher.submit_updates([update(1, chat_id=1), update(2, chat_id=2), update(3)])
+        assert dispatcher.wait_applied(3, 5)
+    finally:
+        dispatcher.stop()
+    assert sorted(handled) == [1, 2, 3]
+    assert fresh.watermark == 3
+
+
+def until(check, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not check():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+@pytest.fixture
+def polled(fake_api, monkeypatch):
+    # a TeleBot on the fake API whose handler for chat 1 blocks until released;
+    # offsets: (offset asked for, released yet) per getUpdates call
+    api, url = fake_api
+    monkeypatch.setattr(telebot.apihelper, "API_URL", url)
+    monkeypatch.setattr(bot, "update_ledger", bot.UpdateLedger())
+    offsets = []
+    get_updates = api.get_updates
+    release = threading.Event()
+
+    def recording(params):
+        offsets.append((int(params.get("offset", 0)), release.is_set()))
+        return get_updates(params)
+
+    monkeypatch.setattr(api, "get_updates", recording)
+    handled = []
+    tb = telebot.TeleBot("123456:TEST", threaded=False)
+
+    @tb.message_handler(func=lambda m: True)
+    def slow(message):
+        if message.chat.id == 1:
+            release.wait(10)
+        handled.append(message.chat.id)
+
+    dispatcher = bot.ChatDispatcher(tb, 2)
+    yield api, tb, dispatcher, offsets, release, handled
+    release.set()
+    dispatcher.stop()
+
+
+def test_polling_offset_stays_below_a_running_update(polled):
+    api, tb, dispatcher, offsets, release, handled = polled
+    dispatcher.install()
+    api.inject(bench.text_update(1, "/start"))      # blocks its worker
+    api.inject(bench.text_update(2, "/start"))      # runs on the other one
+    poller = threading.Thread(target=tb.polling, daemon=True, kwargs={
+        "non_stop": True, "interval": 0, "timeout": 5, "long_polling_timeout": 1})
+    poller.start()
+    try:
+        until(lambda: handled == [2])
+        seen = len(offsets)
+        until(lambda: len(offsets) >= seen + 2)
+        # the worker that ran update 2 moved telebot's own offset past update 1
+        assert tb.last_update_id == 2
+        assert {offset for offset, _ in offsets} == {1}
+        assert api.updates[0]["update_id"] == 1     # Telegram still has it
+        release.set()
+        until(lambda: offsets[-1][0] == 3)
+    finally:
+        tb.stop_polling()
+        poller.join(5)
+    assert sorted(handled) == [1, 2]
+
+
+def test_catch_up_pages_from_the_watermark(polled):
+    api, tb, dispatcher, offsets, release, handled = polled
+    for chat in (1, 2, 2):
+        api.inject(bench.text_update(chat, "/start"))
+    threading.Timer(1.5, release.set).start()
+    bot.catch_up(dispatcher, batch=2)
+    until(lambda: not bot.update_ledger.inflight)
+    assert sorted(handled) == [1, 2, 2]
+    # while update 1 ran, every page started at it
+    assert {offset for offset, released in offsets if not released} == {1}
+    assert bot.update_ledger.watermark == 3
+
+
+def test_ledger_restores_offset_and_applied_ids():
+    ledger = bot.UpdateLedger(offset=10, applied={12})
+    assert not ledger.begin(9)
+    assert not ledger.begin(12)
+    assert ledger.begin(11)
+    ledger.finish(11)
+    assert ledger.watermark == 12
@@ -0,0 +1,83 @@
+import os
+
+import bot
+
+
+def order(oid, status="pending"):
+    return {"order_id": oid, "user_id": 42, "total": 1, "time": "2026-01-01T00:00:00", "status": status}
+
+
+def write(tmp_path, sources):
+    path = str(tmp_path / "snapshot.bin")
+    users = [{"1": bot.UserRecord(wallet=10)}, {"2": bot.UserRecord(wallet=20, lang="en")}]
+    history = {"orders": ("order_id", (order(f"O-{n}") for n in range(3))),
+               "broadcasts": (None, iter([{"text": "hi"}]))}
+    bot.BinarySnapshot.write(path, bot.BinarySnapshot.sources(sources), users, history)
+    return path
+
+
+def test_round_trip_and_single_record_reads(tmp_path):
+    source = tmp_path / "users.json"
+    source.write_text("{}")
+    path = write(tmp_path, [str(source)])
+    snap = bot.BinarySnapshot.open(path, bot.BinarySnapshot.sources([str(source)]), 2)
+    try:
+        assert [{k: u.to_dict() for k, u in part.items()} for part in snap.users()] == [
+            {"1": {"wallet": 10}}, {"2": {"wallet": 20, "lang": "en"}}]
+        assert snap.count("orders") == 3
+        assert snap.get("orders", "O-2") == order("O-2")
+        assert snap.get("orders", "O-9") is None
+        assert snap.records("broadcasts") == [{"text": "hi"}]
+    finally:
+        snap.close()
+
+
+def test_stale_or_foreign_snapshot_is_ignored(tmp_path):
+    source = tmp_path / "users.json"
+    source.write_text("{}")
+    path = write(tmp_path, [str(source)])
+    assert bot.BinarySnapshot.open(path, bot.BinarySnapshot.sources([str(source)]), 3) is None   # resharded
+    source.write_text('{"1": {}}')
+    assert bot.BinarySnapshot.open(path, bot.BinarySnapshot.sources([str(source)]), 2) is None   # changed since
+    with open(path, "r+b") as f:
+        f.truncate(os.path.getsize(path) - 4)
+    assert bot.BinarySnapshot.open(path, {}, 2) is None
+
+
+def test_lazy_history_fetches_one_record_until_iterated():
+    stored = [order("O-1"), order("O-2"), order("O-3")]
+    fetched = []
+
+    def fetch_one(rid):
+        fetched.append(rid)
+        return next((dict(r) for r in stored if r["order_id"] == rid), None)
+
+    h = bot.LazyHistory("order_id", stored=3, fetch_one=fetch_one, fetch_all=lambda: [dict(r) for r in stored],
+                        fetch_iter=lambda: (dict(r) for r in stored))
+    h.append(order("O-4"))
+    h.remove(["O-1"])
+    changed = h.get("O-2")
+    changed["status"] = "paid"
+    assert fetched == ["O-2"] and len(h) == 3 and not h.loaded
+    assert h.get("O-1") is None
+    # streamed and loaded views agree, with this run's copy of O-2
+    streamed = list(h.iter_all())
+    assert not h.loaded
+    assert [(r["order_id"], r["status"]) for r in streamed] == [("O-2", "paid"), ("O-3", "pending"), ("O-4", "pending")]
+    assert list(h) == streamed and h.loaded
+    assert h.get("O-2") is changed
+
+
+def test_restart_reads_history_from_the_snapshot(run_bot):
+    run_bot("""
+    for n in (1, 2):
+        bot.save_order({"order_id": f"O-{n}", "user_id": 42, "total": n, "cart": [],
+                        "time": "2026-01-01T00:00:00", "status": "pending"})
+    bot.set_profile(42, {"first_name": "a", "wallet": 7})
+    bot.storage.close()
+    """)
+    out = run_bot("""
+    print(bot.storage.snapshot is not None, bot.orders_db.loaded, len(bot.orders_db),
+          bot.find_order("O-2")["total"], bot.user_profile(42)["wallet"])
+    """)
+    assert out.split() == ["True", "False", "2", "2", "7"]
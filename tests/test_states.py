@@ -0,0 +1,50 @@
+from datetime import datetime
+
+import bot
+
+
+def test_least_recently_used_is_evicted():
+    states = bot.StateStore(max_size=2, ttl=60)
+    states[1] = {"stage": "a"}
+    states[2] = {"stage": "b"}
+    assert states.get(1)["stage"] == "a"        # 2 is now the oldest
+    states[3] = {"stage": "c"}
+    assert 2 not in states and 1 in states and 3 in states
+    assert states.stats()["evicted"] == 1
+
+
+def test_idle_states_expire(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(bot.time, "time", lambda: now[0])
+    states = bot.StateStore(max_size=10, ttl=60)
+    states[1] = {"stage": "a"}
+    states[2] = {"stage": "b"}
+    now[0] += 30
+    assert states.get(2)["stage"] == "b"
+    now[0] += 45                                 # 1 idle for 75s, 2 for 45s
+    assert states.get(1) is None
+    now[0] += 30
+    assert states.sweep() == 1 and len(states) == 0
+    assert states.stats()["expired"] == 2
+
+
+def test_get_or_create_keeps_the_write_after_an_eviction():
+    states = bot.StateStore(max_size=1, ttl=60)
+    state = {"flow": "shop", "stage": "choose_type", "cart": []}
+    states[1] = state
+    states[2] = {"stage": "other"}               # a busy moment evicts chat 1
+    states.get_or_create(1, state)["stage"] = "choose_country"
+    assert states.get(1) is state and state["stage"] == "choose_country"
+    # an existing state wins over the default
+    assert states.get_or_create(1, {}) is state
+
+
+def test_open_conversations_survive_a_restart(tmp_path):
+    path = str(tmp_path / "states.json")
+    states = bot.StateStore(max_size=10, ttl=60)
+    expiry = datetime(2026, 1, 1, 12, 0)
+    states[1] = {"flow": "shop", "stage": "await_code", "code": "1234", "expiry": expiry}
+    states.save(path)
+    again = bot.StateStore(max_size=10, ttl=60)
+    assert again.restore(path) == 1
+    assert again.get(1) == {"flow": "shop", "stage": "await_code", "code": "1234", "expiry": expiry}
@@ -0,0 +1,67 @@
+import json
+import os
+
+WRITE = """
+for i in range(300):
+    bot.set_profile(1000 + i, {"first_name": f"u{i}", "wallet": i * 10, "lang": "en" if i % 3 else "fa"})
+bot.save_receipt({"receipt_id": "R-1", "user_id": 1000, "amount": 5000,
+                  "time": "2026-01-01T00:00:00", "status": "approved"})
+bot.storage.mark_applied(80)
+bot.storage.save_checkpoint(77)
+bot.storage.close()
+"""
+
+DUMP = """
+import json
+print(json.dumps({
+    "users": {k: p.to_dict() for k, p in bot.users_db.items()},
+    "receipts": list(bot.receipts_db),
+    "checkpoint": [bot.update_ledger.floor, sorted(bot.update_ledger.recent)],
+}, sort_keys=True))
+"""
+
+
+def dump(run_bot, **env):
+    return json.loads(run_bot(DUMP, **env))
+
+
+def test_reshard_round_trip(run_bot, tmp_path):
+    manifest = tmp_path / "data" / "users_shards.json"
+    run_bot(WRITE)
+    before = dump(run_bot)
+    assert len(before["users"]) == 300 and before["checkpoint"] == [77, [80]]
+
+    run_bot("bot.reshard_users(4)")
+    assert json.loads(manifest.read_text()) == {"shards": 4}
+    assert not os.path.exists(tmp_path / "data" / "users.json")
+    assert dump(run_bot) == before
+
+    run_bot("bot.reshard_users(1)")
+    assert not manifest.exists()
+    assert dump(run_bot) == before
+
+
+def test_migrate_keeps_data_and_checkpoint(run_bot):
+    run_bot(WRITE)
+    before = dump(run_bot)
+    run_bot("bot.migrate_json_to_sqlite()")
+    assert dump(run_bot, BOT_STORAGE="sqlite") == before
+
+
+def test_migrate_refuses_a_database_in_use(run_bot):
+    run_bot(WRITE)
+    run_bot("bot.migrate_json_to_sqlite()")
+    # the bot has run on SQLite since: a second migrate must not wipe that
+    run_bot("bot.set_profile(5, {'first_name': 'new', 'wallet': 70})\nbot.storage.close()", BOT_STORAGE="sqlite")
+    after = dump(run_bot, BOT_STORAGE="sqlite")
+    out = run_bot("""
+    try:
+        bot.migrate_json_to_sqlite()
+    except SystemExit as e:
+        print(e)
+    """)
+    assert "already has data" in out
+    assert dump(run_bot, BOT_STORAGE="sqlite") == after
+    assert after["users"]["5"]["wallet"] == 70
+    run_bot("bot.migrate_json_to_sqlite(force=True)")
+    assert "5" not in dump(run_bot, BOT_STORAGE="sqlite")["users"]
@@ -0,0 +1,79 @@
+import json
+import http.client
+
+import pytest
+
+import bot
+
+
+class Collector:
+    # stands in for ChatDispatcher: keeps what WebhookServer hands over
+    def __init__(self):
+        self.updates = []
+
+    def submit(self, update, timeout=None):
+        self.updates.append(update)
+        return True
+
+    def wait_applied(self, update_id, timeout):
+        return True
+
+
+@pytest.fixture
+def server():
+    collector = Collector()
+    srv = bot.WebhookServer(collector, "127.0.0.1", 0, path="/telegram", secret="s3cret").start()
+    yield srv, collector
+    srv.stop()
+
+
+def post(srv, body, secret="s3cret", path="/telegram", headers=None):
+    conn = http.client.HTTPConnection(*srv.address, timeout=10)
+    hdrs = {"Content-Type": "application/json", "X-Telegram-Bot-Api-Secret-Token": secret}
+    hdrs.update(headers or {})
+    conn.request("POST", path, body=body, headers=hdrs)
+    status = conn.getresponse().status
+    conn.close()
+    return status
+
+
+def update(update_id, chat_id=42, text="/start"):
+    return json.dumps({"update_id": update_id, "message": {
+        "message_id": 1, "date": 0, "text": text,
+        "chat": {"id": chat_id, "type": "private"},
+        "from": {"id": chat_id, "is_bot": False, "first_name": "t"}}})
+
+
+def test_valid_update_reaches_dispatcher(server):
+    srv, collector = server
+    assert post(srv, update(7)) == 200
+    assert [u.update_id for u in collector.updates] == [7]
+    assert collector.updates[0].message.text == "/start"
+
+
+def test_bad_secret_is_refused(server):
+    srv, collector = server
+    assert post(srv, update(8), secret="wrong") == 403
+    assert post(srv, update(8), secret="") == 403
+    assert collector.updates == []
+
+
+def test_wrong_path_and_bad_json(server):
+    srv, collector = server
+    assert post(srv, update(9), path="/other") == 404
+    assert post(srv, b"{not json") == 400
+    assert post(srv, b"{}") == 400
+    assert collector.updates == []
+
+
+def test_oversized_body_is_refused_unread(server):
+    srv, collector = server
+    # only the header is sent: the server must answer without reading the body
+    conn = http.client.HTTPConnection(*srv.address, timeout=10)
+    conn.putrequest("POST", "/telegram")
+    conn.putheader("X-Telegram-Bot-Api-Secret-Token", "s3cret")
+    conn.putheader("Content-Length", str(bot.WEBHOOK_MAX_BODY + 1))
+    conn.endheaders()
+    assert conn.getresponse().status == 413
+    conn.close()
+    assert collector.updates == []